@@ -44,15 +44,34 @@ a = Analysis(
         'PIL',
         'PIL.Image',
         'PIL.ImageDraw',
+        'PIL.WebPImagePlugin',
+        'shapely',
         'server',
         'server.config',
         'server.state',
         'server.filters',
         'server.helpers',
+        'server.image_cache',
+        'server.composite_cache',
+        'server.encoders',
+        'server.fog_raster',
+        'server.fog_normalize',
+        'server.fog_ops',
+        'server.fog_codec',
+        'server.state_sync',
+        'server.token_store',
+        'server.token_broadcast',
+        'server.message_bus',
+        'server.save_store',
+        'server.journal',
         'server.map_gen',
+        'server.transport',
+        'server.tiles',
         'server.tunnel',
         'server.routes_core',
         'server.auth',
+        'server.render_pool',
+        'server.render_worker',
         'server.routes_saves',
         'server.sockets',
         'webview',
@@ -62,7 +81,7 @@ a = Analysis(
     runtime_hooks=[],
     excludes=[
         'tkinter', '_tkinter',
-        'matplotlib', 'numpy', 'scipy', 'pandas',
+        'matplotlib', 'scipy', 'pandas',
         'pytest', 'unittest',
     ],
     noarchive=False,
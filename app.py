@@ -15,13 +15,16 @@ if sys.stderr is None:
 import time
 import socket
 import threading
+import multiprocessing
 
 import webview
 
 from server import create_app, socketio
 from server import config
 from server.config import cleanup_generated_maps, IS_PROD
+from server.composite_cache import trim_disk as trim_composite_cache
 from server.routes_saves import _auto_load_latest_save, _save_on_shutdown
+from server.journal import init_journal
 from server.tunnel import _find_cloudflared, _start_tunnel
 
 
@@ -36,8 +39,12 @@ app = create_app()
 
 # --- Main Execution ---
 if __name__ == '__main__':
+    # Render pool workers (RENDER_ENGINE = 'process') re-launch this exe when frozen
+    multiprocessing.freeze_support()
     cleanup_generated_maps()
+    trim_composite_cache()
     _auto_load_latest_save()
+    init_journal()  # replays changes a crash kept out of the latest save
 
     if not IS_PROD:
         with app.app_context(): print("--- Registered URL Routes ---\n", app.url_map, "\n-----------------------------")
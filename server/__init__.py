@@ -7,10 +7,14 @@ from flask import Flask
 from flask_socketio import SocketIO
 
 from server import config
+from server import message_bus
 from server.filters import load_available_filters
 from server.routes_core import core_bp
-from server.routes_saves import saves_bp, init_saves, _init_saves_db
+from server.routes_saves import saves_bp, init_saves
+from server import save_store
 from server.sockets import register_socket_handlers
+from server.render_worker import init_render_worker
+from server.token_broadcast import init_token_broadcast
 
 socketio = SocketIO()
 
@@ -22,18 +26,29 @@ def create_app():
                 template_folder=os.path.join(config.BUNDLE_DIR, 'templates'))
     app.config['SECRET_KEY'] = os.urandom(24)
 
-    # Initialize SocketIO
-    socketio.init_app(app, cors_allowed_origins="*", async_mode='threading')
+    # Initialize SocketIO (with the shared bus when running as one of several workers)
+    socketio.init_app(app, cors_allowed_origins="*", async_mode='threading', client_manager=message_bus.init_message_bus(app),
+                      ping_interval=config.SOCKETIO_PING_INTERVAL, ping_timeout=config.SOCKETIO_PING_TIMEOUT,
+                      max_http_buffer_size=config.SOCKETIO_MAX_MESSAGE_BYTES)
+    message_bus.start_listening(socketio)
 
     # Load filters
     load_available_filters()
 
     # Initialize saves DB + migration
-    _init_saves_db()
+    save_store.init_db()
 
     # Provide socketio reference to saves blueprint
     init_saves(socketio)
 
+    # Fan-out workers hold player sockets only — sessions, rendering and tokens live in the authoritative worker
+    if not message_bus.is_fanout():
+        # Start the background map render worker
+        init_render_worker(socketio)
+
+        # Start the token broadcast tick
+        init_token_broadcast(socketio)
+
     # Register blueprints
     app.register_blueprint(core_bp)
     app.register_blueprint(saves_bp)
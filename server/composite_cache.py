@@ -0,0 +1,229 @@
+# server/composite_cache.py
+# Content-addressed cache of encoded player map composites (memory tier + size-capped disk tier)
+
+import os
+import json
+import queue
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from server import config
+
+_memory = OrderedDict()    # key -> encoded image bytes
+_memory_bytes = 0
+_disk_bytes = None         # lazily scanned total size of composite files on disk
+_lock = threading.Lock()
+_fog_digests = OrderedDict()   # id(fog list) -> (fog list, digest); holding the list keeps its id from being reused
+_FOG_DIGEST_MEMO_MAX = 16
+_disk_queue = queue.Queue(maxsize=32)   # (key, ext, data) waiting for the disk writer
+_disk_pending = {}         # key -> bytes queued for disk, still served by get() (they may not fit the memory tier)
+_disk_thread = None
+
+
+def _fog_digest(fog_data):
+    """
+    sha256 of a fog list's canonical JSON, memoized per list object: fog lists are replaced on
+    every change, never mutated (see helpers.merge_dicts), so one render per revision pays for it.
+    """
+    with _lock:
+        entry = _fog_digests.get(id(fog_data))
+        if entry is not None and entry[0] is fog_data:
+            _fog_digests.move_to_end(id(fog_data))
+            return entry[1]
+    fog_json = json.dumps(fog_data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.sha256(fog_json.encode('utf-8')).digest()
+    with _lock:
+        _fog_digests[id(fog_data)] = (fog_data, digest)
+        _fog_digests.move_to_end(id(fog_data))
+        while len(_fog_digests) > _FOG_DIGEST_MEMO_MAX:
+            _fog_digests.popitem(last=False)
+    return digest
+
+
+def composite_key(map_digest, fog_data, encoder_settings):
+    """Content address of a composite: hash of (map file hash, fog hash, encoder settings)."""
+    h = hashlib.sha256()
+    h.update(map_digest.encode('ascii'))
+    h.update(b'\0'); h.update(_fog_digest(fog_data))
+    h.update(b'\0'); h.update(repr(tuple(encoder_settings)).encode('utf-8'))
+    return h.hexdigest()[:40]
+
+
+def filename_for(key, ext):
+    return f"{config.COMPOSITE_CACHE_PREFIX}{key}.{ext}"
+
+
+def url_for(key, ext):
+    return f"/generated_maps/{filename_for(key, ext)}"
+
+
+def key_from_filename(filename):
+    """Return (key, ext) for a composite cache filename, or (None, None) if it isn't one."""
+    if not filename.startswith(config.COMPOSITE_CACHE_PREFIX) or '.' not in filename:
+        return None, None
+    key, ext = filename[len(config.COMPOSITE_CACHE_PREFIX):].rsplit('.', 1)
+    if not key or not all(c in '0123456789abcdef' for c in key):
+        return None, None
+    return key, ext
+
+
+def _disk_path(key, ext):
+    return os.path.join(config.GENERATED_MAPS_FOLDER, filename_for(key, ext))
+
+
+def _composite_files():
+    """(path, size, mtime) of every composite file on disk."""
+    entries = []
+    for filename in os.listdir(config.GENERATED_MAPS_FOLDER):
+        if key_from_filename(filename)[0] is None:
+            continue
+        path = os.path.join(config.GENERATED_MAPS_FOLDER, filename)
+        try:
+            st = os.stat(path)
+            entries.append((path, st.st_size, st.st_mtime))
+        except OSError:
+            pass
+    return entries
+
+
+def _remember_memory_locked(key, data):
+    global _memory_bytes
+    if key in _memory:
+        _memory.move_to_end(key)
+        return
+    if len(data) > config.COMPOSITE_CACHE_MEMORY_MAX_BYTES:
+        return
+    _memory[key] = data
+    _memory_bytes += len(data)
+    while _memory and _memory_bytes > config.COMPOSITE_CACHE_MEMORY_MAX_BYTES:
+        _, old = _memory.popitem(last=False)
+        _memory_bytes -= len(old)
+
+
+def get(key, ext):
+    """Return cached composite bytes (memory first, then disk), or None on a miss."""
+    with _lock:
+        data = _memory.get(key)
+        if data is not None:
+            _memory.move_to_end(key)
+            return data
+        data = _disk_pending.get(key)
+        if data is not None:
+            return data
+    path = _disk_path(key, ext)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)  # mtime doubles as last-use time for disk eviction
+    except OSError:
+        return None
+    with _lock:
+        _remember_memory_locked(key, data)
+    logging.debug(f"composite_cache: Disk hit {key}")
+    return data
+
+
+def put(key, ext, data):
+    """Store composite bytes in memory; the disk tier is written by a background thread, off the render path."""
+    global _disk_thread
+    with _lock:
+        _remember_memory_locked(key, data)
+        if _disk_thread is None:
+            _disk_thread = threading.Thread(target=_disk_writer_loop, name='composite-cache-writer', daemon=True)
+            _disk_thread.start()
+        if key in _disk_pending:
+            return
+        try:
+            _disk_queue.put_nowait((key, ext, data))
+            _disk_pending[key] = data
+        except queue.Full:
+            logging.debug(f"composite_cache: Disk writer busy, {key} kept in memory only.")
+
+
+def flush(key, ext):
+    """
+    Write a composite to the disk tier now if it is only in memory or queued, for a URL that
+    another worker process (which has none of this one's memory tier) will serve.
+    Returns True once the file exists.
+    """
+    path = _disk_path(key, ext)
+    if os.path.exists(path):
+        return True
+    with _lock:
+        data = _memory.get(key) or _disk_pending.get(key)
+    if data is None:
+        return False
+    _write_disk(key, ext, data)
+    return os.path.exists(path)
+
+
+def _disk_writer_loop():
+    while True:
+        key, ext, data = _disk_queue.get()
+        try:
+            _write_disk(key, ext, data)
+        except Exception as e:
+            logging.error(f"composite_cache: Disk write of {key} failed: {e}", exc_info=True)
+        finally:
+            with _lock:
+                _disk_pending.pop(key, None)
+
+
+def _write_disk(key, ext, data):
+    """Write composite bytes to the disk tier (if not already there) and trim it when over its cap."""
+    global _disk_bytes
+    path = _disk_path(key, ext)
+    if os.path.exists(path):
+        return
+    temp_path = f"{path}.{threading.get_ident()}.tmp"  # flush() and the writer thread may race on one key
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logging.warning(f"composite_cache: Could not write {path}: {e}")
+        try: os.remove(temp_path)
+        except OSError: pass
+        return
+    with _lock:
+        if _disk_bytes is not None:
+            _disk_bytes += len(data)
+        over_budget = _disk_bytes is None or _disk_bytes > config.COMPOSITE_CACHE_DISK_MAX_BYTES
+    if over_budget:
+        trim_disk()
+
+
+def trim_disk():
+    """Delete least-recently-used composite files until the disk tier is under its cap."""
+    global _disk_bytes
+    with _lock:
+        try:
+            entries = _composite_files()
+        except OSError as e:
+            logging.error(f"composite_cache: Could not scan {config.GENERATED_MAPS_FOLDER}: {e}")
+            return
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        if total > config.COMPOSITE_CACHE_DISK_MAX_BYTES:
+            # Trim to 90% so a steady stream of new composites doesn't rescan on every write
+            target = config.COMPOSITE_CACHE_DISK_MAX_BYTES * 9 // 10
+            for path, size, _ in sorted(entries, key=lambda e: e[2]):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path); total -= size; removed += 1
+                except OSError as e:
+                    logging.warning(f"composite_cache: Could not remove {path}: {e}")
+        _disk_bytes = total
+    if removed:
+        logging.info(f"composite_cache: Trimmed {removed} file(s); disk tier now {total} bytes.")
+
+
+def read_file(filename):
+    """Return composite bytes for a /generated_maps/ filename, or None."""
+    key, ext = key_from_filename(filename)
+    if key is None:
+        return None
+    return get(key, ext)
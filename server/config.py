@@ -36,9 +36,71 @@ if IS_PROD:
 ALLOWED_MAP_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
 DEFAULT_HELP_MAP_FILENAME = "Help.png"
 SAVES_DB_PATH = os.path.join(APP_ROOT, 'saves.db')
+SAVES_DB_CACHE_KB = 8192  # SQLite page cache per pooled connection
+SAVES_DB_POOL_SIZE = 4    # most SQLite connections open at once, shared by all request threads
+SAVE_HISTORY_KEYFRAME_INTERVAL = 64  # save revisions are patches against the previous one, with a full keyframe this often
+SAVE_HISTORY_MAX_REVISIONS = 5000    # oldest revisions beyond this are pruned per save (0 = keep all)
+SAVE_HISTORY_COMPRESS_LEVEL = 6      # zlib level for stored revisions
+MAP_CONFIG_CACHE_MAX_ENTRIES = 32    # normalized map configs kept in memory (LRU), revalidated against file mtime/size
 SAVES_FOLDER_LEGACY = os.path.join(APP_ROOT, 'saves')  # for migration only
 ROOM_NAME = "game"
 
+# --- Rendering ---
+BASE_IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024  # decoded base maps kept in memory (LRU)
+FOG_FRAME_CACHE_MAX_ENTRIES = 4                 # composited frames kept per map for renders outside a session (sessions keep their own)
+MAP_IMAGE_TRANSPORT = 'binary'                  # 'binary' (Socket.IO attachments) or 'base64' (force legacy for everyone)
+MAP_TILED_DELIVERY = False                      # after fog edits, send only changed tiles instead of the whole image
+MAP_TILE_SIZE = 512                             # tile edge in pixels (multiple of 16 keeps JPEG blocks aligned)
+MAP_TILE_MAX_PATCH_FRACTION = 0.5               # above this share of changed tiles, send a full image instead
+COMPOSITE_CACHE_PREFIX = 'composite_'           # content-addressed composites in GENERATED_MAPS_FOLDER (kept across restarts)
+COMPOSITE_CACHE_MEMORY_MAX_BYTES = 64 * 1024 * 1024
+COMPOSITE_CACHE_DISK_MAX_BYTES = 512 * 1024 * 1024
+COMPOSITE_HTTP_DELIVERY = True                  # joining players fetch the composite by URL (browser/tunnel cacheable)
+RENDER_IN_BACKGROUND = True                     # render fog updates on a worker thread (latest state wins) instead of in the handler
+RENDER_ENGINE = 'serial'                        # 'serial' or 'process' (full redraws rasterized in parallel bands by a process pool)
+RENDER_POOL_SIZE = max(1, (os.cpu_count() or 2) - 1)
+RENDER_POOL_MIN_PIXELS = 16_000_000             # maps smaller than this always use the serial path
+FOG_RASTER_NUMPY = True                         # vectorized fog vertex conversion (numpy ships with the app; False forces the scalar fallback)
+FOG_NORMALIZE = True                            # lossless cleanup of stored fog, simplified/merged copy for rendering (see fog_normalize.py)
+FOG_SIMPLIFY_TOLERANCE_PX = 0.5                 # max deviation of a simplified freehand polygon, in map pixels
+FOG_OCCLUSION_MARGIN_PX = 2.0                   # a polygon is left out of the render copy only if a later one covers it by this margin
+FOG_NORMALIZE_MAX_POLYGONS = 2000               # above this, skip the occlusion/merge passes (quadratic worst case)
+FOG_PACK = True                                 # keep fog vertices packed in session state, configs and saves (see fog_codec.py); legacy JSON is always read
+FOG_PACK_COMPRESS_LEVEL = 6                     # zlib level for packed fog vertices
+FOG_DECODE_MEMO_MAX_ENTRIES = 8192              # decoded packed polygons kept for rendering (LRU, keyed by packed blob)
+PLAYER_RESOLUTION_BUCKETS = (1280, 1920, 2560)  # long-edge sizes offered to clients; bigger screens get the full map
+MAP_ENCODER = 'jpeg'                            # 'jpeg', 'webp', 'webp_lossless', 'png8', or 'auto' (benchmark per map)
+MAP_ENCODER_QUALITY = 85                        # 1-100; for webp_lossless this is compression effort, not fidelity
+MAP_ENCODER_EFFORT = 4                          # 0-6; higher = smaller files, slower encodes
+MAP_ENCODER_AUTO_CANDIDATES = ('jpeg', 'webp', 'webp_lossless', 'png8')
+MAP_ENCODER_AUTO_MAX_MS = 500                   # auto mode ignores encoders estimated slower than this per full frame
+MAP_ENCODER_AUTO_SAMPLE_PIXELS = 1_000_000      # auto mode benchmarks a centre crop of at most this many pixels
+
+# --- Realtime sync ---
+TOKEN_BROADCAST_HZ = 25                         # token changes are batched and broadcast this many times a second (0 = every change immediately)
+
+# --- Persistence (see journal.py) ---
+JOURNAL_ENABLED = True                          # journal live state and map configs instead of rewriting files on every change
+JOURNAL_PATH = os.path.join(APP_ROOT, 'state.journal')
+JOURNAL_FLUSH_INTERVAL = 0.5                    # seconds between batched appends (one fsync each); a crash loses at most this much
+JOURNAL_COMPACT_INTERVAL = 300                  # seconds between compactions into config files and saves
+JOURNAL_COMPACT_BYTES = 8 * 1024 * 1024         # compact early once the journal grows past this
+
+# --- Headless server (worker.py; command-line flags override these) ---
+SERVER_THREADS = 64                             # request threads; each open WebSocket holds one
+SERVER_MAX_CONNECTIONS = 1000                   # simultaneous client connections accepted
+SERVER_GRACEFUL_TIMEOUT = 10                    # seconds open requests get to finish on shutdown
+SOCKETIO_PING_INTERVAL = 25                     # seconds between Socket.IO pings
+SOCKETIO_PING_TIMEOUT = 20                      # seconds without a pong before a client is dropped
+SOCKETIO_MAX_MESSAGE_BYTES = 1_000_000          # largest Socket.IO message accepted from a client (GM fog lists are the big ones)
+
+# --- Worker fan-out (see message_bus.py) ---
+WORKER_ROLE = 'authoritative'                   # 'authoritative' (GM, state, rendering, tokens) or 'fanout' (player sockets only)
+MESSAGE_QUEUE = None                            # bus shared by all workers, e.g. 'sqlite:///bus.db'; None = single process
+MESSAGE_BUS_CHANNEL = 'dynamic-map-renderer'
+MESSAGE_BUS_POLL_INTERVAL = 0.01                # seconds a worker waits before checking an idle bus again
+MESSAGE_BUS_RETENTION_SECONDS = 60              # delivered messages older than this are pruned from the bus
+
 # --- Ensure directories exist ---
 os.makedirs(MAPS_FOLDER, exist_ok=True)
 os.makedirs(CONFIGS_FOLDER, exist_ok=True)
@@ -50,11 +112,12 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %
 
 
 def cleanup_generated_maps():
-    """Removes old PNG files from the generated maps folder."""
+    """Removes old PNG files from the generated maps folder. Content-addressed composites are kept."""
     logging.info(f"Cleaning up generated maps in: {GENERATED_MAPS_FOLDER}")
     count = 0
     try:
         for filename in os.listdir(GENERATED_MAPS_FOLDER):
+            if filename.startswith(COMPOSITE_CACHE_PREFIX): continue
             if filename.lower().endswith('.png'):
                 filepath = os.path.join(GENERATED_MAPS_FOLDER, filename)
                 try:
@@ -0,0 +1,128 @@
+# server/encoders.py
+# Player map image encoders (JPEG, WebP lossy/lossless, palettized PNG) and per-map auto selection
+
+import time
+import logging
+import threading
+from collections import namedtuple
+from io import BytesIO
+
+from PIL import Image
+
+from server import config
+
+# quality: 1-100 (ignored by png8). effort: 0-6, higher = smaller output but slower encode.
+Encoder = namedtuple('Encoder', 'name ext mime quality effort')
+
+_FORMATS = {
+    'jpeg': ('jpg', 'image/jpeg'),
+    'webp': ('webp', 'image/webp'),
+    'webp_lossless': ('webp', 'image/webp'),
+    'png8': ('png', 'image/png'),
+}
+AUTO = 'auto'
+
+_auto_choices = {}         # map file digest -> Encoder picked by the benchmark
+_auto_lock = threading.Lock()
+
+
+def make_encoder(name, quality=None, effort=None):
+    """Build an Encoder for one of the supported formats, filling in configured quality/effort."""
+    if name not in _FORMATS:
+        raise ValueError(f"Unknown map encoder '{name}' (expected one of {', '.join(_FORMATS)} or '{AUTO}')")
+    ext, mime = _FORMATS[name]
+    quality = config.MAP_ENCODER_QUALITY if quality is None else quality
+    effort = config.MAP_ENCODER_EFFORT if effort is None else effort
+    return Encoder(name, ext, mime, max(1, min(int(quality), 100)), max(0, min(int(effort), 6)))
+
+
+def settings(encoder):
+    """Tuple identifying everything that affects encoded output — part of composite cache keys."""
+    return (encoder.name, encoder.quality, encoder.effort)
+
+
+def mime_for_ext(ext):
+    """MIME type of an encoder file extension, or None."""
+    for fmt_ext, mime in _FORMATS.values():
+        if fmt_ext == ext:
+            return mime
+    return None
+
+
+def encode(image, encoder):
+    """Encode an RGB image with the given Encoder and return the bytes."""
+    buf = BytesIO()
+    if encoder.name == 'jpeg':
+        image.save(buf, format='JPEG', quality=encoder.quality, optimize=encoder.effort >= 4)
+    elif encoder.name == 'webp':
+        image.save(buf, format='WEBP', quality=encoder.quality, method=encoder.effort)
+    elif encoder.name == 'webp_lossless':
+        # For lossless WebP, quality trades encode time for size rather than fidelity
+        image.save(buf, format='WEBP', lossless=True, quality=encoder.quality, method=encoder.effort)
+    elif encoder.name == 'png8':
+        palettized = image.quantize(colors=256, method=Image.FASTOCTREE, dither=Image.NONE)
+        palettized.save(buf, format='PNG', optimize=encoder.effort >= 5, compress_level=min(9, 3 + encoder.effort))
+    else:
+        raise ValueError(f"Unknown map encoder '{encoder.name}'")
+    return buf.getvalue()
+
+
+def _sample(image):
+    """Centre crop of at most MAP_ENCODER_AUTO_SAMPLE_PIXELS, so benchmarking a huge map stays cheap."""
+    width, height = image.size
+    limit = config.MAP_ENCODER_AUTO_SAMPLE_PIXELS
+    if width * height <= limit:
+        return image
+    scale = (limit / (width * height)) ** 0.5
+    w, h = max(16, int(width * scale)), max(16, int(height * scale))
+    left, top = (width - w) // 2, (height - h) // 2
+    return image.crop((left, top, left + w, top + h))
+
+
+def benchmark(image):
+    """
+    Encode a sample of image with every candidate encoder.
+    Returns [(encoder, estimated_bytes, estimated_ms)] extrapolated to the full image size.
+    """
+    sample = _sample(image)
+    scale = (image.width * image.height) / (sample.width * sample.height)
+    results = []
+    for name in config.MAP_ENCODER_AUTO_CANDIDATES:
+        encoder = make_encoder(name)
+        started = time.perf_counter()
+        try:
+            data = encode(sample, encoder)
+        except Exception as e:
+            # e.g. Pillow built without WebP support
+            logging.warning(f"encoders: Skipping '{name}' in auto benchmark: {e}")
+            continue
+        elapsed_ms = (time.perf_counter() - started) * 1000 * scale
+        results.append((encoder, int(len(data) * scale), elapsed_ms))
+    return results
+
+
+def choose_auto(map_digest, image):
+    """Pick (once per map file) the smallest encoder whose estimated encode time fits the latency budget."""
+    with _auto_lock:
+        encoder = _auto_choices.get(map_digest)
+    if encoder is not None:
+        return encoder
+    results = benchmark(image)
+    in_budget = [r for r in results if r[2] <= config.MAP_ENCODER_AUTO_MAX_MS]
+    if in_budget:
+        encoder = min(in_budget, key=lambda r: r[1])[0]
+    elif results:
+        encoder = min(results, key=lambda r: r[2])[0]  # nothing fits the budget — fastest wins
+    else:
+        encoder = make_encoder('jpeg')
+    summary = ', '.join(f"{e.name}={size}B/{ms:.0f}ms" for e, size, ms in results)
+    logging.info(f"encoders: Auto-selected '{encoder.name}' for map {map_digest[:12]} ({summary}).")
+    with _auto_lock:
+        _auto_choices[map_digest] = encoder
+    return encoder
+
+
+def get_auto_choice(map_digest):
+    """Encoder previously chosen for a map by the auto benchmark, or None."""
+    with _auto_lock:
+        return _auto_choices.get(map_digest)
@@ -35,3 +35,40 @@ def load_available_filters():
             filter_id = item; filter_data = load_single_filter(filter_id)
             if filter_data: loaded_filters[filter_id] = filter_data; logging.info(f"  - Loaded: {filter_data['name']} ({filter_id})")
     available_filters = loaded_filters; logging.info(f"Total filters loaded: {len(available_filters)}")
+
+
+# --- Parameters ---
+# A state's filter_params holds only overrides: {filter_id: {param: value}} for values that differ from the
+# filter's config.json default. Readers (the GM and player clients) resolve everything else from the
+# definitions /api/filters serves, so states stay the same size however many filters are installed.
+
+def default_params(filter_id):
+    """{param: default value} from a filter's config.json ({} for a filter that isn't installed)."""
+    params = (available_filters.get(filter_id) or {}).get('params', {})
+    return {key: param['value'] for key, param in params.items() if isinstance(param, dict) and 'value' in param}
+
+
+def sparse_params(filter_params):
+    """
+    The overrides in filter_params: values equal to their filter's default are dropped (and text
+    params, which never belong in a state), then filters left with none. New dicts throughout.
+    """
+    if not isinstance(filter_params, dict):
+        return {}
+    text_params = ('backgroundImageFilename', 'defaultFontFamily', 'defaultTextSpeed', 'fontSize')
+    sparse = {}
+    for filter_id, params in filter_params.items():
+        if not isinstance(params, dict):
+            continue
+        defaults = default_params(filter_id)
+        overrides = {k: v for k, v in params.items() if k not in text_params and (k not in defaults or v != defaults[k])}
+        if overrides:
+            sparse[filter_id] = overrides
+    return sparse
+
+
+def sparse_state(state_data):
+    """A shallow copy of a state/config dict with sparse filter_params (unchanged if it has none)."""
+    if not isinstance(state_data, dict) or 'filter_params' not in state_data:
+        return state_data
+    return dict(state_data, filter_params=sparse_params(state_data['filter_params']))
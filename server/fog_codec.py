@@ -0,0 +1,159 @@
+# server/fog_codec.py
+# Compact fog geometry — quantized, delta-encoded int32 vertex arrays, zlib-compressed
+
+import sys
+import zlib
+import base64
+import binascii
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+
+from server import config
+
+# A packed polygon carries its vertices as 'packed_vertices' instead of 'vertices': int32 values
+# x0, y0, dx1, dy1, ... (little-endian) in 1/QUANT_SCALE units of the map, zlib-compressed. They are
+# bytes on the wire (Socket.IO sends them as binary attachments) and base64 text everywhere the
+# server keeps fog: session state, the journal, JSON files and the saves table. Every other key of
+# the polygon is kept as is. Readers decode through unpack_polygon(), memoized per packed blob, so
+# a polygon that didn't change between fog revisions is decoded once, not once per frame.
+# QUANT_SCALE is a power of two, so a quantized coordinate survives a round trip exactly: packing
+# an unpacked polygon again gives the same bytes, and stored copies compare equal.
+QUANT_SCALE = 1 << 16
+PACKED_KEY = 'packed_vertices'
+_MAX_COORDINATE = 1 << 14     # |x|, |y| bound (in map widths) that keeps every delta within int32
+_SWAP = sys.byteorder == 'big'
+
+_decode_memo = OrderedDict()     # packed blob -> decoded vertices (shared, never mutated), or None if corrupt
+_decode_lock = threading.Lock()
+
+
+def pack_vertices(vertices):
+    """zlib-compressed delta array for [{'x', 'y'}] vertices, or None if a coordinate isn't a finite, in-range number."""
+    if not isinstance(vertices, list):
+        return None
+    values = array('i')
+    previous_x = previous_y = 0
+    try:
+        for vertex in vertices:
+            x = round(float(vertex['x']) * QUANT_SCALE); y = round(float(vertex['y']) * QUANT_SCALE)
+            if abs(x) > _MAX_COORDINATE * QUANT_SCALE or abs(y) > _MAX_COORDINATE * QUANT_SCALE:
+                return None
+            values.append(x - previous_x); values.append(y - previous_y)
+            previous_x = x; previous_y = y
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None
+    if _SWAP:
+        values.byteswap()
+    return zlib.compress(values.tobytes(), config.FOG_PACK_COMPRESS_LEVEL)
+
+
+def unpack_vertices(data):
+    """[{'x', 'y'}] vertices from pack_vertices() output (bytes, or its base64 text). Raises ValueError if corrupt."""
+    try:
+        if isinstance(data, str):
+            data = base64.b64decode(data, validate=True)
+        raw = zlib.decompress(data)
+    except (binascii.Error, zlib.error, TypeError) as e:
+        raise ValueError(f"Undecodable packed vertices: {e}")
+    if len(raw) % 8:
+        raise ValueError("Packed vertices are not a whole number of (x, y) pairs.")
+    values = array('i')
+    values.frombytes(raw)
+    if _SWAP:
+        values.byteswap()
+    vertices = []
+    x = y = 0
+    for i in range(0, len(values), 2):
+        x += values[i]; y += values[i + 1]
+        vertices.append({'x': x / QUANT_SCALE, 'y': y / QUANT_SCALE})
+    return vertices
+
+
+def pack_polygon(polygon, binary=False):
+    """polygon with its vertices packed (bytes if binary, else base64 text); unchanged if they can't be."""
+    if not isinstance(polygon, dict) or 'vertices' not in polygon:
+        return polygon
+    data = pack_vertices(polygon['vertices'])
+    if data is None:
+        return polygon
+    packed = {k: v for k, v in polygon.items() if k != 'vertices'}
+    packed[PACKED_KEY] = data if binary else base64.b64encode(data).decode('ascii')
+    return packed
+
+
+def _decoded(data):
+    """unpack_vertices(data) through the decode memo; None if data is corrupt. The list is shared — don't mutate it."""
+    if not isinstance(data, (str, bytes)):
+        data = bytes(data) if isinstance(data, (bytearray, memoryview)) else None
+    if data is None:
+        return None
+    with _decode_lock:
+        if data in _decode_memo:
+            _decode_memo.move_to_end(data)
+            return _decode_memo[data]
+    try:
+        vertices = unpack_vertices(data)
+    except ValueError as e:
+        logging.warning(f"fog_codec: Dropping undecodable packed vertices: {e}")
+        vertices = None
+    with _decode_lock:
+        _decode_memo[data] = vertices
+        while len(_decode_memo) > config.FOG_DECODE_MEMO_MAX_ENTRIES:
+            _decode_memo.popitem(last=False)
+    return vertices
+
+
+def unpack_polygon(polygon):
+    """polygon with plain vertices; legacy polygons pass through. A corrupt one comes back with no vertices, which renders as nothing."""
+    if not isinstance(polygon, dict) or PACKED_KEY not in polygon:
+        return polygon
+    unpacked = {k: v for k, v in polygon.items() if k != PACKED_KEY}
+    unpacked['vertices'] = _decoded(polygon[PACKED_KEY]) or []
+    return unpacked
+
+
+def store_polygon(polygon):
+    """polygon in the form the server keeps it: base64-packed (plain vertices when FOG_PACK is off)."""
+    if not config.FOG_PACK:
+        return unpack_polygon(polygon)
+    if isinstance(polygon, dict) and isinstance(polygon.get(PACKED_KEY), (bytes, bytearray, memoryview)):
+        return dict(polygon, **{PACKED_KEY: base64.b64encode(polygon[PACKED_KEY]).decode('ascii')})
+    return pack_polygon(polygon)
+
+
+def _map_polygons(fog_of_war, convert):
+    if not isinstance(fog_of_war, dict) or not isinstance(fog_of_war.get('hidden_polygons'), list):
+        return fog_of_war
+    return dict(fog_of_war, hidden_polygons=[convert(p) for p in fog_of_war['hidden_polygons']])
+
+
+def pack_fog(fog_of_war):
+    """fog_of_war with every polygon in stored form (see store_polygon); returned as is when nothing changes."""
+    if not isinstance(fog_of_war, dict) or not isinstance(fog_of_war.get('hidden_polygons'), list):
+        return fog_of_war
+    polygons = fog_of_war['hidden_polygons']
+    stored = [store_polygon(p) for p in polygons]
+    if all(a is b for a, b in zip(stored, polygons)):
+        return fog_of_war  # already stored form: keep the list, so per-list memos (fog_normalize.render_polygons) still hit
+    return dict(fog_of_war, hidden_polygons=stored)
+
+
+def unpack_fog(fog_of_war):
+    return _map_polygons(fog_of_war, unpack_polygon)
+
+
+def pack_state(state_data):
+    """A state/config dict (or GM update) with its fog in stored form — a shallow copy if anything changes, nothing else is copied."""
+    if not isinstance(state_data, dict) or 'fog_of_war' not in state_data:
+        return state_data
+    fog_of_war = pack_fog(state_data['fog_of_war'])
+    return state_data if fog_of_war is state_data['fog_of_war'] else dict(state_data, fog_of_war=fog_of_war)
+
+
+def unpack_state(state_data):
+    """A state/config dict with plain fog vertices, for the GM — stored, wire and legacy forms all accepted."""
+    if not isinstance(state_data, dict) or 'fog_of_war' not in state_data:
+        return state_data
+    return dict(state_data, fog_of_war=unpack_fog(state_data['fog_of_war']))
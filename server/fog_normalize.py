@@ -0,0 +1,510 @@
+# server/fog_normalize.py
+# Fog normalization — lossless cleanup of the stored fog list, plus a simplified/merged render-side copy
+
+import os
+import math
+import logging
+import threading
+from collections import OrderedDict
+
+from server import config
+from server import fog_codec
+from server.fog_raster import HEX_COLOR_RE
+from server.image_cache import get_image_size
+
+try:
+    import numpy as np
+except ImportError:  # optional — pure-Python fallbacks below
+    np = None
+
+try:
+    import shapely
+    from shapely import STRtree
+    from shapely.geometry import MultiPoint, Polygon as ShapelyPolygon
+    from shapely.ops import unary_union
+except ImportError:  # in requirements.txt; without it, overlaps aren't merged and only convex occluders are detected
+    ShapelyPolygon = None
+
+_simplify_memo = OrderedDict()   # (vertex tuple, size, tolerance) -> kept vertex indices
+_simplify_lock = threading.Lock()
+_SIMPLIFY_MEMO_MAX = 4096
+_render_memo = OrderedDict()     # id(fog list) -> (fog list, size, render copy); holding the list keeps its id from being reused
+_RENDER_MEMO_MAX = 8
+_item_memo = OrderedDict()       # id(stored polygon) -> (polygon, size, tolerance, _Item or the stats key it was dropped under)
+_ITEM_MEMO_MAX = 8192
+_union_memo = OrderedDict()      # member _Item ids -> (members, size, tolerance, union _Item or None)
+_UNION_MEMO_MAX = 256
+_COLLINEAR_EPSILON = 1e-12       # |cross product| in normalized units² below which three vertices count as collinear
+
+
+def _parse(polygon):
+    """Return [(x, y)] normalized floats for a polygon the renderer would draw, else None."""
+    if not isinstance(polygon, dict):
+        return None
+    vertices = polygon.get('vertices')
+    if not isinstance(vertices, list) or len(vertices) < 3:
+        return None
+    points = []
+    for vertex in vertices:
+        if not isinstance(vertex, dict) or 'x' not in vertex or 'y' not in vertex:
+            return None
+        try:
+            x = float(vertex['x']); y = float(vertex['y'])
+        except (ValueError, TypeError):
+            return None
+        if not (math.isfinite(x) and math.isfinite(y)):
+            return None
+        points.append((x, y))
+    return points
+
+
+def _off_map(points):
+    xs = [p[0] for p in points]; ys = [p[1] for p in points]
+    return max(xs) < 0 or min(xs) > 1 or max(ys) < 0 or min(ys) > 1
+
+
+def _segment_distance(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length_sq))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def _farthest(points, start, end, xy=None):
+    """(index, distance) of the point in points[start+1..end-1] farthest from segment start-end."""
+    a, b = points[start], points[end % len(points)]
+    if xy is not None and end - start > 8:
+        xy = xy[start + 1:end]
+        dx, dy = b[0] - a[0], b[1] - a[1]
+        length_sq = dx * dx + dy * dy
+        if length_sq == 0:
+            d = np.hypot(xy[:, 0] - a[0], xy[:, 1] - a[1])
+        else:
+            t = np.clip(((xy[:, 0] - a[0]) * dx + (xy[:, 1] - a[1]) * dy) / length_sq, 0.0, 1.0)
+            d = np.hypot(xy[:, 0] - a[0] - t * dx, xy[:, 1] - a[1] - t * dy)
+        i = int(np.argmax(d))
+        return start + 1 + i, float(d[i])
+    index, distance = start, -1.0
+    for i in range(start + 1, end):
+        d = _segment_distance(points[i], a, b)
+        if d > distance:
+            index, distance = i, d
+    return index, distance
+
+
+def _rdp_indices(points, first, last, tolerance, keep, xy=None):
+    """Iterative Ramer-Douglas-Peucker over points[first..last]; adds kept indices to keep."""
+    stack = [(first, last)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        index, distance = _farthest(points, start, end, xy)
+        if distance > tolerance:
+            keep.add(index)
+            stack.append((start, index)); stack.append((index, end))
+
+
+def simplify_ring(pixel_points, tolerance):
+    """Indices of a closed ring's vertices to keep so no dropped vertex is further than tolerance from the result."""
+    n = len(pixel_points)
+    if ShapelyPolygon is not None:
+        # GEOS Douglas-Peucker on the closed ring; it only ever keeps input coordinates
+        ring = shapely.linestrings(np.asarray(pixel_points + [pixel_points[0]], dtype=np.float64))
+        simplified = shapely.get_coordinates(shapely.simplify(ring, tolerance, preserve_topology=False)).tolist()
+        index_of = {}
+        for i, point in enumerate(pixel_points):
+            index_of.setdefault(point, i)
+        return sorted({index_of[point] for point in map(tuple, simplified) if point in index_of})
+    origin = pixel_points[0]
+    far = max(range(n), key=lambda i: (pixel_points[i][0] - origin[0]) ** 2 + (pixel_points[i][1] - origin[1]) ** 2)
+    keep = {0, far}
+    xy = np.asarray(pixel_points, dtype=np.float64) if np is not None else None
+    _rdp_indices(pixel_points, 0, far, tolerance, keep, xy)
+    _rdp_indices(pixel_points, far, n, tolerance, keep, xy)  # index n wraps back to vertex 0
+    return sorted(keep)
+
+
+def _simplified_indices(points, size, tolerance):
+    key = (tuple(points), size, tolerance)
+    with _simplify_lock:
+        kept = _simplify_memo.get(key)
+        if kept is not None:
+            _simplify_memo.move_to_end(key)
+            return kept
+    kept = simplify_ring([(x * size[0], y * size[1]) for x, y in points], tolerance)
+    with _simplify_lock:
+        _simplify_memo[key] = kept
+        while len(_simplify_memo) > _SIMPLIFY_MEMO_MAX:
+            _simplify_memo.popitem(last=False)
+    return kept
+
+
+def _is_convex(points):
+    sign = 0
+    n = len(points)
+    for i in range(n):
+        (x0, y0), (x1, y1), (x2, y2) = points[i], points[(i + 1) % n], points[(i + 2) % n]
+        cross = (x1 - x0) * (y2 - y1) - (y1 - y0) * (x2 - x1)
+        if cross:
+            if sign and (cross > 0) != (sign > 0):
+                return False
+            sign = cross
+    return sign != 0
+
+
+def _inside_convex(point, ring, margin):
+    """True when point lies inside the convex ring at least margin away from every edge."""
+    n = len(ring)
+    orientation = 0
+    for i in range(n):
+        (x0, y0), (x1, y1), (x2, y2) = ring[i], ring[(i + 1) % n], ring[(i + 2) % n]
+        orientation = (x1 - x0) * (y2 - y1) - (y1 - y0) * (x2 - x1)
+        if orientation:
+            break
+    for i in range(n):
+        (ax, ay), (bx, by) = ring[i], ring[(i + 1) % n]
+        length = math.hypot(bx - ax, by - ay)
+        if length == 0:
+            continue
+        cross = (bx - ax) * (point[1] - ay) - (by - ay) * (point[0] - ax)
+        if (cross if orientation > 0 else -cross) / length < margin:
+            return False
+    return True
+
+
+class _Item:
+    """One polygon on its way through normalization (pixel-space geometry + original dict)."""
+    __slots__ = ('polygon', 'points', 'pixels', 'color', 'bbox', 'freehand', 'convex', '_shape', '_shrunk')
+
+    def __init__(self, polygon, points, size, color):
+        self.polygon = polygon; self.points = points; self.color = color
+        self.pixels = [(x * size[0], y * size[1]) for x, y in points]
+        xs = [p[0] for p in self.pixels]; ys = [p[1] for p in self.pixels]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys))
+        self.freehand = not polygon.get('shapeType')
+        self.convex = None; self._shape = None; self._shrunk = None
+
+    def shape(self):
+        if self._shape is None:
+            self._shape = shapely.polygons(np.asarray(self.pixels, dtype=np.float64))
+        return self._shape
+
+    def covers(self, other, margin):
+        """True when self, drawn later, hides every pixel of other."""
+        if not (self.bbox[0] + margin <= other.bbox[0] and self.bbox[1] + margin <= other.bbox[1]
+                and other.bbox[2] <= self.bbox[2] - margin and other.bbox[3] <= self.bbox[3] - margin):
+            return False
+        if self.convex is None:
+            self.convex = _is_convex(self.pixels)
+        if self.convex:
+            return all(_inside_convex(p, self.pixels, margin) for p in other.pixels)
+        if ShapelyPolygon is None or not self.shape().is_valid:
+            return False
+        if self._shrunk is None:
+            self._shrunk = self.shape().buffer(-margin)
+        # The convex hull bounds what other paints, whatever its self-intersections
+        return self._shrunk.covers(MultiPoint(other.pixels).convex_hull)
+
+
+def _later_bbox_containers(items, margin):
+    """For each item, indices of later items whose bounding box contains its box with margin."""
+    if np is not None:
+        boxes = np.array([item.bbox for item in items], dtype=np.float64)
+        result = []
+        for i, (x0, y0, x1, y1) in enumerate(boxes):
+            later = boxes[i + 1:]
+            hits = np.flatnonzero((later[:, 0] + margin <= x0) & (later[:, 1] + margin <= y0)
+                                  & (later[:, 2] - margin >= x1) & (later[:, 3] - margin >= y1))
+            result.append((hits + i + 1).tolist())
+        return result
+    return [[j for j in range(i + 1, len(items)) if items[j].bbox[0] + margin <= item.bbox[0] and items[j].bbox[1] + margin <= item.bbox[1]
+             and items[j].bbox[2] - margin >= item.bbox[2] and items[j].bbox[3] - margin >= item.bbox[3]]
+            for i, item in enumerate(items)]
+
+
+def _drop_occluded(items, margin):
+    """
+    Remove items completely hidden by a polygon drawn after them. Hiding is transitive
+    (anything under a hidden polygon is also under whatever hides it), so every later
+    polygon is a valid occluder whether or not it survives itself.
+    """
+    containers = _later_bbox_containers(items, margin)
+    kept = [item for item, later in zip(items, containers) if not any(items[j].covers(item, margin) for j in later)]
+    return kept, len(items) - len(kept)
+
+
+def _union_item(members, size, tolerance):
+    """
+    One _Item drawing the union of overlapping members, or None when it can't be drawn as one polygon.
+    Memoized per member set: items are reused across fog revisions (see _item), so a fog op only
+    re-unions the component it touched.
+    """
+    key = tuple(id(m) for m in members)
+    with _simplify_lock:
+        entry = _union_memo.get(key)
+        if entry is not None and all(a is b for a, b in zip(entry[0], members)) and entry[1] == size and entry[2] == tolerance:
+            _union_memo.move_to_end(key)
+            return entry[3]
+    result = None
+    union = unary_union([m.shape() for m in members]).simplify(tolerance, preserve_topology=True)
+    ring = list(union.exterior.coords)[:-1] if union.geom_type == 'Polygon' and not union.interiors else []
+    if len(ring) >= 3:  # holes can't be drawn as one polygon — otherwise the originals are kept
+        first = members[0]
+        polygon = {k: v for k, v in first.polygon.items() if k != 'vertices'}
+        polygon['vertices'] = [{'x': round(x / size[0], 6), 'y': round(y / size[1], 6)} for x, y in ring]
+        # Render copies only: the union stands for every member, so fog-op hints on any of them repaint it
+        polygon['id'] = frozenset(m.polygon.get('id') for m in members)
+        result = _Item(polygon, [(v['x'], v['y']) for v in polygon['vertices']], size, first.color)
+    with _simplify_lock:
+        _union_memo[key] = (members, size, tolerance, result)
+        _union_memo.move_to_end(key)
+        while len(_union_memo) > _UNION_MEMO_MAX:
+            _union_memo.popitem(last=False)
+    return result
+
+
+def _merge_run(run, size, tolerance):
+    """Union overlapping simple freehand polygons within a run of same-colour polygons."""
+    candidates = [item for item in run if item.freehand and item.shape().is_valid]
+    if len(candidates) < 2:
+        return run, 0
+    # Connected components of overlapping candidates
+    parent = list(range(len(candidates)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]; i = parent[i]
+        return i
+    shapes = [item.shape() for item in candidates]
+    for i, j in zip(*STRtree(shapes).query(shapes, predicate='intersects').tolist()):
+        if i != j:
+            parent[find(j)] = find(i)
+    components = {}
+    for i, item in enumerate(candidates):
+        components.setdefault(find(i), []).append(item)
+
+    replaced = {}; merged = 0
+    for members in components.values():
+        if len(members) < 2:
+            continue
+        union = _union_item(members, size, tolerance)
+        if union is None:
+            continue
+        replaced[id(members[0])] = union
+        for other in members[1:]:
+            replaced[id(other)] = None
+        merged += len(members) - 1
+    result = []
+    for item in run:
+        new = replaced.get(id(item), item)
+        if new is not None:
+            result.append(new)
+    return result, merged
+
+
+def _between(a, b, c):
+    """True when b lies on segment a-c, so dropping it leaves the drawn ring unchanged."""
+    cross = (b[0] - a[0]) * (c[1] - b[1]) - (b[1] - a[1]) * (c[0] - b[0])
+    return abs(cross) <= _COLLINEAR_EPSILON and (b[0] - a[0]) * (c[0] - b[0]) + (b[1] - a[1]) * (c[1] - b[1]) > 0
+
+
+def _lossless_indices(points):
+    """Indices of a closed ring's vertices left after dropping repeated vertices and ones lying on a straight edge."""
+    kept = []
+    for i, point in enumerate(points):
+        if not kept or points[kept[-1]] != point:
+            kept.append(i)
+    if len(kept) > 1 and points[kept[-1]] == points[kept[0]]:
+        kept.pop()
+    changed = True
+    while changed and len(kept) > 3:
+        changed = False; result = []; n = len(kept)
+        for j in range(n):
+            previous = points[result[-1]] if result else points[kept[-1]]
+            if len(result) + n - j - 1 >= 3 and _between(previous, points[kept[j]], points[kept[(j + 1) % n]]):
+                changed = True
+                continue
+            result.append(kept[j])
+        kept = result
+    return kept
+
+
+def _new_stats(count):
+    return {'input': count, 'invalid': 0, 'off_map': 0, 'vertices_removed': 0, 'occluded': 0, 'merged': 0}
+
+
+def _clean(polygon, stats):
+    """
+    Lossless per-polygon cleanup of a polygon in stored form (see fog_codec.store_polygon). Returns it
+    (a new, repacked dict if vertices were dropped), or None if the renderer would skip it.
+    """
+    plain = fog_codec.unpack_polygon(polygon)
+    points = _parse(plain)
+    if points is None:
+        stats['invalid'] += 1
+        return None
+    if polygon.get('shapeType'):
+        return polygon  # shapes keep their vertices so the GM can still edit them
+    kept = _lossless_indices(points)
+    if len(kept) < 3:
+        stats['invalid'] += 1
+        return None
+    if len(kept) < len(points):
+        stats['vertices_removed'] += len(points) - len(kept)
+        vertices = plain['vertices']
+        polygon = fog_codec.store_polygon(dict(plain, vertices=[vertices[i] for i in kept]))
+    return polygon
+
+
+def normalize_polygon(polygon):
+    """
+    Per-polygon cleanup for fog operations: returns the polygon with repeated and collinear vertices
+    dropped, or None when the renderer would skip it. Ids and appearance never change.
+    """
+    return _clean(polygon, _new_stats(1))
+
+
+def normalize_polygons(hidden_polygons):
+    """
+    Return (cleaned hidden_polygons, stats) for a GM fog list: polygons the renderer would skip are
+    dropped and every other one goes through normalize_polygon. Nothing is merged or culled, so
+    the list keeps every id the GM holds and stays the authoritative, stored fog. Input dicts are never mutated.
+    """
+    stats = _new_stats(len(hidden_polygons))
+    result = []
+    for polygon in hidden_polygons:
+        polygon = _clean(polygon, stats)
+        if polygon is not None:
+            result.append(polygon)
+    stats['output'] = len(result)
+    return result, stats
+
+
+def normalize_fog_of_war(fog_of_war):
+    """
+    Normalize fog_of_war['hidden_polygons'] in place (the list is replaced, its dicts are not mutated).
+    Returns the stats dict, or None when normalization is disabled.
+    """
+    if not config.FOG_NORMALIZE or not isinstance(fog_of_war, dict) or not isinstance(fog_of_war.get('hidden_polygons'), list):
+        return None
+    fog_of_war['hidden_polygons'], stats = normalize_polygons(fog_of_war['hidden_polygons'])
+    if stats['output'] != stats['input'] or stats['vertices_removed']:
+        logging.info(f"fog_normalize: {stats['input']} -> {stats['output']} polygon(s) (invalid {stats['invalid']}), "
+                     f"{stats['vertices_removed']} repeated/collinear vertices dropped.")
+    return stats
+
+
+# --- Render-side copy ---
+
+def _prepare(polygon, size, tolerance, stats):
+    """Cull and simplify one polygon for drawing. Returns its _Item, or the stats key it is dropped under."""
+    points = _parse(polygon)
+    if points is None:
+        return 'invalid'
+    if _off_map(points):
+        return 'off_map'
+    color = polygon.get('color', '#000000')
+    if not isinstance(color, str) or not HEX_COLOR_RE.match(color):
+        color = '#000000'
+    if not polygon.get('shapeType') and tolerance > 0 and len(points) > 3:
+        kept = _simplified_indices(points, size, tolerance)
+        if 3 <= len(kept) < len(points):
+            stats['vertices_removed'] += len(points) - len(kept)
+            vertices = polygon['vertices']
+            polygon = dict(polygon, vertices=[vertices[i] for i in kept])
+            points = [points[i] for i in kept]
+    return _Item(polygon, points, size, color)
+
+
+def _item(polygon, size, tolerance, stats):
+    """
+    The render _Item for a stored polygon, or None when it draws nothing. Memoized per polygon dict:
+    fog revisions share every unchanged one (see fog_ops.apply_ops), so a fog op prepares only what it touched.
+    """
+    key = id(polygon)
+    with _simplify_lock:
+        entry = _item_memo.get(key)
+        if entry is not None and entry[0] is polygon and entry[1] == size and entry[2] == tolerance:
+            _item_memo.move_to_end(key)
+            result = entry[3]
+        else:
+            result = None
+    if result is None:
+        result = _prepare(fog_codec.unpack_polygon(polygon), size, tolerance, stats)
+        with _simplify_lock:
+            _item_memo[key] = (polygon, size, tolerance, result)
+            _item_memo.move_to_end(key)
+            while len(_item_memo) > _ITEM_MEMO_MAX:
+                _item_memo.popitem(last=False)
+    if isinstance(result, str):
+        stats[result] += 1
+        return None
+    return result
+
+
+def _render_copy(hidden_polygons, size):
+    stats = _new_stats(len(hidden_polygons))
+    tolerance = config.FOG_SIMPLIFY_TOLERANCE_PX
+    items = []
+    for polygon in hidden_polygons:
+        item = _item(polygon, size, tolerance, stats)
+        if item is not None:
+            items.append(item)
+    if len(items) <= config.FOG_NORMALIZE_MAX_POLYGONS:
+        items, stats['occluded'] = _drop_occluded(items, config.FOG_OCCLUSION_MARGIN_PX)
+        if ShapelyPolygon is not None:
+            merged_items = []; run = []
+            for item in items + [None]:
+                if run and (item is None or item.color != run[0].color):
+                    run, merged = _merge_run(run, size, tolerance)
+                    merged_items.extend(run); stats['merged'] += merged; run = []
+                if item is not None:
+                    run.append(item)
+            items = merged_items
+    stats['output'] = len(items)
+    logging.debug(f"fog_normalize: Render copy {stats['input']} -> {stats['output']} polygon(s) (off-map {stats['off_map']}, "
+                  f"occluded {stats['occluded']}, merged {stats['merged']}), {stats['vertices_removed']} vertices simplified away.")
+    return [item.polygon for item in items]
+
+
+def render_polygons(hidden_polygons, size):
+    """
+    The fog list the renderer draws for a stored one, at map pixel size: vertices decoded (see
+    fog_codec.unpack_polygon), off-map polygons dropped, freehand ones simplified within
+    FOG_SIMPLIFY_TOLERANCE_PX, polygons fully hidden by later ones dropped and (when shapely is
+    installed) overlapping same-colour freehand polygons unioned, their copy's id becoming the
+    frozenset of member ids. Never stored or sent anywhere, so nothing the GM holds is lost.
+    With FOG_NORMALIZE off only the decoding applies. Memoized per list object: every fog
+    revision is a new list (see fog_ops.apply_ops).
+    """
+    if not isinstance(hidden_polygons, list):
+        return hidden_polygons
+    key = id(hidden_polygons)
+    with _simplify_lock:
+        entry = _render_memo.get(key)
+        if entry is not None and entry[0] is hidden_polygons and entry[1] == size:
+            _render_memo.move_to_end(key)
+            return entry[2]
+    if config.FOG_NORMALIZE and size:
+        result = _render_copy(hidden_polygons, size)
+    else:
+        result = [fog_codec.unpack_polygon(p) for p in hidden_polygons]
+    with _simplify_lock:
+        _render_memo[key] = (hidden_polygons, size, result)
+        _render_memo.move_to_end(key)
+        while len(_render_memo) > _RENDER_MEMO_MAX:
+            _render_memo.popitem(last=False)
+    return result
+
+
+def map_size(full_map_path):
+    """Pixel size of the map at full_map_path, or None when it can't be read."""
+    if not full_map_path or not os.path.exists(full_map_path):
+        return None
+    try:
+        return get_image_size(full_map_path)
+    except Exception as e:
+        logging.warning(f"fog_normalize: Could not read map size of {full_map_path}: {e}")
+        return None
@@ -0,0 +1,94 @@
+# server/fog_ops.py
+# Operation-based fog edits keyed by stable polygon IDs (add / update / delete / reorder)
+
+import logging
+
+from server import config
+from server import fog_codec
+from server import fog_normalize
+
+OP_ADD = 'add'
+OP_UPDATE = 'update'
+OP_DELETE = 'delete'
+OP_REORDER = 'reorder'
+
+
+def _polygon_id(polygon):
+    polygon_id = polygon.get('id') if isinstance(polygon, dict) else None
+    return polygon_id if isinstance(polygon_id, str) and polygon_id else None
+
+
+def apply_ops(fog_of_war, ops):
+    """
+    Apply fog operations to fog_of_war and return (new_fog_of_war, changed_ids, reordered).
+        {'op': 'add',     'polygon': {...}, 'index': optional int}   (an existing id is replaced; vertices may be packed, see fog_codec)
+        {'op': 'update',  'polygon': {...}}                          (whole polygon, matched by id)
+        {'op': 'delete',  'id': str}
+        {'op': 'reorder', 'order': [id, ...]}                        (unlisted ids keep their relative order, after these)
+    Only the polygon list is copied (a list of references), never the polygons, so the previous
+    fog_of_war stays a valid snapshot for renders still in flight. Added/updated polygons go
+    through lossless per-polygon normalization; ones that come out invalid are deleted.
+    changed_ids holds every id whose polygon was added, replaced or removed.
+    """
+    fog_of_war = fog_of_war if isinstance(fog_of_war, dict) else {}
+    polygons = list(fog_of_war.get('hidden_polygons') or [])
+    index = {}
+    for i, polygon in enumerate(polygons):
+        polygon_id = _polygon_id(polygon)
+        if polygon_id is not None:
+            index[polygon_id] = i
+    changed = set(); reordered = False; removed = 0
+
+    for op in ops:
+        if not isinstance(op, dict):
+            continue
+        kind = op.get('op')
+        if kind in (OP_ADD, OP_UPDATE):
+            polygon = fog_codec.store_polygon(op.get('polygon'))
+            polygon_id = _polygon_id(polygon)
+            if polygon_id is None:
+                logging.warning(f"fog_ops: Ignoring '{kind}' without a polygon id.")
+                continue
+            if config.FOG_NORMALIZE:
+                polygon = fog_normalize.normalize_polygon(polygon)
+            changed.add(polygon_id)
+            position = index.get(polygon_id)
+            if polygon is None:
+                if position is not None:
+                    polygons[position] = None; del index[polygon_id]; removed += 1
+                continue
+            if position is not None:
+                polygons[position] = polygon
+                continue
+            insert_at = op.get('index')
+            if kind == OP_ADD and isinstance(insert_at, int) and 0 <= insert_at < len(polygons):
+                polygons.insert(insert_at, polygon)
+                index = {pid: (i if i < insert_at else i + 1) for pid, i in index.items()}
+                index[polygon_id] = insert_at
+            else:
+                index[polygon_id] = len(polygons)
+                polygons.append(polygon)
+        elif kind == OP_DELETE:
+            polygon_id = op.get('id')
+            position = index.pop(polygon_id, None) if isinstance(polygon_id, str) else None
+            if position is not None:
+                polygons[position] = None; removed += 1
+                changed.add(polygon_id)
+        elif kind == OP_REORDER:
+            order = op.get('order')
+            if not isinstance(order, list):
+                continue
+            listed = [index[pid] for pid in dict.fromkeys(order) if isinstance(pid, str) and pid in index]
+            listed_set = set(listed)
+            new_order = listed + [i for i, p in enumerate(polygons) if p is not None and i not in listed_set]
+            polygons = [polygons[i] for i in new_order]
+            index = {_polygon_id(p): i for i, p in enumerate(polygons) if _polygon_id(p) is not None}
+            reordered = True; removed = 0
+        else:
+            logging.warning(f"fog_ops: Unknown op '{kind}'.")
+
+    if removed:
+        polygons = [p for p in polygons if p is not None]
+    new_fog = dict(fog_of_war)
+    new_fog['hidden_polygons'] = polygons
+    return new_fog, changed, reordered
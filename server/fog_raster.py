@@ -0,0 +1,184 @@
+# server/fog_raster.py
+# Bulk fog polygon conversion (NumPy, optional) and single-paste fog rasterization
+
+import re
+import logging
+
+from PIL import Image, ImageColor, ImageDraw
+
+from server import config
+
+try:
+    import numpy as np
+except ImportError:  # numpy ships (requirements.txt, frozen build); the scalar path is only a fallback, also used when FOG_RASTER_NUMPY is off
+    np = None
+
+HEX_COLOR_RE = re.compile(r'^#[0-9a-fA-F]{3}(?:[0-9a-fA-F]{3})?$')
+
+# Label images are 8-bit, so at most 255 distinct fog colours go through the single-paste path
+_MAX_LABELS = 255
+_MASK_TABLE = [0] + [255] * 255
+
+
+def numpy_enabled():
+    """True when the vectorized conversion path is configured and numpy is importable."""
+    return np is not None and config.FOG_RASTER_NUMPY
+
+
+def _valid_color(color, cache):
+    if not isinstance(color, str):
+        return False
+    ok = cache.get(color)
+    if ok is None:
+        ok = cache[color] = bool(HEX_COLOR_RE.match(color))
+    return ok
+
+
+def polygons_scalar(fog_data, size, ids=None):
+    """Validate fog polygons and convert them to (pixel_vertices, color) tuples, in draw order."""
+    size_x, size_y = size
+    result = []
+    for polygon in fog_data:
+        if not isinstance(polygon, dict):
+            continue
+        vertices = polygon.get('vertices')
+        if not vertices or not isinstance(vertices, list) or len(vertices) < 3:
+            continue
+        absolute_vertices = []
+        valid_polygon = True
+        for vertex in vertices:
+            if isinstance(vertex, dict) and 'x' in vertex and 'y' in vertex:
+                try:
+                    x_coord = max(0, min(int(float(vertex['x']) * size_x), size_x - 1))
+                    y_coord = max(0, min(int(float(vertex['y']) * size_y), size_y - 1))
+                    absolute_vertices.append((x_coord, y_coord))
+                except (ValueError, TypeError, OverflowError):
+                    valid_polygon = False
+                    break
+            else:
+                valid_polygon = False
+                break
+        if not valid_polygon or len(absolute_vertices) < 3:
+            continue
+        color = polygon.get('color', '#000000')
+        if not isinstance(color, str) or not HEX_COLOR_RE.match(color):
+            color = '#000000'
+        result.append((tuple(absolute_vertices), color))
+        if ids is not None:
+            ids.append(polygon.get('id'))
+    return result
+
+
+def polygons_vectorized(fog_data, size, ids=None):
+    """
+    Same result as polygons_scalar, but every vertex of every polygon is scaled,
+    truncated and clamped in one NumPy pass. Falls back to the scalar path when
+    a coordinate isn't a plain number, so odd input is judged exactly as before.
+    """
+    size_x, size_y = size
+    xs = []; ys = []; spans = []  # spans: (start, count, color, id) per structurally valid polygon
+    color_cache = {}
+    for polygon in fog_data:
+        if not isinstance(polygon, dict):
+            continue
+        vertices = polygon.get('vertices')
+        if not vertices or not isinstance(vertices, list) or len(vertices) < 3:
+            continue
+        if not all(type(v) is dict and 'x' in v and 'y' in v for v in vertices):
+            continue
+        spans.append((len(xs), len(vertices), polygon.get('color', '#000000'), polygon.get('id')))
+        xs.extend(v['x'] for v in vertices)
+        ys.extend(v['y'] for v in vertices)
+    if not spans:
+        return []
+    try:
+        x_arr = np.array(xs, dtype=np.float64); y_arr = np.array(ys, dtype=np.float64)
+    except (ValueError, TypeError, OverflowError):
+        return polygons_scalar(fog_data, size, ids)
+    if x_arr.ndim != 1 or y_arr.ndim != 1:
+        return polygons_scalar(fog_data, size, ids)
+
+    x_scaled = x_arr * size_x; y_scaled = y_arr * size_y
+    finite = np.isfinite(x_scaled) & np.isfinite(y_scaled)
+    # int() truncates toward zero; clamp afterwards exactly like the scalar path
+    x_px = np.clip(np.trunc(np.where(finite, x_scaled, 0)), 0, size_x - 1).astype(np.int64).tolist()
+    y_px = np.clip(np.trunc(np.where(finite, y_scaled, 0)), 0, size_y - 1).astype(np.int64).tolist()
+    # A polygon is invalid if any of its vertices is non-finite
+    bad = np.flatnonzero(~finite)
+    bad_starts = set()
+    if bad.size:
+        starts = np.array([span[0] for span in spans])
+        bad_starts = set(starts[np.searchsorted(starts, bad, side='right') - 1].tolist())
+
+    result = []
+    for start, count, color, polygon_id in spans:
+        if start in bad_starts:
+            continue
+        if not _valid_color(color, color_cache):
+            color = '#000000'
+        end = start + count
+        result.append((tuple(zip(x_px[start:end], y_px[start:end])), color))
+        if ids is not None:
+            ids.append(polygon_id)
+    return result
+
+
+def absolute_polygons(fog_data, size, ids=None):
+    """
+    Validate fog polygons and convert them to (pixel_vertices, color) tuples, in draw order.
+    When ids is a list, the 'id' of each converted polygon is appended to it in the same order.
+    """
+    if numpy_enabled():
+        return polygons_vectorized(fog_data, size, ids)
+    return polygons_scalar(fog_data, size, ids)
+
+
+def _draw_each(image, polygons, offset):
+    draw = ImageDraw.Draw(image)
+    ox, oy = offset
+    for vertices, color in polygons:
+        try:
+            if ox or oy:
+                vertices = [(x - ox, y - oy) for x, y in vertices]
+            draw.polygon(vertices, fill=color)
+        except Exception as e:
+            logging.error(f"fog_raster: Error drawing polygon: {e}")
+
+
+def draw_polygons(image, polygons, offset=(0, 0)):
+    """
+    Draw (vertices, color) polygons onto image, translating by -offset.
+    Polygons are rasterized in order into an 8-bit label image holding a colour
+    index per pixel (last polygon wins, exactly like drawing them one by one);
+    the label image then supplies both the fog colours and the coverage mask
+    for a single paste onto image.
+    """
+    if not polygons:
+        return
+    colors = list(dict.fromkeys(color for _, color in polygons))
+    if len(colors) > _MAX_LABELS:
+        _draw_each(image, polygons, offset)
+        return
+    # Only the union bounding box of the polygons needs a label image
+    ox, oy = offset
+    left = max(0, min(min(x for x, _ in v) for v, _ in polygons) - ox)
+    top = max(0, min(min(y for _, y in v) for v, _ in polygons) - oy)
+    right = min(image.width, max(max(x for x, _ in v) for v, _ in polygons) - ox + 1)
+    bottom = min(image.height, max(max(y for _, y in v) for v, _ in polygons) - oy + 1)
+    if right <= left or bottom <= top:
+        return
+    labels = Image.new('L', (right - left, bottom - top), 0)
+    draw = ImageDraw.Draw(labels)
+    index = {color: i + 1 for i, color in enumerate(colors)}
+    dx, dy = ox + left, oy + top
+    for vertices, color in polygons:
+        try:
+            draw.polygon([(x - dx, y - dy) for x, y in vertices], fill=index[color])
+        except Exception as e:
+            logging.error(f"fog_raster: Error drawing polygon: {e}")
+    mask = labels.point(_MASK_TABLE)
+    palette = [0, 0, 0]
+    for color in colors:
+        palette.extend(ImageColor.getrgb(color)[:3])
+    labels.putpalette(palette)
+    image.paste(labels.convert(image.mode), (left, top), mask)
@@ -3,13 +3,16 @@
 
 import os
 import json
-import copy
 import logging
+import threading
+from collections import OrderedDict
 
 from werkzeug.utils import secure_filename
 
 from server import config
 from server import filters
+from server import journal
+from server import fog_codec
 
 
 def allowed_map_file(filename):
@@ -21,18 +24,58 @@ def get_map_config_path(map_filename):
     secured_base = secure_filename(map_filename); config_filename = f"{secured_base}_config.json"; return os.path.join(config.CONFIGS_FOLDER, config_filename)
 
 
+# Normalized configs as read from (or last written to) their files, revalidated against the file's mtime and size
+_config_cache = OrderedDict()   # secured map filename -> ((mtime_ns, size), config), least recently used first
+_config_cache_lock = threading.Lock()
+_config_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _file_signature(path):
+    try: st = os.stat(path); return (st.st_mtime_ns, st.st_size)
+    except OSError: return None
+
+
+def _cache_config(map_filename, signature, config_data):
+    """Remember a normalized config as the content of a config file with this signature."""
+    if signature is None or config.MAP_CONFIG_CACHE_MAX_ENTRIES <= 0: return
+    key = secure_filename(map_filename)
+    with _config_cache_lock:
+        _config_cache[key] = (signature, dict(config_data)); _config_cache.move_to_end(key)
+        while len(_config_cache) > config.MAP_CONFIG_CACHE_MAX_ENTRIES: _config_cache.popitem(last=False)
+
+
+def get_config_cache_stats():
+    with _config_cache_lock: return dict(_config_cache_stats, entries=len(_config_cache))
+
+
 def load_map_config(map_filename):
+    """
+    A map's normalized config, or None. Returns a shallow copy: callers may set top-level keys, never
+    mutate nested values (they are shared with the cache, the journal and live states).
+    """
     config_path = get_map_config_path(map_filename); backup_path = config_path + ".bak"; config_data = None; source_loaded = None
-    if os.path.exists(config_path):
+    secured = secure_filename(map_filename); pending = journal.pending_config(secured); signature = None
+    if pending is None:
+        signature = _file_signature(config_path)
+        with _config_cache_lock:
+            cached = _config_cache.get(secured)
+            if cached is not None and cached[0] == signature:
+                _config_cache.move_to_end(secured); _config_cache_stats["hits"] += 1
+                return dict(cached[1])
+            _config_cache_stats["misses"] += 1
+    if pending is not None:
+        # Journaled but not yet compacted into the file
+        config_data = dict(pending); source_loaded = "journal"
+    elif signature is not None:
         logging.debug(f"Loading main config: {config_path}")
         try:
-            with open(config_path, 'r', encoding='utf-8') as f: config_data = json.load(f)
+            with open(config_path, 'r', encoding='utf-8') as f: config_data = fog_codec.pack_state(json.load(f))
             logging.info(f"Loaded config: {config_path}"); source_loaded = "main"
         except Exception as e: logging.error(f"Error reading/decoding main config {config_path}: {e}"); config_data = None
     if config_data is None and os.path.exists(backup_path):
         logging.warning(f"Main config failed/missing for '{map_filename}', trying backup: {backup_path}")
         try:
-            with open(backup_path, 'r', encoding='utf-8') as f: config_data = json.load(f)
+            with open(backup_path, 'r', encoding='utf-8') as f: config_data = fog_codec.pack_state(json.load(f))
             logging.info(f"Loaded config from backup: {backup_path}"); source_loaded = "backup"
             if save_map_config(map_filename, config_data, create_backup=False): logging.info(f"Restored main config from backup for {map_filename}")
             else: logging.error(f"Failed to restore main config from backup for {map_filename}")
@@ -45,43 +88,46 @@ def load_map_config(map_filename):
                 expected_path = os.path.join('maps', secure_filename(map_filename)).replace('\\', '/')
                 if os.path.exists(os.path.join(config.MAPS_FOLDER, secure_filename(map_filename))): config_data['map_content_path'] = expected_path
                 else: logging.error(f"Cannot find map file {map_filename}."); return None
-            if 'filter_params' in config_data:
-                params = config_data['filter_params']; keys_to_remove = ['backgroundImageFilename', 'defaultFontFamily', 'defaultTextSpeed', 'fontSize']
-                for filter_id in list(params.keys()):
-                    if isinstance(params.get(filter_id), dict):
-                        for key in keys_to_remove: params[filter_id].pop(key, None)
-                config_data['filter_params'] = params
+            # Older configs carry every parameter of every filter; only overrides are kept (see filters.sparse_params)
+            config_data['filter_params'] = filters.sparse_params(config_data.get('filter_params'))
             if "view_state" not in config_data: config_data["view_state"] = {"center_x": 0.5, "center_y": 0.5, "scale": 1.0}
             if "fog_of_war" not in config_data: config_data["fog_of_war"] = {"hidden_polygons": []}
             elif not isinstance(config_data.get("fog_of_war"), dict): config_data["fog_of_war"] = {"hidden_polygons": []}
-            elif "hidden_polygons" not in config_data["fog_of_war"] or not isinstance(config_data["fog_of_war"].get("hidden_polygons"), list): config_data["fog_of_war"]["hidden_polygons"] = []
-            return config_data
+            elif "hidden_polygons" not in config_data["fog_of_war"] or not isinstance(config_data["fog_of_war"].get("hidden_polygons"), list): config_data["fog_of_war"] = dict(config_data["fog_of_war"], hidden_polygons=[])
+            if source_loaded == "main": _cache_config(map_filename, signature, config_data)
+            return dict(config_data)
         except Exception as e: logging.error(f"Error processing config {map_filename}: {e}", exc_info=True); return None
     logging.warning(f"Config/backup not found/failed for {map_filename}.")
     return None
 
 
 def save_map_config(map_filename, config_data, create_backup=True):
-    config_path = get_map_config_path(map_filename); backup_path = config_path + ".bak"; temp_path = config_path + ".tmp"
+    """Normalize a map config and journal it (see journal.record_config); written straight to its file when the journal isn't running."""
     try:
         expected_path = os.path.join('maps', secure_filename(map_filename)).replace('\\', '/'); config_data['map_content_path'] = expected_path
         config_data['display_type'] = 'image'; config_data.pop('map_image_path', None)
-        if 'filter_params' in config_data:
-            params = config_data['filter_params']; keys_to_remove = ['backgroundImageFilename', 'defaultFontFamily', 'defaultTextSpeed', 'fontSize']
-            for filter_id in list(params.keys()):
-                if isinstance(params.get(filter_id), dict):
-                    for key in keys_to_remove: params[filter_id].pop(key, None)
-            config_data['filter_params'] = params
+        # Only top-level keys of config_data are replaced — nested dicts may be shared with the live state
+        if 'filter_params' in config_data: config_data['filter_params'] = filters.sparse_params(config_data['filter_params'])
         if "view_state" not in config_data: config_data["view_state"] = {"center_x": 0.5, "center_y": 0.5, "scale": 1.0}
         if "fog_of_war" not in config_data or not isinstance(config_data.get("fog_of_war"), dict): config_data["fog_of_war"] = {"hidden_polygons": []}
-        if "hidden_polygons" not in config_data["fog_of_war"] or not isinstance(config_data["fog_of_war"].get("hidden_polygons"), list): config_data["fog_of_war"]["hidden_polygons"] = []
-        with open(temp_path, 'w', encoding='utf-8') as f: json.dump(config_data, f, indent=2, ensure_ascii=False)
+        if "hidden_polygons" not in config_data["fog_of_war"] or not isinstance(config_data["fog_of_war"].get("hidden_polygons"), list): config_data["fog_of_war"] = dict(config_data["fog_of_war"], hidden_polygons=[])
+    except Exception as e: logging.error(f"Error saving config {map_filename}: {e}", exc_info=True); return False
+    if journal.record_config(secure_filename(map_filename), config_data): logging.debug(f"Map config journaled: {map_filename}"); return True
+    return _write_map_config_file(map_filename, config_data, create_backup)
+
+
+def _write_map_config_file(map_filename, config_data, create_backup=True):
+    config_path = get_map_config_path(map_filename); backup_path = config_path + ".bak"; temp_path = config_path + ".tmp"
+    try:
+        # Fog vertices are packed (see fog_codec.py) — they were most of a config file's size
+        with open(temp_path, 'w', encoding='utf-8') as f: json.dump(fog_codec.pack_state(config_data), f, indent=2, ensure_ascii=False)
         if create_backup:
             try:
                 if os.path.exists(config_path): os.replace(config_path, backup_path)
                 logging.debug(f"Created backup: {backup_path}")
             except OSError as e: logging.error(f"Could not create backup {backup_path}: {e}", exc_info=True)
-        os.replace(temp_path, config_path); logging.info(f"Map config saved: {config_path}"); return True
+        os.replace(temp_path, config_path); logging.info(f"Map config saved: {config_path}")
+        _cache_config(map_filename, _file_signature(config_path), config_data); return True
     except Exception as e: logging.error(f"Error saving config {map_filename}: {e}", exc_info=True)
     finally:
          if os.path.exists(temp_path):
@@ -90,16 +136,6 @@ def save_map_config(map_filename, config_data, create_backup=True):
     return False
 
 
-def get_default_filter_params():
-    filter_params = {}; text_params = ['backgroundImageFilename', 'defaultFontFamily', 'defaultTextSpeed', 'fontSize']
-    for f_id, f_config in filters.available_filters.items():
-        defaults = {};
-        for key, param_data in f_config.get('params', {}).items():
-            if 'value' in param_data and key not in text_params: defaults[key] = param_data['value']
-        filter_params[f_id] = defaults
-    return filter_params
-
-
 def get_default_session_state():
     """
     Returns the default structure for a new session state.
@@ -124,7 +160,7 @@ def get_default_session_state():
         "display_type": "image",
         "current_filter": default_filter_id,
         "view_state": {"center_x": 0.5, "center_y": 0.5, "scale": 1.0},
-        "filter_params": get_default_filter_params(),
+        "filter_params": {},
         "fog_of_war": {"hidden_polygons": []}
     }
 
@@ -132,13 +168,6 @@ def get_default_session_state():
 def get_state_for_map(map_filename):
     map_config = load_map_config(map_filename)
     if map_config:
-        loaded_filter_params = map_config.get("filter_params", {}); default_filter_params = get_default_filter_params()
-        for f_id, params in default_filter_params.items():
-            if f_id not in loaded_filter_params: loaded_filter_params[f_id] = params
-            else:
-                for key, default_value in params.items():
-                    if key not in loaded_filter_params[f_id]: loaded_filter_params[f_id][key] = default_value
-        map_config["filter_params"] = loaded_filter_params
         if "view_state" not in map_config: map_config["view_state"] = {"center_x": 0.5, "center_y": 0.5, "scale": 1.0}
         if "fog_of_war" not in map_config: map_config["fog_of_war"] = {"hidden_polygons": []}
         map_config["display_type"] = "image"; map_config["original_map_path"] = map_config.get("map_content_path")
@@ -150,24 +179,22 @@ def get_state_for_map(map_filename):
             logging.info(f"Generating default state for: {map_filename}.")
             generic_default_state = { "original_map_path": relative_path, "map_content_path": None, "display_type": "image",
                                       "current_filter": "none" if "none" in filters.available_filters else list(filters.available_filters.keys())[0] if filters.available_filters else "",
-                                      "view_state": {"center_x": 0.5, "center_y": 0.5, "scale": 1.0}, "filter_params": get_default_filter_params(),
+                                      "view_state": {"center_x": 0.5, "center_y": 0.5, "scale": 1.0}, "filter_params": {},
                                       "fog_of_war": {"hidden_polygons": []} }
             return generic_default_state
         else: logging.warning(f"Map file not found/invalid: {map_filename}"); return None
 
 
 def merge_dicts(dict1, dict2):
-    result = copy.deepcopy(dict1)
+    """
+    Copy-on-write merge of dict2 into dict1. Only the dicts along changed paths are new;
+    every untouched subtree is shared with dict1, and lists (e.g. hidden_polygons) are
+    replaced whole. Neither argument is modified, and values from dict2 are adopted
+    as-is, so dict2 must not be mutated afterwards either.
+    """
+    result = dict(dict1)
     for key, value in dict2.items():
         if key == 'original_map_path': continue
-        if isinstance(value, dict) and key in result and isinstance(result[key], dict):
-            if key == 'fog_of_war':
-                if 'hidden_polygons' in value: result['fog_of_war']['hidden_polygons'] = copy.deepcopy(value['hidden_polygons'])
-                for fog_key, fog_value in value.items():
-                    if fog_key != 'hidden_polygons':
-                        if isinstance(fog_value, dict) and fog_key in result['fog_of_war'] and isinstance(result['fog_of_war'][fog_key], dict):
-                            result['fog_of_war'][fog_key] = merge_dicts(result['fog_of_war'][fog_key], fog_value)
-                        else: result['fog_of_war'][fog_key] = fog_value
-            else: result[key] = merge_dicts(result[key], value)
+        if isinstance(value, dict) and isinstance(result.get(key), dict): result[key] = merge_dicts(result[key], value)
         else: result[key] = value
     return result
@@ -0,0 +1,138 @@
+# server/image_cache.py
+# In-process LRU cache of decoded base map images (shared by all renders)
+
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from server import config
+
+_cache = OrderedDict()     # (abs_path, mtime_ns, size) -> decoded RGB PIL.Image
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+_digests = {}              # (abs_path, mtime_ns, size) -> sha256 hex of the file contents
+_sizes = {}                # (abs_path, mtime_ns, size) -> (width, height) read from the file header
+
+
+def _image_nbytes(image):
+    """Approximate in-memory size of a decoded image."""
+    return image.width * image.height * len(image.getbands())
+
+
+def _cache_key(full_path):
+    """Key a map file by absolute path plus mtime and size, so edits/re-uploads miss."""
+    st = os.stat(full_path)
+    return (os.path.abspath(full_path), st.st_mtime_ns, st.st_size)
+
+
+def _evict_locked(budget):
+    """Drop least-recently-used entries until the cache fits in budget. Caller holds the lock."""
+    global _cache_bytes
+    while _cache and _cache_bytes > budget:
+        old_key, old_image = _cache.popitem(last=False)
+        _cache_bytes -= _image_nbytes(old_image)
+        logging.debug(f"image_cache: Evicted {old_key[0]}")
+
+
+def get_base_image(full_path):
+    """
+    Return the decoded RGB base image for full_path, decoding from disk only on a miss.
+    The returned image is shared between callers — always copy() before drawing on it.
+    """
+    global _cache_bytes
+    key = _cache_key(full_path)
+    with _cache_lock:
+        image = _cache.get(key)
+        if image is not None:
+            _cache.move_to_end(key)
+            return image
+
+    # Decode outside the lock so a large map doesn't block hits on other maps
+    with Image.open(full_path) as src:
+        image = src.convert('RGB')
+    nbytes = _image_nbytes(image)
+    budget = config.BASE_IMAGE_CACHE_MAX_BYTES
+
+    with _cache_lock:
+        # Drop stale entries for the same file (map was replaced on disk)
+        for stale_key in [k for k in _cache if k[0] == key[0] and k != key]:
+            _cache_bytes -= _image_nbytes(_cache.pop(stale_key))
+        if key in _cache:
+            # Another thread decoded it concurrently — keep the cached copy
+            _cache.move_to_end(key)
+            return _cache[key]
+        if nbytes > budget:
+            logging.warning(f"image_cache: {full_path} ({nbytes} bytes) exceeds cache budget ({budget} bytes); not cached.")
+            return image
+        _cache[key] = image
+        _cache_bytes += nbytes
+        _evict_locked(budget)
+    logging.info(f"image_cache: Decoded and cached {full_path} ({image.width}x{image.height}, {nbytes} bytes).")
+    return image
+
+
+def get_file_digest(full_path):
+    """SHA-256 of a map file's contents, hashed once per (path, mtime, size)."""
+    key = _cache_key(full_path)
+    with _cache_lock:
+        digest = _digests.get(key)
+    if digest is not None:
+        return digest
+    h = hashlib.sha256()
+    with open(full_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _cache_lock:
+        for stale_key in [k for k in _digests if k[0] == key[0] and k != key]:
+            del _digests[stale_key]
+        _digests[key] = digest
+    return digest
+
+
+def get_image_size(full_path):
+    """Pixel size of a map file, from the decoded cache or the file header (no full decode)."""
+    key = _cache_key(full_path)
+    with _cache_lock:
+        image = _cache.get(key)
+        if image is not None:
+            return image.size
+        size = _sizes.get(key)
+    if size is not None:
+        return size
+    with Image.open(full_path) as src:
+        size = src.size
+    with _cache_lock:
+        for stale_key in [k for k in _sizes if k[0] == key[0] and k != key]:
+            del _sizes[stale_key]
+        _sizes[key] = size
+    return size
+
+
+def invalidate(full_path=None):
+    """Forget cached images for one file, or everything when full_path is None."""
+    global _cache_bytes
+    with _cache_lock:
+        if full_path is None:
+            _cache.clear()
+            _digests.clear()
+            _sizes.clear()
+            _cache_bytes = 0
+            return
+        abs_path = os.path.abspath(full_path)
+        for key in [k for k in _cache if k[0] == abs_path]:
+            _cache_bytes -= _image_nbytes(_cache.pop(key))
+        for key in [k for k in _digests if k[0] == abs_path]:
+            del _digests[key]
+        for key in [k for k in _sizes if k[0] == abs_path]:
+            del _sizes[key]
+
+
+def get_cache_stats():
+    """Return current cache occupancy as a dict."""
+    with _cache_lock:
+        return {"entries": len(_cache), "bytes": _cache_bytes, "budget_bytes": config.BASE_IMAGE_CACHE_MAX_BYTES}
@@ -0,0 +1,297 @@
+# server/journal.py
+# Write-behind journal of live state — batched appends + fsync, periodic compaction into config files and saves
+
+import os
+import json
+import time
+import logging
+import threading
+
+from server import config
+from server import state
+from server import save_store
+from server.state_sync import make_patch, apply_patch
+
+# The journal is a file of JSON lines, replayed in order at startup:
+#   {"k": "config", "map": name, "data": {...}}            full map config (first record per map since compaction)
+#   {"k": "config", "map": name, "ops": [...]}             JSON patch against the map's previous config record
+#   {"k": "session", "s": code, "full": {state, tokens, save_id}}
+#   {"k": "session", "s": code, "state": [...], "tokens": [...], "save_id": id}   patches against the previous record
+# Compaction writes pending configs to their files and sessions to their saves, then rewrites the journal
+# as one full record per session.
+#
+# Per session (see state.GameSession), owned by the journal thread: journaled_state / journaled_tokens /
+# journaled_tokens_seq / journaled_save_id are what the journal holds for it, persisted_state /
+# persisted_tokens_seq what its save last received.
+
+_lock = threading.RLock()
+_pending_configs = {}      # map filename -> latest config not yet written to its file (what load_map_config returns)
+_buffer = []               # records waiting for the next batch
+_file = None               # append handle, open while the journal runs
+_thread = None
+_stop = threading.Event()
+_last_compaction = 0.0
+_stats = {"records": 0, "batches": 0, "bytes": 0, "compactions": 0, "replayed": 0}
+
+
+def _dumps(record):
+    return json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n'
+
+
+def is_running():
+    return _thread is not None
+
+
+def init_journal():
+    """
+    Called at startup, after the latest save was auto-loaded: replay the journal left by the
+    last run (it may have crashed), compact it, and start the background writer.
+    """
+    global _thread
+    if not config.JOURNAL_ENABLED or _thread is not None:
+        return
+    _replay()
+    compact()
+    _thread = threading.Thread(target=_writer_loop, name='journal', daemon=True)
+    _thread.start()
+    logging.info(f"journal: Started ({config.JOURNAL_PATH}).")
+
+
+def shutdown():
+    """Stop the writer, then persist everything (compaction). Never raises."""
+    global _thread
+    if not config.JOURNAL_ENABLED:
+        # No journal to fold: write sessions straight to their configs and saves, and leave JOURNAL_PATH alone
+        for game in state.all_sessions():
+            persist_session(game)
+        return
+    if _thread is not None:
+        _stop.set()
+        _thread.join(timeout=5)
+        _thread = None
+    try:
+        compact()
+    except Exception as e:
+        logging.error(f"journal: Final compaction failed: {e}", exc_info=True)
+
+
+# --- Map configs ---
+
+def record_config(map_filename, config_data):
+    """
+    Journal a normalized map config instead of rewriting its file (see helpers.save_map_config).
+    Returns False when the journal isn't running and the caller must write the file itself.
+    """
+    if _thread is None:
+        return False
+    with _lock:
+        previous = _pending_configs.get(map_filename)
+        if previous is None:
+            _buffer.append({'k': 'config', 'map': map_filename, 'data': config_data})
+        else:
+            ops = make_patch(previous, config_data)
+            if ops:
+                _buffer.append({'k': 'config', 'map': map_filename, 'ops': ops})
+        _pending_configs[map_filename] = config_data
+    return True
+
+
+def pending_config(map_filename):
+    """The journaled config of a map not yet written to its file, or None."""
+    with _lock:
+        return _pending_configs.get(map_filename)
+
+
+# --- Sessions ---
+
+def _session_records():
+    """Records for every session whose state, tokens or save changed since it was last journaled."""
+    records = []
+    for game in state.all_sessions():
+        current_state = game.current_state
+        store = game.current_tokens
+        if current_state is game.journaled_state and store.seq == game.journaled_tokens_seq and game.current_save_id == game.journaled_save_id:
+            continue
+        with store.lock:
+            seq = store.seq
+            tokens = {t['id']: t for t in store.to_list()} if seq != game.journaled_tokens_seq else game.journaled_tokens
+        record = {'k': 'session', 's': game.code}
+        if game.journaled_tokens is None:
+            record['full'] = {'state': current_state, 'tokens': list(tokens.values()), 'save_id': game.current_save_id}
+        else:
+            state_ops = make_patch(game.journaled_state, current_state)
+            token_ops = make_patch(game.journaled_tokens, tokens)
+            if state_ops: record['state'] = state_ops
+            if token_ops: record['tokens'] = token_ops
+            if game.current_save_id != game.journaled_save_id: record['save_id'] = game.current_save_id
+        game.journaled_state = current_state; game.journaled_tokens = tokens
+        game.journaled_tokens_seq = seq; game.journaled_save_id = game.current_save_id
+        if len(record) > 2:
+            records.append(record)
+    return records
+
+
+def persist_session(game):
+    """Write a session's state into its map's config and, if one is loaded, its save. Never raises."""
+    from server import helpers  # helpers imports journal (save_map_config journals configs) — imported here to keep the modules acyclic
+    try:
+        current_state = game.current_state
+        seq = game.current_tokens.seq
+        if current_state is game.persisted_state and seq == game.persisted_tokens_seq:
+            return
+        # 1. Save per-map JSON config
+        if current_state:
+            original = current_state.get('original_map_path', '')
+            if original:
+                map_filename = os.path.basename(original)
+                if map_filename:
+                    cfg = {k: v for k, v in current_state.items() if k != 'original_map_path'}
+                    helpers.save_map_config(map_filename, cfg)
+                    logging.info(f"journal: Saved map config for {map_filename} (session {game.code})")
+
+        # 2. Save SQLite save
+        if game.current_save_id and current_state:
+            existing = save_store.read_summary(game.current_save_id)  # state and tokens are replaced below
+            if existing:
+                save_state = {k: v for k, v in current_state.items() if k != 'original_map_path'}
+                # Normalize map_content_path to the file path for persistence
+                original = current_state.get('original_map_path', '')
+                if original:
+                    map_filename = os.path.basename(original)
+                    save_state['map_content_path'] = f"maps/{map_filename}" if map_filename else save_state.get('map_content_path')
+                existing['state'] = save_state
+                existing['tokens'] = game.current_tokens.to_list()
+                existing['modified_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+                save_store.write(existing)
+                logging.info(f"journal: Saved SQLite save {game.current_save_id} (session {game.code})")
+        game.persisted_state = current_state; game.persisted_tokens_seq = seq
+    except Exception as e:
+        logging.error(f"journal: Save error (session {game.code}): {e}", exc_info=True)
+
+
+# --- Writing ---
+
+def _append(records):
+    """Append records and fsync once for the whole batch."""
+    if not records or _file is None:
+        return
+    data = ''.join(_dumps(r) for r in records)
+    _file.write(data)
+    _file.flush()
+    os.fsync(_file.fileno())
+    _stats["records"] += len(records); _stats["batches"] += 1; _stats["bytes"] += len(data)
+
+
+def _flush_batch():
+    with _lock:
+        records = _buffer[:]
+        _buffer.clear()
+        records.extend(_session_records())
+        _append(records)
+
+
+def compact():
+    """
+    Fold the journal into durable storage: sessions into their config and save, pending configs
+    into their files. The journal is then rewritten as one full record per session.
+    """
+    global _file, _last_compaction
+    from server import helpers  # see persist_session
+    for game in state.all_sessions():
+        persist_session(game)
+    with _lock:
+        _buffer.clear()
+        for map_filename, config_data in list(_pending_configs.items()):
+            if helpers._write_map_config_file(map_filename, config_data):
+                del _pending_configs[map_filename]
+            else:
+                _buffer.append({'k': 'config', 'map': map_filename, 'data': config_data})
+        # Journal state resets to nothing, so every session is written out in full
+        for game in state.all_sessions():
+            game.journaled_state = None; game.journaled_tokens = None
+            game.journaled_tokens_seq = -1; game.journaled_save_id = None
+        records = _buffer[:]
+        _buffer.clear()
+        records.extend(_session_records())
+        temp_path = config.JOURNAL_PATH + ".tmp"
+        if _file is not None:
+            _file.close(); _file = None
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(''.join(_dumps(r) for r in records))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, config.JOURNAL_PATH)
+        except OSError as e:
+            logging.error(f"journal: Could not rewrite {config.JOURNAL_PATH}: {e}", exc_info=True)
+        _file = open(config.JOURNAL_PATH, 'a', encoding='utf-8')
+        _last_compaction = time.monotonic()
+        _stats["compactions"] += 1
+    logging.debug(f"journal: Compacted to {len(records)} record(s).")
+
+
+def _writer_loop():
+    while not _stop.wait(config.JOURNAL_FLUSH_INTERVAL):
+        try:
+            _flush_batch()
+            due = time.monotonic() - _last_compaction >= config.JOURNAL_COMPACT_INTERVAL
+            if due or (_file is not None and _file.tell() >= config.JOURNAL_COMPACT_BYTES):
+                compact()
+        except Exception as e:
+            logging.error(f"journal: Write failed: {e}", exc_info=True)
+    try:
+        _flush_batch()
+    except Exception as e:
+        logging.error(f"journal: Final write failed: {e}", exc_info=True)
+
+
+# --- Replay ---
+
+def _replay():
+    """Apply the records of a journal left by the previous run to the sessions and pending configs."""
+    try:
+        with open(config.JOURNAL_PATH, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        logging.error(f"journal: Could not read {config.JOURNAL_PATH}: {e}")
+        return
+    tokens_by_session = {}
+    replayed = 0
+    for line_number, line in enumerate(lines, 1):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # A torn final line is what a crash mid-append leaves behind
+            logging.warning(f"journal: Skipping unreadable record on line {line_number}.")
+            continue
+        try:
+            if record.get('k') == 'config':
+                if 'data' in record:
+                    _pending_configs[record['map']] = record['data']
+                else:
+                    _pending_configs[record['map']] = apply_patch(_pending_configs[record['map']], record['ops'])
+            elif record.get('k') == 'session':
+                game = state.get_or_create_session(record['s'])
+                if 'full' in record:
+                    full = record['full']
+                    game.current_state = full['state']
+                    tokens_by_session[game] = {t['id']: t for t in full['tokens']}
+                    game.current_save_id = full['save_id']
+                else:
+                    if 'state' in record: game.current_state = apply_patch(game.current_state, record['state'])
+                    if 'tokens' in record: tokens_by_session[game] = apply_patch(tokens_by_session.get(game, {}), record['tokens'])
+                    if 'save_id' in record: game.current_save_id = record['save_id']
+            replayed += 1
+        except (KeyError, TypeError, ValueError) as e:
+            logging.warning(f"journal: Skipping inconsistent record on line {line_number}: {e}")
+    for game, tokens in tokens_by_session.items():
+        game.current_tokens.replace_all(list(tokens.values()))
+    _stats["replayed"] = replayed
+    if replayed:
+        logging.info(f"journal: Replayed {replayed} record(s) into {len(tokens_by_session)} session(s), {len(_pending_configs)} map config(s).")
+
+
+def get_stats():
+    return dict(_stats, pending_configs=len(_pending_configs), size=_file.tell() if _file is not None else 0)
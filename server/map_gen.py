@@ -5,11 +5,20 @@ import os
 import re
 import time
 import logging
-from io import BytesIO
+import threading
+from collections import Counter, OrderedDict
 from uuid import uuid4
 from PIL import Image, ImageDraw, UnidentifiedImageError
 
 from server import config
+from server import tiles
+from server import composite_cache
+from server import render_pool
+from server import encoders
+from server import fog_raster
+from server import fog_codec
+from server import fog_normalize
+from server.image_cache import get_base_image, get_file_digest, get_image_size
 
 
 def generate_player_map(state):
@@ -22,6 +31,7 @@ def generate_player_map(state):
         with Image.open(full_map_path).convert('RGBA') as base_image:
             draw = ImageDraw.Draw(base_image)
             for polygon in fog_data:
+                polygon = fog_codec.unpack_polygon(polygon)
                 vertices = polygon.get('vertices');
                 if not vertices or not isinstance(vertices, list) or len(vertices) < 3: continue
                 size_x, size_y = base_image.size; absolute_vertices = []; valid_polygon = True
@@ -45,55 +55,265 @@ def generate_player_map(state):
     return None
 
 
-def generate_player_map_bytes(state):
-    """Generate composited map as JPEG bytes in memory (no disk I/O)."""
+# --- Incremental fog compositing ---
+# The last composited frame of each session (GameSession.fog_frame) is kept so a fog edit only
+# repaints the rectangles touched by polygons that were added or removed since that frame.
+# A frame is {'base', 'polygons', 'ids', 'fog_rev', 'image', 'encoded', 'version', 'pending_dirty', 'tile_hashes', 'tile_version'}.
+
+_frames = OrderedDict()    # full_map_path -> frame, for renders outside any session
+_frames_lock = threading.Lock()    # guards _frames and every GameSession.fog_frame
+
+
+def absolute_polygons(fog_data, size, ids=None):
+    """Validate the render copy of the fog (see fog_normalize.render_polygons) and convert it to (pixel_vertices, color) tuples, in draw order."""
+    return fog_raster.absolute_polygons(fog_normalize.render_polygons(fog_data, size), size, ids)
+
+
+def _polygon_bbox(vertices):
+    """Bounding box of pixel vertices as (left, top, right, bottom), right/bottom exclusive."""
+    xs = [v[0] for v in vertices]; ys = [v[1] for v in vertices]
+    return (min(xs), min(ys), max(xs) + 1, max(ys) + 1)
+
+
+def _rects_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _merge_rects(rects):
+    """Merge overlapping rectangles until none overlap."""
+    merged = list(rects)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                if _rects_overlap(merged[i], merged[j]):
+                    a, b = merged[i], merged.pop(j)
+                    merged[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+def _draw_polygons(image, polygons, offset=(0, 0)):
+    """Draw (vertices, color) polygons onto image, translating by -offset."""
+    fog_raster.draw_polygons(image, polygons, offset)
+
+
+def _repaint_rect(frame_image, base_image, polygons, rect):
+    """Restore rect from the base image and redraw only the polygons that intersect it."""
+    hit_boxes = [(p, _polygon_bbox(p[0])) for p in polygons]
+    hit_boxes = [(p, box) for p, box in hit_boxes if _rects_overlap(box, rect)]
+    # Draw on a region holding every hit polygon whole: Pillow clips self-intersecting
+    # polygons slightly differently at canvas edges, so clipping to rect could drift from a full redraw
+    outer = rect
+    for _, box in hit_boxes:
+        outer = (min(outer[0], box[0]), min(outer[1], box[1]), max(outer[2], box[2]), max(outer[3], box[3]))
+    region = base_image.crop(outer)
+    _draw_polygons(region, [p for p, _ in hit_boxes], offset=outer[:2])
+    frame_image.paste(region.crop((rect[0] - outer[0], rect[1] - outer[1], rect[2] - outer[0], rect[3] - outer[1])), rect[:2])
+
+
+def _dirty_rects(old_polygons, new_polygons):
+    """
+    Rectangles that differ between two polygon lists, or None when the whole
+    frame must be redrawn (same polygons, different stacking order).
+    """
+    old_counts = Counter(old_polygons); new_counts = Counter(new_polygons)
+    changed = list((old_counts - new_counts).elements()) + list((new_counts - old_counts).elements())
+    if not changed:
+        return None if old_polygons != new_polygons else []
+    return _merge_rects([_polygon_bbox(vertices) for vertices, _ in changed])
+
+
+def _hinted_rects(frame, polygons, ids, changed_ids):
+    """Dirty rectangles from the old and new versions of the polygons a fog operation touched."""
+    def touched(i):  # a merged render polygon's id is the frozenset of its members' ids
+        return not changed_ids.isdisjoint(i) if isinstance(i, frozenset) else i in changed_ids
+    boxes = [_polygon_bbox(p[0]) for p, i in zip(frame['polygons'], frame['ids']) if touched(i)]
+    boxes += [_polygon_bbox(p[0]) for p, i in zip(polygons, ids) if touched(i)]
+    return _merge_rects(boxes)
+
+
+def _store_frame(game, full_map_path, frame):
+    """Keep frame as the session's last one, or (without a session) in the small per-map LRU. Caller must hold _frames_lock."""
+    if game is not None:
+        game.fog_frame = frame
+        return
+    _frames[full_map_path] = frame
+    _frames.move_to_end(full_map_path)
+    while len(_frames) > config.FOG_FRAME_CACHE_MAX_ENTRIES:
+        _frames.popitem(last=False)
+
+
+def _composite_frame(game, full_map_path, base_image, polygons, version, ids=None, fog_hint=None):
+    """
+    Bring the cached frame of game (or, with no session, of full_map_path) up to date with polygons and return it.
+    frame['version'] is the composite cache key of what the frame shows; repainted rects accumulate in
+    frame['pending_dirty'] (None = whole frame) until the tile differ consumes them.
+    fog_hint ({'base', 'rev', 'ids'}, from fog operations) names the polygon ids changed between fog
+    revisions base and rev; when the frame shows revision base, only those polygons are diffed.
+    Caller must hold _frames_lock.
+    """
+    frame = game.fog_frame if game is not None else _frames.get(full_map_path)
+    fog_rev = fog_hint['rev'] if fog_hint else None
+    if frame is not None and frame['base'] is base_image:
+        if game is None: _frames.move_to_end(full_map_path)
+        if fog_hint and ids is not None and frame['fog_rev'] == fog_hint['base'] and frame['ids'] is not None:
+            rects = _hinted_rects(frame, polygons, ids, fog_hint['ids'])
+        else:
+            rects = _dirty_rects(frame['polygons'], polygons)
+        frame['fog_rev'] = fog_rev
+        if rects == []:
+            frame['version'] = version  # same pixels, possibly a differently-keyed fog list
+            frame['polygons'] = polygons; frame['ids'] = ids
+            return frame
+        width, height = base_image.size
+        if rects is not None and sum((r[2] - r[0]) * (r[3] - r[1]) for r in rects) < width * height // 2:
+            for rect in rects:
+                _repaint_rect(frame['image'], base_image, polygons, rect)
+            logging.debug(f"generate_player_map_bytes: Repainted {len(rects)} dirty region(s).")
+            frame['polygons'] = polygons; frame['ids'] = ids; frame['encoded'] = None; frame['version'] = version
+            if frame['pending_dirty'] is not None: frame['pending_dirty'].extend(rects)
+            return frame
+    # No usable frame (first render, map replaced, or most of the map changed) — full redraw
+    if render_pool.is_enabled_for(base_image.size):
+        image = render_pool.composite(base_image, polygons)
+    else:
+        image = base_image.copy()
+        _draw_polygons(image, polygons)
+    new_frame = {'base': base_image, 'polygons': polygons, 'ids': ids, 'fog_rev': fog_rev, 'image': image, 'encoded': None,
+                 'version': version, 'pending_dirty': None, 'tile_hashes': None, 'tile_version': None}
+    if frame is not None and frame['image'].size == image.size:
+        # Tile hashes are content-based, so they stay a valid diff baseline across a full redraw
+        new_frame['tile_hashes'] = frame['tile_hashes']; new_frame['tile_version'] = frame['tile_version']
+    _store_frame(game, full_map_path, new_frame)
+    return new_frame
+
+
+def clear_frame_cache(game=None):
+    """Forget a session's composited frame, or (without one) the frames of sessionless renders."""
+    with _frames_lock:
+        if game is None: _frames.clear()
+        else: game.fog_frame = None
+
+
+def _resolve_map(state, log_prefix):
+    """Return (full_map_path, fog_data) for a state, or (None, None) if it has no usable map."""
     original_map_path = state.get('original_map_path')
     fog_data = state.get('fog_of_war', {}).get('hidden_polygons', [])
     if not original_map_path:
-        logging.debug("generate_player_map_bytes: No original_map_path.")
-        return None
+        logging.debug(f"{log_prefix}: No original_map_path.")
+        return None, None
     full_map_path = os.path.join(config.APP_ROOT, original_map_path)
     if not os.path.exists(full_map_path):
-        logging.error(f"generate_player_map_bytes: Original map missing: {full_map_path}")
+        logging.error(f"{log_prefix}: Original map missing: {full_map_path}")
+        return None, None
+    return full_map_path, fog_data
+
+
+def encoder_for(full_map_path):
+    """Encoder for a map: the configured one, or in auto mode the one benchmarked when the map first loaded."""
+    if config.MAP_ENCODER != encoders.AUTO:
+        return encoders.make_encoder(config.MAP_ENCODER)
+    digest = get_file_digest(full_map_path)
+    return encoders.get_auto_choice(digest) or encoders.choose_auto(digest, get_base_image(full_map_path))
+
+
+def _encode_frame(frame, encoder):
+    """Encode (or reuse) the full-frame image. Caller must hold _frames_lock."""
+    if frame['encoded'] is None or frame['encoded'][0] != encoder:
+        frame['encoded'] = (encoder, encoders.encode(frame['image'], encoder))
+        logging.info(f"generate_player_map_bytes: Generated {len(frame['encoded'][1])} bytes {encoder.name} in memory.")
+    return frame['encoded'][1]
+
+
+def variant_size(size, max_size):
+    """Output size of a map of the given size for a resolution bucket, or None when no downscale applies."""
+    if not max_size or max(size) <= max_size:
         return None
+    scale = max_size / max(size)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+
+def composite_key_for(full_map_path, fog_data, encoder, max_size=None):
+    """Content address of the composite for a map file + fog list with the given encoder (and resolution bucket)."""
+    settings = encoders.settings(encoder)
+    if variant_size(get_image_size(full_map_path), max_size) is not None:
+        settings = settings + (('max_size', max_size),)
+    return composite_cache.composite_key(get_file_digest(full_map_path), fog_data, settings)
+
+
+def _encode_variant(frame, size, encoder):
+    """Downscale the composited frame to size and encode it. Caller must hold _frames_lock."""
+    image = frame['image'].resize(size, Image.LANCZOS, reducing_gap=3.0)
+    image_bytes = encoders.encode(image, encoder)
+    logging.info(f"generate_player_map_bytes: Generated {len(image_bytes)} bytes {size[0]}x{size[1]} {encoder.name} variant.")
+    return image_bytes
+
+
+def generate_player_map_frame(state, game=None, max_size=None, fog_hint=None):
+    """
+    Composite the player map and return (image_bytes, composite_key, encoder), or (None, None, None) on failure.
+    Identical (map, fog, encoder, resolution) combinations are served from the composite cache without rendering.
+    max_size picks a resolution bucket: the full-size frame is composited as usual and only
+    resampled at the end, so every bucket shares one decode and one fog rasterization.
+    fog_hint is passed through to _composite_frame. game (a GameSession) owns the cached frame
+    to repaint; without one, frames are kept per map path.
+    """
+    full_map_path, fog_data = _resolve_map(state, "generate_player_map_bytes")
+    if not full_map_path:
+        return None, None, None
     try:
-        with Image.open(full_map_path).convert('RGB') as base_image:
-            draw = ImageDraw.Draw(base_image)
-            for polygon in fog_data:
-                vertices = polygon.get('vertices')
-                if not vertices or not isinstance(vertices, list) or len(vertices) < 3:
-                    continue
-                size_x, size_y = base_image.size
-                absolute_vertices = []
-                valid_polygon = True
-                for vertex in vertices:
-                    if isinstance(vertex, dict) and 'x' in vertex and 'y' in vertex:
-                        try:
-                            x_coord = max(0, min(int(float(vertex['x']) * size_x), size_x - 1))
-                            y_coord = max(0, min(int(float(vertex['y']) * size_y), size_y - 1))
-                            absolute_vertices.append((x_coord, y_coord))
-                        except (ValueError, TypeError):
-                            valid_polygon = False
-                            break
-                    else:
-                        valid_polygon = False
-                        break
-                if not valid_polygon or len(absolute_vertices) < 3:
-                    continue
-                color = polygon.get('color', '#000000')
-                try:
-                    if not re.match(r'^#[0-9a-fA-F]{3}(?:[0-9a-fA-F]{3})?$', color):
-                        color = '#000000'
-                    draw.polygon(absolute_vertices, fill=color)
-                except Exception as e:
-                    logging.error(f"generate_player_map_bytes: Error drawing polygon: {e}")
-            buf = BytesIO()
-            base_image.save(buf, format='JPEG', quality=85)
-            image_bytes = buf.getvalue()
-            logging.info(f"generate_player_map_bytes: Generated {len(image_bytes)} bytes JPEG in memory.")
-            return image_bytes
+        encoder = encoder_for(full_map_path)
+        key = composite_key_for(full_map_path, fog_data, encoder, max_size)
+        cached = composite_cache.get(key, encoder.ext)
+        if cached is not None:
+            return cached, key, encoder
+        base_image = get_base_image(full_map_path)
+        ids = []
+        polygons = absolute_polygons(fog_data, base_image.size, ids)
+        size = variant_size(base_image.size, max_size)
+        # The frame is always keyed by the full-resolution composite so tile diffs stay consistent
+        frame_version = key if size is None else composite_key_for(full_map_path, fog_data, encoder)
+        with _frames_lock:
+            frame = _composite_frame(game, full_map_path, base_image, polygons, frame_version, ids, fog_hint)
+            image_bytes = _encode_frame(frame, encoder) if size is None else _encode_variant(frame, size, encoder)
+        composite_cache.put(key, encoder.ext, image_bytes)
+        return image_bytes, key, encoder
     except UnidentifiedImageError:
         logging.error(f"generate_player_map_bytes: Pillow could not identify: {full_map_path}")
     except Exception as e:
         logging.error(f"Error generating player map bytes: {e}", exc_info=True)
+    return None, None, None
+
+
+def generate_player_map_bytes(state, game=None):
+    """Generate the composited map as encoded bytes in memory (no disk I/O), repainting only what changed."""
+    return generate_player_map_frame(state, game)[0]
+
+
+def generate_player_map_tiles(state, game=None, fog_hint=None):
+    """
+    Composite the player map and return a tile patch holding only the tiles whose
+    content changed since the previous patch, or None when clients need a full image.
+    """
+    full_map_path, fog_data = _resolve_map(state, "generate_player_map_tiles")
+    if not full_map_path:
+        return None
+    try:
+        encoder = encoder_for(full_map_path)
+        key = composite_key_for(full_map_path, fog_data, encoder)
+        base_image = get_base_image(full_map_path)
+        ids = []
+        polygons = absolute_polygons(fog_data, base_image.size, ids)
+        with _frames_lock:
+            frame = _composite_frame(game, full_map_path, base_image, polygons, key, ids, fog_hint)
+            return tiles.diff_tiles(frame, config.MAP_TILE_SIZE, encoder)
+    except UnidentifiedImageError:
+        logging.error(f"generate_player_map_tiles: Pillow could not identify: {full_map_path}")
+    except Exception as e:
+        logging.error(f"Error generating player map tiles: {e}", exc_info=True)
     return None
@@ -0,0 +1,200 @@
+# server/message_bus.py
+# Shared message bus between server worker processes — a SQLite-backed Socket.IO client manager
+
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import deque
+
+from flask import request
+import socketio as python_socketio
+
+from server import config
+
+# One authoritative worker owns the game sessions (GM, state, rendering, tokens); any number of
+# fan-out workers only hold player sockets. Fan-out workers forward every player event to the
+# authoritative worker, which handles it as if the socket were local: its emits to rooms and sids
+# travel over the bus once and each worker delivers them to the sockets it holds.
+
+_app = None
+_manager = None
+_socketio = None
+_forwarded_handlers = {}   # event name -> socket handler, on the authoritative worker
+_backlogs = {}             # sid -> deque of forwarded messages waiting for that socket's runner task
+_backlogs_lock = threading.Lock()
+_stats = {"published": 0, "received": 0, "forwarded": 0, "dispatched": 0, "dropped": 0}
+
+
+class SQLiteManager(python_socketio.PubSubManager):
+    """
+    Socket.IO client manager whose pub/sub channel is a table in a local SQLite database,
+    so several worker processes on one machine can share rooms without a broker.
+    Messages are JSON rows read in id order; rows older than MESSAGE_BUS_RETENTION_SECONDS are pruned.
+    """
+    name = 'sqlite'
+
+    def __init__(self, url, channel='socketio', write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.path = url[len('sqlite:///'):]  # sqlite:///bus.db is relative, sqlite:////tmp/bus.db absolute
+        self.on_forward = None     # called with each 'forward' message (authoritative worker only)
+        self._lock = threading.Lock()
+        self._publish_count = 0
+        self._conn = self._connect()
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS bus (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                payload TEXT NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _publish(self, data):
+        payload = json.dumps(data, separators=(',', ':'))
+        with self._lock:
+            self._conn.execute("INSERT INTO bus (channel, created_at, payload) VALUES (?, ?, ?)", (self.channel, time.time(), payload))
+            self._publish_count += 1
+            if self._publish_count % 256 == 0:
+                self._conn.execute("DELETE FROM bus WHERE created_at < ?", (time.time() - config.MESSAGE_BUS_RETENTION_SECONDS,))
+        _stats["published"] += 1
+
+    def _listen(self):
+        conn = self._connect()
+        # Start at the current end: messages published before this worker started are not for it
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM bus").fetchone()[0]
+        while True:
+            rows = conn.execute("SELECT id, payload FROM bus WHERE id > ? AND channel = ? ORDER BY id", (last_id, self.channel)).fetchall()
+            for row_id, payload in rows:
+                last_id = row_id
+                try:
+                    message = json.loads(payload)
+                except ValueError:
+                    continue
+                _stats["received"] += 1
+                if message.get('method') == 'forward':
+                    if self.on_forward is not None:
+                        self.on_forward(message)
+                    continue
+                yield message
+            if not rows:
+                time.sleep(config.MESSAGE_BUS_POLL_INTERVAL)
+
+
+def init_message_bus(app):
+    """
+    Called from create_app() before SocketIO is initialised. Returns the client manager for
+    config.MESSAGE_QUEUE (None when running as a single process). Raises RuntimeError for a
+    fan-out worker without a bus or a queue URL this tree has no manager for.
+    """
+    global _app, _manager
+    _app = app
+    url = config.MESSAGE_QUEUE
+    if not url:
+        if config.WORKER_ROLE != 'authoritative':
+            raise RuntimeError("A fan-out worker needs MESSAGE_QUEUE set to the bus shared with the authoritative worker.")
+        return None
+    if not url.startswith('sqlite:///'):
+        raise RuntimeError(f"Unsupported MESSAGE_QUEUE {url!r} (expected sqlite:///path/to/bus.db).")
+    _manager = SQLiteManager(url, channel=config.MESSAGE_BUS_CHANNEL)
+    if config.WORKER_ROLE == 'authoritative':
+        _manager.on_forward = _dispatch
+    logging.info(f"message_bus: {config.WORKER_ROLE} worker on {_manager.path} (host {_manager.host_id}).")
+    return _manager
+
+
+def start_listening(socketio_instance):
+    """Start reading the bus now rather than at the first local connection (python-socketio's default) — the authoritative worker may never have one."""
+    global _socketio
+    _socketio = socketio_instance
+    server = socketio_instance.server
+    if _manager is not None and not server.manager_initialized:
+        server.manager_initialized = True
+        _manager.initialize()
+
+
+def is_fanout():
+    return config.WORKER_ROLE == 'fanout'
+
+
+def is_shared():
+    """True when other worker processes share this one's players (a bus is configured)."""
+    return _manager is not None
+
+
+def serve_forwarded(handlers):
+    """Authoritative worker: the socket handlers that run events forwarded by fan-out workers, by event name."""
+    _forwarded_handlers.update(handlers)
+
+
+def forward(event, sid, data=None):
+    """Fan-out worker: hand a player socket's event to the authoritative worker."""
+    _stats["forwarded"] += 1
+    _manager._publish({'method': 'forward', 'event': event, 'sid': sid, 'namespace': '/', 'data': data, 'host_id': _manager.host_id})
+
+
+def _dispatch(message):
+    """
+    Bus listener thread: queue a forwarded event behind the earlier ones from its socket and return.
+    Each socket with queued events has one background task running them in order, so a slow
+    handler (join_game rendering a large map) delays only its own socket's later events.
+    """
+    sid = message.get('sid')
+    if message.get('event') not in _forwarded_handlers or not sid:
+        _stats["dropped"] += 1
+        logging.warning(f"message_bus: Dropped forwarded event {message.get('event')!r}.")
+        return
+    with _backlogs_lock:
+        backlog = _backlogs.get(sid)
+        if backlog is not None:
+            backlog.append(message)
+            return
+        _backlogs[sid] = deque([message])
+    _socketio.start_background_task(_drain, sid)
+
+
+def _drain(sid):
+    while True:
+        with _backlogs_lock:
+            backlog = _backlogs[sid]
+            if not backlog:
+                del _backlogs[sid]
+                return
+            message = backlog.popleft()
+        _run_forwarded(message)
+
+
+def _run_forwarded(message):
+    """
+    Run a forwarded event's handler as if the socket were connected here. The handler runs in a test
+    request context whose request.sid / request.namespace are the player's, which is all these
+    Flask-SocketIO helpers need: emit/send (to the sender or a room), join_room, leave_room and
+    disconnect — the pub/sub manager relays them over the bus to the worker holding the socket.
+    Not supported: rooms() (it only sees local sockets), emit callbacks / call() (acks can't cross
+    the bus) and the Flask session (it is empty here, so forwarded events never count as the GM's).
+    """
+    handler = _forwarded_handlers[message['event']]
+    data = message.get('data')
+    try:
+        with _app.test_request_context('/socket.io/'):
+            request.sid = message['sid']
+            request.namespace = message.get('namespace') or '/'
+            if data is None: handler()
+            else: handler(data)
+        _stats["dispatched"] += 1
+    except Exception as e:
+        logging.error(f"message_bus: Forwarded {message.get('event')} from {message.get('sid')} failed: {e}", exc_info=True)
+
+
+def get_stats():
+    with _backlogs_lock:
+        pending = sum(len(b) for b in _backlogs.values())
+    return dict(_stats, pending=pending, role=config.WORKER_ROLE, bus=_manager.path if _manager else None)
@@ -0,0 +1,140 @@
+# server/render_pool.py
+# Optional multi-core fog compositing — horizontal bands rasterized by a process pool over shared memory
+
+import atexit
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+from PIL import Image
+
+from server import config
+from server import fog_raster
+
+_pool = None               # ProcessPoolExecutor, created on first use
+_encode_pool = None        # ThreadPoolExecutor for tile encodes (Pillow releases the GIL while encoding)
+_pool_lock = threading.Lock()
+_base_segments = []        # [(base_image, SharedMemory)] — decoded base pixels published once per base image
+_output_segments = {}      # nbytes -> SharedMemory reused as the band output buffer
+
+# Worker-process side: segments attached by name, so the base is never pickled per task
+_attached = {}
+
+
+def is_enabled_for(size):
+    """True when the process engine is configured and the image is large enough to benefit."""
+    return config.RENDER_ENGINE == 'process' and size[0] * size[1] >= config.RENDER_POOL_MIN_PIXELS
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=config.RENDER_POOL_SIZE)
+            logging.info(f"render_pool: Started {config.RENDER_POOL_SIZE} render process(es).")
+        return _pool
+
+
+def get_encode_pool():
+    """Thread pool for parallel tile encodes, or None when the process engine is off."""
+    global _encode_pool
+    if config.RENDER_ENGINE != 'process':
+        return None
+    with _pool_lock:
+        if _encode_pool is None:
+            _encode_pool = ThreadPoolExecutor(max_workers=config.RENDER_POOL_SIZE, thread_name_prefix='tile-encode')
+        return _encode_pool
+
+
+def _base_segment(base_image):
+    """Shared-memory copy of a decoded base image, created once per base image object."""
+    for image, segment in _base_segments:
+        if image is base_image:
+            return segment
+    data = base_image.tobytes()
+    segment = shared_memory.SharedMemory(create=True, size=len(data))
+    segment.buf[:len(data)] = data
+    _base_segments.append((base_image, segment))
+    while len(_base_segments) > 2:
+        _, old = _base_segments.pop(0)
+        old.close(); old.unlink()
+    return segment
+
+
+def _output_segment(nbytes):
+    segment = _output_segments.get(nbytes)
+    if segment is None:
+        for old in _output_segments.values():
+            old.close(); old.unlink()
+        _output_segments.clear()
+        segment = shared_memory.SharedMemory(create=True, size=nbytes)
+        _output_segments[nbytes] = segment
+    return segment
+
+
+def _attach(name):
+    """Worker side: attach (and keep) a shared-memory segment by name."""
+    segment = _attached.get(name)
+    if segment is None:
+        # Pool workers share the parent's resource tracker, so attaching doesn't take ownership
+        segment = shared_memory.SharedMemory(name=name)
+        _attached[name] = segment
+        while len(_attached) > 4:
+            old_name = next(iter(_attached))
+            _attached.pop(old_name).close()
+    return segment
+
+
+def _render_band(base_name, output_name, size, top, bottom, polygons):
+    """Worker task: copy rows [top, bottom) of the base, draw intersecting polygons, write to output."""
+    width = size[0]
+    row_bytes = width * 3
+    start, end = top * row_bytes, bottom * row_bytes
+    base = _attach(base_name); output = _attach(output_name)
+    band = Image.frombytes('RGB', (width, bottom - top), bytes(base.buf[start:end]))
+    fog_raster.draw_polygons(band, polygons, offset=(0, top))
+    output.buf[start:end] = band.tobytes()
+    return bottom - top
+
+
+def composite(base_image, polygons):
+    """
+    Composite polygons over base_image using the process pool and return a new image.
+    Each band only receives the polygons whose bounding box crosses it.
+    """
+    width, height = base_image.size
+    base = _base_segment(base_image)
+    output = _output_segment(width * height * 3)
+    bands = max(1, config.RENDER_POOL_SIZE * 2)
+    band_height = -(-height // bands)
+    bboxes = [(min(y for _, y in v), max(y for _, y in v)) for v, _ in polygons]
+    futures = []
+    for top in range(0, height, band_height):
+        bottom = min(top + band_height, height)
+        band_polygons = [p for p, (y0, y1) in zip(polygons, bboxes) if y0 < bottom and y1 >= top]
+        futures.append(_get_pool().submit(_render_band, base.name, output.name, (width, height), top, bottom, band_polygons))
+    for future in futures:
+        future.result()
+    return Image.frombuffer('RGB', (width, height), output.buf, 'raw', 'RGB', 0, 1).copy()
+
+
+def shutdown():
+    """Stop worker processes and release shared memory."""
+    global _pool, _encode_pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True); _pool = None
+        if _encode_pool is not None:
+            _encode_pool.shutdown(wait=False); _encode_pool = None
+    for _, segment in _base_segments:
+        try: segment.close(); segment.unlink()
+        except Exception: pass
+    _base_segments.clear()
+    for segment in _output_segments.values():
+        try: segment.close(); segment.unlink()
+        except Exception: pass
+    _output_segments.clear()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,154 @@
+# server/render_worker.py
+# Background player-map render worker with latest-wins coalescing
+
+import logging
+import threading
+
+from server import config
+from server import transport
+from server.map_gen import generate_player_map_frame, generate_player_map_tiles
+
+# Module-level socketio reference — set by init_render_worker()
+_socketio = None
+
+_cond = threading.Condition()
+_pending = {}              # session code -> latest job waiting to render: {'game', 'generation', 'state', 'full', 'fog_hint'}
+# Per session (see state.GameSession), guarded by _cond: render_generation is bumped on every
+# submit/invalidate (renders from older generations are stale), and carry_patch holds a tile patch
+# superseded before it was sent, merged into the next one.
+_thread = None
+_stats = {"submitted": 0, "superseded": 0, "rendered": 0, "dropped_stale": 0}
+
+
+def init_render_worker(socketio_instance):
+    """Called from create_app() to provide the socketio reference and start the worker thread."""
+    global _socketio, _thread
+    _socketio = socketio_instance
+    if config.RENDER_IN_BACKGROUND and _thread is None:
+        _thread = threading.Thread(target=_worker_loop, name='render-worker', daemon=True)
+        _thread.start()
+
+
+def submit(game, state_snapshot, full_image=False, fog_hint=None):
+    """
+    Queue a render of a session's state_snapshot for broadcast to its players. A newer submit for the
+    same session replaces any job still waiting, and a render that finishes after a newer submit is discarded.
+    full_image forces a whole-image broadcast (map switch / save load) instead of a tile patch.
+    fog_hint lists the polygon ids a fog operation changed (see map_gen._composite_frame).
+    The snapshot must not be mutated afterwards.
+    """
+    with _cond:
+        game.render_generation += 1
+        _stats["submitted"] += 1
+        previous = _pending.pop(game.code, None)
+        if previous is not None:
+            _stats["superseded"] += 1
+            full_image = full_image or previous['full']
+            fog_hint = _merge_fog_hints(previous['fog_hint'], fog_hint)
+        job = {'game': game, 'generation': game.render_generation, 'state': state_snapshot, 'full': full_image, 'fog_hint': fog_hint}
+        if config.RENDER_IN_BACKGROUND:
+            _pending[game.code] = job
+            _cond.notify()
+    if not config.RENDER_IN_BACKGROUND:
+        _run_job(job)
+
+
+def invalidate(game):
+    """Drop a session's pending render and mark its in-flight renders stale (e.g. map was cleared)."""
+    with _cond:
+        game.render_generation += 1
+        _pending.pop(game.code, None)
+        game.carry_patch = None
+
+
+def get_stats():
+    with _cond:
+        return dict(_stats, pending=len(_pending))
+
+
+def _take_pending():
+    """Oldest waiting job across sessions, so one busy table can't starve the others."""
+    with _cond:
+        if not _pending:
+            return None
+        return _pending.pop(next(iter(_pending)))
+
+
+def _merge_fog_hints(older, newer):
+    """Combine the hints of two coalesced jobs; None (diff everything) unless they are consecutive."""
+    if older is None or newer is None or older['rev'] != newer['base']:
+        return None
+    return {'base': older['base'], 'rev': newer['rev'], 'ids': older['ids'] | newer['ids']}
+
+
+def _merge_patches(older, newer):
+    """Combine two consecutive tile patches into one that applies on top of older's base."""
+    if older is None:
+        return newer
+    if older['version'] != newer['base_version']:
+        return None
+    newer_positions = {(t['x'], t['y']) for t in newer['tiles']}
+    merged = dict(newer)
+    merged['base_version'] = older['base_version']
+    merged['tiles'] = [t for t in older['tiles'] if (t['x'], t['y']) not in newer_positions] + newer['tiles']
+    return merged
+
+
+def _run_job(job):
+    """Render one job and broadcast it to its session, unless a newer job arrived meanwhile."""
+    game = job['game']
+    render_state = job['state']
+    routes = transport.active_routes(game)
+    full_route = (transport.TRANSPORT_BINARY, None)
+    images = {}; tile_patch = None
+    try:
+        if config.MAP_TILED_DELIVERY and not job['full'] and full_route in routes:
+            tile_patch = generate_player_map_tiles(render_state, game=game, fog_hint=job['fog_hint'])
+            if tile_patch is not None:
+                with _cond:
+                    tile_patch = _merge_patches(game.carry_patch, tile_patch); game.carry_patch = None
+        # One full composite per job; each resolution bucket only adds a resample + encode
+        for image_transport, bucket in routes:
+            if (image_transport, bucket) == full_route and tile_patch is not None:
+                continue
+            if bucket not in images:
+                images[bucket] = generate_player_map_frame(render_state, game=game, max_size=bucket, fog_hint=job['fog_hint'])
+    except Exception as e:
+        logging.error(f"render_worker: Render failed: {e}", exc_info=True)
+        return
+
+    with _cond:
+        if job['generation'] != game.render_generation:
+            _stats["dropped_stale"] += 1
+            if tile_patch is not None and not job['full']:
+                # Clients still need these tiles; they ride along with the next patch
+                game.carry_patch = _merge_patches(game.carry_patch, tile_patch)
+            logging.debug(f"render_worker: Dropped stale render for session {game.code} (generation {job['generation']} < {game.render_generation}).")
+            return
+        _stats["rendered"] += 1
+        if tile_patch is None:
+            game.carry_patch = None
+
+    if tile_patch is not None:
+        logging.info(f"render_worker: Broadcasting {len(tile_patch['tiles'])} changed tile(s).")
+        transport.emit_map_tiles(_socketio.emit, tile_patch, room=game.room)
+    for image_transport, bucket in routes:
+        if bucket not in images or ((image_transport, bucket) == full_route and tile_patch is not None):
+            continue
+        image_bytes, image_version, encoder = images[bucket]
+        if not image_bytes:
+            logging.warning("render_worker: Image regeneration was needed but produced no bytes.")
+            continue
+        logging.info(f"render_worker: Broadcasting {len(image_bytes)} bytes image ({image_transport}, max size {bucket or 'full'}).")
+        transport.emit_map_image(_socketio.emit, image_bytes, transport=image_transport, bucket=bucket, mime=encoder.mime, version=image_version, room=game.room)
+
+
+def _worker_loop():
+    logging.info("render_worker: Started.")
+    while True:
+        with _cond:
+            while not _pending:
+                _cond.wait()
+        job = _take_pending()
+        if job is not None:
+            _run_job(job)
@@ -9,22 +9,44 @@ from flask import Blueprint, request, jsonify, render_template, send_from_direct
 from werkzeug.utils import secure_filename
 
 from server import config
+from server import state
 from server import filters
 from server import helpers
 from server import tunnel
+from server import composite_cache
+from server import encoders
+from server import fog_codec
+from server import fog_normalize
+from server import render_worker
+from server import token_broadcast
+from server import message_bus
+from server import journal
 from server.auth import gm_required
 
 core_bp = Blueprint('core', __name__)
 
 
+def _select_session(code):
+    """Point the GM's browser at session `code` (created on first use); malformed codes are ignored."""
+    if not code:
+        return
+    try:
+        game = state.get_or_create_session(code)
+    except ValueError:
+        logging.warning(f"Ignoring invalid session code {code!r}.")
+        return
+    session['session_code'] = game.code
+
+
 @core_bp.route('/')
 def index():
     if session.get('is_gm'):
+        _select_session(request.args.get('session'))
         return render_template('index.html')
     token = request.args.get('token')
-    if token and token == config.GM_SECRET:
+    if token and token == config.GM_SECRET and not message_bus.is_fanout():
         session['is_gm'] = True
-        return redirect(url_for('core.index'))
+        return redirect(url_for('core.index', session=request.args.get('session')))
     return render_template('unauthorized.html'), 403
 
 
@@ -54,6 +76,8 @@ def serve_map_image(filename):
 def serve_generated_map(filename):
     log_prefix = "[serve_generated_map]"; logging.debug(f"{log_prefix} Route hit. Raw: '{filename}'"); safe_filename = secure_filename(filename)
     if safe_filename != filename: logging.warning(f"{log_prefix} Sanitized: '{safe_filename}'")
+    cache_key, _ = composite_cache.key_from_filename(safe_filename)
+    if cache_key is not None: return _serve_composite(safe_filename, cache_key)
     generated_maps_dir = config.GENERATED_MAPS_FOLDER; filepath = os.path.join(generated_maps_dir, safe_filename)
     logging.debug(f"{log_prefix} Path: '{filepath}'"); file_exists = os.path.exists(filepath); is_file = os.path.isfile(filepath)
     logging.debug(f"{log_prefix} Exists: {file_exists}, Is file: {is_file}")
@@ -68,6 +92,20 @@ def serve_generated_map(filename):
     return make_response(jsonify({"error": "Generated map image not found or error"}), status_code)
 
 
+def _serve_composite(filename, cache_key):
+    """Serve a content-addressed composite: strong ETag, immutable caching, 304 on revalidation."""
+    headers = {'ETag': f'"{cache_key}"', 'Cache-Control': 'public, max-age=31536000, immutable', 'Access-Control-Allow-Origin': '*'}
+    if request.if_none_match.contains(cache_key):
+        response = make_response('', 304); response.headers.update(headers); return response
+    data = composite_cache.read_file(filename)
+    if data is None:
+        # Not (yet) on this worker's disk tier — retryable, and never cached as if it were the immutable content
+        logging.debug(f"[serve_generated_map] Composite not cached: {filename}"); response = make_response(jsonify({"error": "Generated map image not available yet"}), 503)
+        response.headers.update({'Retry-After': '1', 'Cache-Control': 'no-store'}); return response
+    response = make_response(data); response.headers['Content-Type'] = encoders.mime_for_ext(filename.rsplit('.', 1)[-1]) or 'application/octet-stream'; response.headers.update(headers)
+    return response
+
+
 @core_bp.route('/filters/<path:filter_id>/<shader_type>')
 def serve_shader(filter_id, shader_type):
     logging.debug(f"Request shader: {filter_id}/{shader_type}"); secured_filter_id=secure_filename(filter_id); secured_shader_type=secure_filename(shader_type)
@@ -103,6 +141,39 @@ def get_tunnel_info():
     return jsonify(tunnel.get_tunnel_info())
 
 
+@core_bp.route('/api/stats', methods=['GET'])
+@gm_required
+def get_stats():
+    """Render worker, token broadcast, message bus, journal and map config cache counters (how many updates were coalesced)."""
+    return jsonify({"render": render_worker.get_stats(), "tokens": token_broadcast.get_stats(), "bus": message_bus.get_stats(), "journal": journal.get_stats(),
+                    "map_configs": helpers.get_config_cache_stats()})
+
+
+@core_bp.route('/api/sessions', methods=['GET'])
+@gm_required
+def list_sessions():
+    sessions = [{"code": game.code, "clients": len(game.image_clients), "has_gm": game.gm_socket_sid is not None,
+                 "map": (game.current_state or {}).get('original_map_path')} for game in state.all_sessions()]
+    return jsonify(sessions)
+
+
+@core_bp.route('/api/sessions', methods=['POST'])
+@gm_required
+def create_session():
+    """Start a new table with a random code and switch this GM's browser to it."""
+    game = state.create_session()
+    session['session_code'] = game.code
+    logging.info(f"Session created: {game.code}")
+    return jsonify({"code": game.code, "default": False}), 201
+
+
+@core_bp.route('/api/sessions/current', methods=['GET'])
+@gm_required
+def get_current_session():
+    game = state.gm_session()
+    return jsonify({"code": game.code, "default": game.code == state.DEFAULT_SESSION})
+
+
 @core_bp.route('/api/maps', methods=['GET'])
 def list_map_content():
     try:
@@ -140,7 +211,7 @@ def get_config(map_filename):
     secured_filename = secure_filename(map_filename); map_file_path = os.path.join(config.MAPS_FOLDER, secured_filename)
     if not helpers.allowed_map_file(secured_filename) or not os.path.exists(map_file_path): return jsonify({"error": "Map not found/invalid"}), 404
     map_state = helpers.get_state_for_map(secured_filename)
-    if map_state: state_to_send = copy.deepcopy(map_state); state_to_send.pop('original_map_path', None); return jsonify(state_to_send)
+    if map_state: state_to_send = fog_codec.unpack_state({k: v for k, v in map_state.items() if k != 'original_map_path'}); return jsonify(state_to_send)
     else: logging.error(f"Failed get/generate state {secured_filename}"); return jsonify({"error": "Could not get/generate config"}), 500
 
 
@@ -150,9 +221,10 @@ def save_config_api(map_filename):
     secured_filename = secure_filename(map_filename); map_file_path = os.path.join(config.MAPS_FOLDER, secured_filename)
     if not helpers.allowed_map_file(secured_filename) or not os.path.exists(map_file_path): return jsonify({"error": "Map not found/invalid"}), 404
     if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
-    config_data = request.get_json(); required_keys = ["map_content_path", "current_filter", "view_state", "filter_params", "fog_of_war"]
+    config_data = fog_codec.pack_state(request.get_json()); required_keys = ["map_content_path", "current_filter", "view_state", "filter_params", "fog_of_war"]
     if not isinstance(config_data, dict) or not all(k in config_data for k in required_keys): return jsonify({"error": "Invalid config structure"}), 400
     fog_data = config_data.get("fog_of_war");
     if not isinstance(fog_data, dict) or not isinstance(fog_data.get("hidden_polygons"), list): return jsonify({"error": "Invalid fog structure"}), 400
+    fog_normalize.normalize_fog_of_war(fog_data)
     if helpers.save_map_config(secured_filename, config_data): logging.info(f"Config saved via API: {secured_filename}"); return jsonify({"success": True}), 200
     else: logging.error(f"Failed save config via API: {map_filename}"); return jsonify({"error": "Could not save config"}), 500
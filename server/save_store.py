@@ -0,0 +1,338 @@
+# server/save_store.py
+# Save repository — the saves table behind per-thread pooled SQLite connections (WAL mode), with revision history
+
+import os
+import json
+import zlib
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from server import config
+from server import filters
+from server import fog_codec
+from server.state_sync import make_patch, apply_patch
+
+# Summary queries select only these, so listing saves never reads the state/tokens blobs
+_SUMMARY_COLUMNS = 'id, name, created_at, modified_at, map_filename'
+
+# Statements are kept as constants: sqlite3 caches the compiled form per connection, keyed by SQL text
+_SQL_READ = 'SELECT * FROM saves WHERE id = ?'
+_SQL_SUMMARY = f'SELECT {_SUMMARY_COLUMNS} FROM saves WHERE id = ?'
+_SQL_LIST = f'SELECT {_SUMMARY_COLUMNS} FROM saves ORDER BY modified_at DESC'
+_SQL_LATEST = 'SELECT * FROM saves ORDER BY modified_at DESC LIMIT 1'
+_SQL_WRITE = 'INSERT OR REPLACE INTO saves (id, name, created_at, modified_at, map_filename, state, tokens) VALUES (?, ?, ?, ?, ?, ?, ?)'
+_SQL_INSERT_IGNORE = 'INSERT OR IGNORE INTO saves (id, name, created_at, modified_at, map_filename, state, tokens) VALUES (?, ?, ?, ?, ?, ?, ?)'
+_SQL_DELETE = 'DELETE FROM saves WHERE id = ?'
+
+# Every write of a save also appends a revision: a full keyframe every SAVE_HISTORY_KEYFRAME_INTERVAL
+# revisions, otherwise a JSON patch against the previous revision — both zlib-compressed JSON.
+# Restoring any revision reads its keyframe plus fewer than SAVE_HISTORY_KEYFRAME_INTERVAL patches.
+_SQL_REVISION_HEAD = "SELECT MAX(rev), MAX(CASE WHEN kind = 'key' THEN rev END) FROM save_revisions WHERE save_id = ?"
+_SQL_INSERT_REVISION = 'INSERT INTO save_revisions (save_id, rev, created_at, kind, data) VALUES (?, ?, ?, ?, ?)'
+_SQL_LIST_REVISIONS = 'SELECT rev, created_at, kind, LENGTH(data) AS size FROM save_revisions WHERE save_id = ? ORDER BY rev DESC'
+_SQL_REVISION_CHAIN = '''SELECT rev, created_at, kind, data FROM save_revisions WHERE save_id = ? AND rev <= ?
+    AND rev >= (SELECT MAX(rev) FROM save_revisions WHERE save_id = ? AND kind = 'key' AND rev <= ?) ORDER BY rev'''
+_SQL_PRUNE_KEYFRAME = "SELECT MAX(rev) FROM save_revisions WHERE save_id = ? AND kind = 'key' AND rev <= ?"
+_SQL_PRUNE_REVISIONS = 'DELETE FROM save_revisions WHERE save_id = ? AND rev < ?'
+_SQL_DELETE_REVISIONS = 'DELETE FROM save_revisions WHERE save_id = ?'
+
+# The threaded server runs each request on a fresh thread, so connections are pooled across
+# threads rather than kept per thread: at most SAVES_DB_POOL_SIZE are ever opened.
+_pool = queue.LifoQueue()    # idle connections; the most recently used one (warmest page cache) goes out first
+_pool_lock = threading.Lock()
+_pool_opened = 0
+_POOL_WAIT_SECONDS = 10
+
+
+def _connect():
+    conn = sqlite3.connect(config.SAVES_DB_PATH, timeout=10, cached_statements=32, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')      # readers never block the writer (and vice versa)
+    conn.execute('PRAGMA synchronous=NORMAL')    # in WAL mode: no fsync per commit, still safe against app crashes
+    conn.execute(f'PRAGMA cache_size=-{config.SAVES_DB_CACHE_KB}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+
+def _checkout():
+    global _pool_opened
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        pass
+    with _pool_lock:
+        if _pool_opened < config.SAVES_DB_POOL_SIZE:
+            _pool_opened += 1
+            opened = True
+        else:
+            opened = False
+    if not opened:
+        return _pool.get(timeout=_POOL_WAIT_SECONDS)  # queue.Empty if every connection stays busy
+    try:
+        return _connect()
+    except Exception:
+        with _pool_lock:
+            _pool_opened -= 1
+        raise
+
+
+@contextmanager
+def _connection():
+    """A pooled connection for the duration of the with block (use `with conn:` inside for a transaction)."""
+    conn = _checkout()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        _pool.put(conn)
+
+
+def _row_to_save(row):
+    return {
+        'id': row['id'],
+        'name': row['name'],
+        'created_at': row['created_at'],
+        'modified_at': row['modified_at'],
+        'map_filename': row['map_filename'],
+        'state': filters.sparse_state(fog_codec.pack_state(json.loads(row['state']))) if row['state'] else {},
+        'tokens': json.loads(row['tokens']) if row['tokens'] else [],
+    }
+
+
+def _row_to_summary(row):
+    return {'id': row['id'], 'name': row['name'], 'created_at': row['created_at'], 'modified_at': row['modified_at'], 'map_filename': row['map_filename']}
+
+
+def _save_params(save_data):
+    return (
+        save_data['id'],
+        save_data['name'],
+        save_data['created_at'],
+        save_data['modified_at'],
+        save_data.get('map_filename', ''),
+        json.dumps(fog_codec.pack_state(filters.sparse_state(save_data.get('state', {}))), ensure_ascii=False),
+        json.dumps(save_data.get('tokens', []), ensure_ascii=False),
+    )
+
+
+def init_db():
+    """Create the saves table and its modified_at index, and migrate any legacy JSON save files."""
+    with _connection() as conn:
+        _create_tables(conn)
+        _migrate_legacy_saves(conn)
+
+
+def _create_tables(conn):
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS saves (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            modified_at TEXT NOT NULL,
+            map_filename TEXT,
+            state TEXT,
+            tokens TEXT
+        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_saves_modified_at ON saves (modified_at)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS save_revisions (
+            save_id TEXT NOT NULL,
+            rev INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (save_id, rev)
+        ) WITHOUT ROWID''')
+
+
+def _migrate_legacy_saves(conn):
+    if os.path.isdir(config.SAVES_FOLDER_LEGACY):
+        json_files = [f for f in os.listdir(config.SAVES_FOLDER_LEGACY) if f.endswith('.json')]
+        if json_files:
+            logging.info(f"Migrating {len(json_files)} legacy JSON save(s) to SQLite...")
+            migrated = 0
+            with conn:
+                for fname in json_files:
+                    fpath = os.path.join(config.SAVES_FOLDER_LEGACY, fname)
+                    try:
+                        with open(fpath, 'r', encoding='utf-8') as f:
+                            data = json.load(f)
+                        conn.execute(_SQL_INSERT_IGNORE, _save_params({
+                            'id': data.get('id', fname.replace('.json', '')),
+                            'name': data.get('name', 'Unnamed'),
+                            'created_at': data.get('created_at', ''),
+                            'modified_at': data.get('modified_at', ''),
+                            'map_filename': data.get('map_filename', ''),
+                            'state': data.get('state', {}),
+                            'tokens': data.get('tokens', []),
+                        }))
+                        migrated += 1
+                    except Exception as e:
+                        logging.warning(f"Could not migrate save file {fname}: {e}")
+            if migrated > 0:
+                migrated_dir = config.SAVES_FOLDER_LEGACY + '_migrated'
+                try:
+                    os.rename(config.SAVES_FOLDER_LEGACY, migrated_dir)
+                    logging.info(f"Migrated {migrated} save(s). Old folder renamed to {migrated_dir}")
+                except OSError as e:
+                    logging.warning(f"Could not rename saves folder after migration: {e}")
+
+
+def read(save_id):
+    """Read a full save (state and tokens decoded) by ID, returning a dict or None."""
+    try:
+        with _connection() as conn:
+            row = conn.execute(_SQL_READ, (save_id,)).fetchone()
+        return _row_to_save(row) if row else None
+    except Exception as e:
+        logging.error(f"Error reading save {save_id}: {e}")
+        return None
+
+
+def read_summary(save_id):
+    """Summary fields of a save (no state/tokens), or None."""
+    try:
+        with _connection() as conn:
+            row = conn.execute(_SQL_SUMMARY, (save_id,)).fetchone()
+        return _row_to_summary(row) if row else None
+    except Exception as e:
+        logging.error(f"Error reading save {save_id}: {e}")
+        return None
+
+
+def read_latest():
+    """The most recently modified full save, or None."""
+    with _connection() as conn:
+        row = conn.execute(_SQL_LATEST).fetchone()
+    return _row_to_save(row) if row else None
+
+
+def list_summaries():
+    """Summary info of all saves, ordered by modified_at DESC."""
+    try:
+        with _connection() as conn:
+            return [_row_to_summary(r) for r in conn.execute(_SQL_LIST)]
+    except Exception as e:
+        logging.error(f"Error listing saves: {e}")
+        return []
+
+
+def write(save_data):
+    """Insert or replace a save, recording the change as a new revision. Returns True on success."""
+    try:
+        with _connection() as conn, conn:
+            previous = conn.execute(_SQL_READ, (save_data['id'],)).fetchone()
+            conn.execute(_SQL_WRITE, _save_params(save_data))
+            _add_revision(conn, save_data, _row_to_save(previous) if previous else None)
+        return True
+    except Exception as e:
+        logging.error(f"Error writing save {save_data.get('id')}: {e}")
+        return False
+
+
+def delete(save_id):
+    """Delete a save by ID. Returns True if a row was deleted."""
+    try:
+        with _connection() as conn, conn:
+            cursor = conn.execute(_SQL_DELETE, (save_id,))
+            conn.execute(_SQL_DELETE_REVISIONS, (save_id,))
+        return cursor.rowcount > 0
+    except Exception as e:
+        logging.error(f"Error deleting save {save_id}: {e}")
+        return False
+
+
+# --- Revision history ---
+
+def _keyed(items):
+    """A list of dicts with unique string ids as {'order', 'by_id'}, so patches touch only the entries that changed."""
+    if not isinstance(items, list):
+        return items
+    ids = [item.get('id') if isinstance(item, dict) else None for item in items]
+    if not all(isinstance(i, str) for i in ids) or len(set(ids)) != len(ids):
+        return items
+    return {'order': ids, 'by_id': dict(zip(ids, items))}
+
+
+def _unkeyed(value):
+    if isinstance(value, dict) and 'order' in value and 'by_id' in value:
+        return [value['by_id'][i] for i in value['order']]
+    return value
+
+
+def _history_doc(save_data):
+    """The part of a save that revisions track, with fog polygons (packed) and tokens keyed by id."""
+    save_state = fog_codec.pack_state(filters.sparse_state(save_data.get('state') or {}))
+    fog = save_state.get('fog_of_war')
+    if isinstance(fog, dict) and 'hidden_polygons' in fog:
+        save_state = dict(save_state, fog_of_war=dict(fog, hidden_polygons=_keyed(fog['hidden_polygons'])))
+    return {'name': save_data.get('name'), 'map_filename': save_data.get('map_filename', ''),
+            'state': save_state, 'tokens': _keyed(save_data.get('tokens') or [])}
+
+
+def _from_history_doc(doc):
+    save_state = doc.get('state') or {}
+    fog = save_state.get('fog_of_war')
+    if isinstance(fog, dict) and 'hidden_polygons' in fog:
+        save_state = dict(save_state, fog_of_war=dict(fog, hidden_polygons=_unkeyed(fog['hidden_polygons'])))
+    return {'name': doc.get('name'), 'map_filename': doc.get('map_filename'), 'state': fog_codec.pack_state(save_state), 'tokens': _unkeyed(doc.get('tokens'))}
+
+
+def _pack(payload):
+    return zlib.compress(json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8'), config.SAVE_HISTORY_COMPRESS_LEVEL)
+
+
+def _unpack(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def _add_revision(conn, save_data, previous):
+    """Append a revision for save_data (previous is the save as stored before this write, or None)."""
+    save_id = save_data['id']
+    head, last_key = conn.execute(_SQL_REVISION_HEAD, (save_id,)).fetchone()
+    doc = _history_doc(save_data)
+    if head is None or last_key is None or previous is None or head - last_key + 1 >= config.SAVE_HISTORY_KEYFRAME_INTERVAL:
+        kind, payload = 'key', doc
+    else:
+        ops = make_patch(_history_doc(previous), doc)
+        if not ops:
+            return
+        kind, payload = 'delta', ops
+    rev = (head or 0) + 1
+    conn.execute(_SQL_INSERT_REVISION, (save_id, rev, save_data['modified_at'], kind, _pack(payload)))
+    if kind == 'key' and config.SAVE_HISTORY_MAX_REVISIONS and rev > config.SAVE_HISTORY_MAX_REVISIONS:
+        # Drop whole keyframe groups, keeping every one of the newest revisions restorable
+        oldest_kept = rev - config.SAVE_HISTORY_MAX_REVISIONS + 1
+        keyframe = conn.execute(_SQL_PRUNE_KEYFRAME, (save_id, oldest_kept)).fetchone()[0]
+        if keyframe is not None:
+            conn.execute(_SQL_PRUNE_REVISIONS, (save_id, keyframe))
+
+
+def list_revisions(save_id):
+    """Revisions of a save, newest first: rev, created_at, kind ('key' or 'delta') and stored size in bytes."""
+    try:
+        with _connection() as conn:
+            return [{'rev': r['rev'], 'created_at': r['created_at'], 'kind': r['kind'], 'size': r['size']} for r in conn.execute(_SQL_LIST_REVISIONS, (save_id,))]
+    except Exception as e:
+        logging.error(f"Error listing revisions of save {save_id}: {e}")
+        return []
+
+
+def read_revision(save_id, rev):
+    """A save as it was at revision rev (name, map_filename, state, tokens), or None."""
+    try:
+        with _connection() as conn:
+            rows = conn.execute(_SQL_REVISION_CHAIN, (save_id, rev, save_id, rev)).fetchall()
+        if not rows or rows[-1]['rev'] != rev:
+            return None
+        doc = None
+        for row in rows:
+            payload = _unpack(row['data'])
+            doc = payload if row['kind'] == 'key' else apply_patch(doc, payload)
+        return dict(_from_history_doc(doc), id=save_id, rev=rev, created_at=rows[-1]['created_at'])
+    except Exception as e:
+        logging.error(f"Error reading revision {rev} of save {save_id}: {e}")
+        return None
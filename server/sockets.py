@@ -4,68 +4,140 @@
 import os
 import re
 import json
-import copy
 import time
-import base64
 import logging
 from uuid import uuid4
 
 from flask import request, session
-from flask_socketio import emit as socketio_emit, join_room, disconnect
+from flask_socketio import emit as socketio_emit, join_room, leave_room, disconnect
 from werkzeug.utils import secure_filename
 
 from server import config
 from server import state
 from server import helpers
-from server.map_gen import generate_player_map_bytes
+from server import filters
+from server import transport
+from server import composite_cache
+from server import render_worker
+from server import fog_codec
+from server import fog_normalize
+from server import fog_ops
+from server import state_sync
+from server import token_broadcast
+from server import message_bus
+from server.map_gen import generate_player_map_frame
+
+
+def _game():
+    """Session the calling socket joined (a GM's socket is bound at connect), or None."""
+    return state.session_for_sid(request.sid)
+
+
+def _join_target(data):
+    """Session a join_game request asks for: its 'session' code, else the GM's own table or the default one."""
+    code = data.get('session') if isinstance(data, dict) else None
+    if code:
+        return state.get_session(code) if isinstance(code, str) else None
+    return state.gm_session() if session.get('is_gm') else state.default_session()
+
+
+# Player events a fan-out worker hands to the authoritative worker (see message_bus)
+FORWARDED_EVENTS = ('disconnect', 'join_game', 'request_state_snapshot', 'request_map_image', 'request_tokens',
+                    'token_place', 'token_move', 'token_remove', 'token_update_color')
+
+
+def _register_fanout_handlers(sio):
+    """Fan-out worker: accept player sockets and forward each of their events to the authoritative worker."""
+
+    @sio.on('connect')
+    def handle_connect():
+        logging.info(f"Client connected: {request.sid}")
+        if session.get('is_gm') and request.args.get('preview') != '1':
+            logging.warning(f"Rejected GM connection on fan-out worker: {request.sid}")
+            disconnect()
+
+    def forwarder(event):
+        def handle_event(*args):
+            # Disconnect handlers receive a reason string, which the authoritative handler doesn't take
+            message_bus.forward(event, request.sid, args[0] if args and event != 'disconnect' else None)
+        return handle_event
+
+    for event in FORWARDED_EVENTS:
+        sio.on(event)(forwarder(event))
 
 
 def register_socket_handlers(sio):
     """Register all SocketIO event handlers on the given SocketIO instance."""
+    if message_bus.is_fanout():
+        _register_fanout_handlers(sio)
+        return
 
     @sio.on('connect')
     def handle_connect():
         logging.info(f"Client connected: {request.sid}")
         is_preview = request.args.get('preview') == '1'
         if session.get('is_gm') and not is_preview:
-            if state.gm_socket_sid is not None:
+            game = state.gm_session()
+            if game.gm_socket_sid is not None:
                 # Already have an active GM — reject this connection
-                logging.warning(f"Rejected duplicate GM connection: {request.sid} (active GM: {state.gm_socket_sid})")
+                logging.warning(f"Rejected duplicate GM connection: {request.sid} (session {game.code}, active GM: {game.gm_socket_sid})")
                 disconnect()
                 return
-            state.gm_socket_sid = request.sid
-            logging.info(f"GM socket registered: {request.sid}")
+            game.gm_socket_sid = request.sid
+            state.bind_sid(request.sid, game)
+            logging.info(f"GM socket registered: {request.sid} (session {game.code})")
 
     @sio.on('disconnect')
     def handle_disconnect():
         logging.info(f"Client disconnected: {request.sid}")
-        if request.sid == state.gm_socket_sid:
-            state.gm_socket_sid = None
-            logging.info("GM socket cleared.")
+        game = state.unbind_sid(request.sid)
+        if game is None:
+            return
+        transport.unregister_client(game, request.sid)
+        if request.sid == game.gm_socket_sid:
+            game.gm_socket_sid = None
+            logging.info(f"GM socket cleared (session {game.code}).")
 
     @sio.on('join_game')
     def handle_join_game(data=None):
-        """Handles a client joining the single game room."""
-        join_room(config.ROOM_NAME)
-        logging.info(f"Client {request.sid} joined room: {config.ROOM_NAME}")
+        """Handles a client joining a game session (by code; the default table without one)."""
+        game = _join_target(data)
+        if game is None:
+            logging.warning(f"Client {request.sid} asked for unknown session {data.get('session')!r}.")
+            socketio_emit('error', {'message': 'Unknown session code'}, to=request.sid)
+            return
+        previous = state.session_for_sid(request.sid)
+        if previous is not None:
+            if request.sid in previous.image_clients:
+                leave_room(transport.image_room(*transport.route_for(previous, request.sid), room=previous.room))
+                transport.unregister_client(previous, request.sid)
+            if previous is not game:
+                leave_room(previous.room)
+        state.bind_sid(request.sid, game)
+        join_room(game.room)
+        image_transport = transport.negotiate_transport(data)
+        image_bucket = transport.negotiate_bucket(data)
+        join_room(transport.image_room(image_transport, image_bucket, room=game.room))
+        transport.register_client(game, request.sid, image_transport, image_bucket)
+        logging.info(f"Client {request.sid} joined room: {game.room} (images: {image_transport}, max size: {image_bucket or 'full'})")
         # Initialize state if needed
-        if state.current_state is None:
-            logging.info("Creating default state for game room.")
-            state.current_state = helpers.get_default_session_state()
+        if game.current_state is None:
+            logging.info(f"Creating default state for session {game.code}.")
+            game.current_state = helpers.get_default_session_state()
         # Generate image bytes in memory
-        image_bytes = None
-        if state.current_state.get('original_map_path'):
-            image_bytes = generate_player_map_bytes(state.current_state)
-        state_to_send = copy.deepcopy(state.current_state)
-        state_to_send['map_content_path'] = 'binary://' if image_bytes else None
-        state_to_send.pop('original_map_path', None)
+        image_bytes = None; image_version = None; encoder = None
+        if game.current_state.get('original_map_path'):
+            image_bytes, image_version, encoder = generate_player_map_frame(game.current_state, game=game, max_size=image_bucket)
         logging.info(f"Sending initial state to {request.sid}. Binary image: {len(image_bytes) if image_bytes else 0} bytes")
-        socketio_emit('state_update', state_to_send, to=request.sid)
-        if image_bytes:
-            b64_data = base64.b64encode(image_bytes).decode('ascii')
-            socketio_emit('map_image_data', {'b64': b64_data}, to=request.sid)
+        state_sync.send_snapshot(game, socketio_emit, request.sid)
+        # With a bus the URL may be served by a fan-out worker, which only sees the disk tier — write it out first
+        if image_bytes and transport.wants_http_images(data) and (not message_bus.is_shared() or composite_cache.flush(image_version, encoder.ext)):
+            # Content-addressed URL: reconnecting players reuse their browser/tunnel cache
+            transport.emit_map_image_url(socketio_emit, composite_cache.url_for(image_version, encoder.ext), to=request.sid, mime=encoder.mime, version=image_version)
+        else:
+            transport.emit_map_image(socketio_emit, image_bytes, to=request.sid, transport=image_transport, mime=encoder and encoder.mime, version=image_version)
         # Send current tokens
-        socketio_emit('tokens_update', {'tokens': state.current_tokens}, to=request.sid)
+        _send_tokens(game, request.sid)
 
     @sio.on('gm_update')
     def handle_gm_update(data):
@@ -74,14 +146,16 @@ def register_socket_handlers(sio):
             logging.warning(f"Non-GM client {request.sid} tried to emit gm_update — rejected.")
             return
         if not isinstance(data, dict) or 'update_data' not in data: logging.warning("Invalid GM update."); return
-        update_delta = data['update_data']
+        game = _game()
+        if game is None: logging.warning(f"GM update from {request.sid} outside any session."); return
+        update_delta = fog_codec.pack_state(data['update_data'])  # fog is kept packed (see fog_codec); the GM may send binary or plain vertices
         # Initialize state if needed
-        if state.current_state is None:
+        if game.current_state is None:
             logging.warning("GM update with no current state. Creating default.")
-            state.current_state = helpers.get_default_session_state()
+            game.current_state = helpers.get_default_session_state()
         logging.debug(f"Received GM update: {json.dumps(update_delta)}")
         try:
-            current_authoritative_state = state.current_state
+            current_authoritative_state = game.current_state
             original_map_path_before_update = current_authoritative_state.get('original_map_path')
             fog_changed = 'fog_of_war' in update_delta
             new_original_map_path = update_delta.get('map_content_path'); map_changed = False; state_to_merge_into = current_authoritative_state
@@ -95,47 +169,109 @@ def register_socket_handlers(sio):
             elif new_original_map_path is None and 'map_content_path' in update_delta:
                 state_to_merge_into = helpers.get_default_session_state(); logging.info("Map reset."); map_changed = True
             if not map_changed:
-                update_delta_copy = copy.deepcopy(update_delta); update_delta_copy.pop('map_content_path', None); updated_state = helpers.merge_dicts(state_to_merge_into, update_delta_copy)
+                update_delta_without_path = {k: v for k, v in update_delta.items() if k != 'map_content_path'}; updated_state = helpers.merge_dicts(state_to_merge_into, update_delta_without_path)
             else: updated_state = helpers.merge_dicts(state_to_merge_into, update_delta)
             if map_changed: updated_state['original_map_path'] = new_original_map_path
             else: updated_state['original_map_path'] = original_map_path_before_update
             updated_state['display_type'] = 'image'
+            if 'filter_params' in update_delta or map_changed:
+                # A param set back to its default drops out, so state_update carries only overrides
+                updated_state['filter_params'] = filters.sparse_params(updated_state.get('filter_params'))
+            if fog_changed:
+                # Lossless only: later fog_ops (and undo/redo/resync lists) address polygons by the GM's ids
+                fog_normalize.normalize_fog_of_war(updated_state.get('fog_of_war'))
+            if fog_changed or map_changed:
+                game.fog_revision += 1
 
-            image_bytes = None
             regenerate_image = map_changed or fog_changed
-            if regenerate_image and updated_state.get('original_map_path'):
-                logging.info(f"Regenerating map image (in memory) because map_changed={map_changed} or fog_changed={fog_changed}")
-                image_bytes = generate_player_map_bytes(updated_state)
 
             # Players should never receive the raw file path — always use binary sentinel
             # so they keep the fog-composited texture from the last map_image_data event.
             has_map = bool(updated_state.get('original_map_path'))
             updated_state['map_content_path'] = 'binary://' if has_map else None
-            state.current_state = updated_state
+            game.current_state = updated_state
             logging.debug("Authoritative state updated.")
 
-            state_to_send = copy.deepcopy(updated_state)
-            state_to_send.pop('original_map_path', None)
-            state_to_send['map_content_path'] = 'binary://' if has_map else None
-            if image_bytes:
-                logging.info(f"Broadcasting update with {len(image_bytes)} bytes binary image.")
-            elif not regenerate_image:
-                logging.debug("Broadcasting metadata-only update.")
+            # Metadata goes out immediately as a diff against the last version; the image follows from the render worker
+            state_sync.publish(game, socketio_emit)
+            if regenerate_image and has_map:
+                logging.info(f"Queueing map render because map_changed={map_changed} or fog_changed={fog_changed}")
+                render_worker.submit(game, updated_state, full_image=map_changed)
+            elif regenerate_image:
+                render_worker.invalidate(game)
             else:
-                logging.warning("Image regeneration was needed but produced no bytes.")
-            socketio_emit('state_update', state_to_send, room=config.ROOM_NAME)
-            if image_bytes:
-                b64_data = base64.b64encode(image_bytes).decode('ascii')
-                socketio_emit('map_image_data', {'b64': b64_data}, room=config.ROOM_NAME)
-            logging.debug("Broadcasted state_update.")
+                logging.debug("Broadcasting metadata-only update.")
+            logging.debug("Broadcasted state_patch.")
         except Exception as e: logging.error(f"Error processing GM update: {e}", exc_info=True)
 
+    @sio.on('fog_ops')
+    def handle_fog_ops(data):
+        """Apply add/update/delete/reorder fog operations keyed by polygon id (see fog_ops.apply_ops)."""
+        if not session.get('is_gm'):
+            logging.warning(f"Non-GM client {request.sid} tried to emit fog_ops — rejected.")
+            return
+        ops = data.get('ops') if isinstance(data, dict) else None
+        if not isinstance(ops, list) or not ops: logging.warning("Invalid fog_ops payload."); return
+        game = _game()
+        if game is None: logging.warning(f"fog_ops from {request.sid} outside any session."); return
+        if game.current_state is None:
+            logging.warning("fog_ops with no current state. Creating default.")
+            game.current_state = helpers.get_default_session_state()
+        try:
+            map_path = game.current_state.get('original_map_path')
+            new_fog, changed_ids, reordered = fog_ops.apply_ops(game.current_state.get('fog_of_war'), ops)
+            # Shallow copy: the previous state object may still be rendering
+            updated_state = dict(game.current_state); updated_state['fog_of_war'] = new_fog
+            base_revision = game.fog_revision
+            game.fog_revision += 1
+            game.current_state = updated_state
+            logging.debug(f"Applied {len(ops)} fog op(s), {len(changed_ids)} polygon(s) changed.")
+            # Players only see fog through the composited image, so no state_update is needed
+            if map_path and (changed_ids or reordered):
+                fog_hint = None if reordered else {'base': base_revision, 'rev': game.fog_revision, 'ids': frozenset(changed_ids)}
+                render_worker.submit(game, updated_state, fog_hint=fog_hint)
+        except Exception as e: logging.error(f"Error applying fog ops: {e}", exc_info=True)
+
+    @sio.on('request_state_snapshot')
+    def handle_request_state_snapshot(data=None):
+        """Resend the full versioned state to one client (it saw a gap in state_patch versions)."""
+        game = _game()
+        if game is None:
+            return
+        logging.info(f"Sending state snapshot to {request.sid}.")
+        state_sync.send_snapshot(game, socketio_emit, request.sid)
+
+    @sio.on('request_map_image')
+    def handle_request_map_image(data=None):
+        """Resend the full current map image to one client (e.g. after it missed a tile patch)."""
+        game = _game()
+        if game is None or game.current_state is None or not game.current_state.get('original_map_path'):
+            return
+        image_transport, image_bucket = transport.route_for(game, request.sid)
+        image_bytes, image_version, encoder = generate_player_map_frame(game.current_state, game=game, max_size=image_bucket)
+        logging.info(f"Resending full map image to {request.sid} (version {image_version}).")
+        transport.emit_map_image(socketio_emit, image_bytes, to=request.sid, transport=image_transport, mime=encoder and encoder.mime, version=image_version)
+
     # --- Token Socket Event Handlers ---
+    # Changes are coalesced into per-tick 'tokens_delta' batches (see token_broadcast); the full list only on join/resync.
+
+    def _send_tokens(game, sid):
+        with game.current_tokens.lock:
+            seq, tokens = game.current_tokens.snapshot()
+            socketio_emit('tokens_update', {'seq': seq, 'tokens': tokens}, to=sid)
+
+    @sio.on('request_tokens')
+    def handle_request_tokens(data=None):
+        """Resend the full token list to one client (it saw a gap in token delta seqs)."""
+        game = _game()
+        if game is not None:
+            _send_tokens(game, request.sid)
 
     @sio.on('token_place')
     def handle_token_place(data):
         """Place a new token on the map."""
-        if not isinstance(data, dict):
+        game = _game()
+        if game is None or not isinstance(data, dict):
             return
         token_data = data.get('token')
         if not isinstance(token_data, dict):
@@ -156,46 +292,50 @@ def register_socket_handlers(sio):
             'x': x,
             'y': y
         }
-        state.current_tokens.append(new_token)
+        with game.current_tokens.lock:
+            game.current_tokens.add(new_token)
+            token_broadcast.mark_changed(game, token_id)
         logging.info(f"Token placed: {token_id} by {request.sid}")
-        socketio_emit('tokens_update', {'tokens': state.current_tokens}, room=config.ROOM_NAME)
 
     @sio.on('token_move')
     def handle_token_move(data):
         """Move an existing token."""
-        if not isinstance(data, dict):
+        game = _game()
+        if game is None or not isinstance(data, dict):
             return
         token_id = data.get('token_id')
         x = data.get('x')
         y = data.get('y')
         if not token_id or x is None or y is None:
             return
-        for token in state.current_tokens:
-            if token['id'] == token_id:
-                token['x'] = max(0.0, min(1.0, float(x)))
-                token['y'] = max(0.0, min(1.0, float(y)))
-                logging.debug(f"Token moved: {token_id} to ({token['x']:.3f}, {token['y']:.3f})")
-                socketio_emit('tokens_update', {'tokens': state.current_tokens}, room=config.ROOM_NAME)
+        x = max(0.0, min(1.0, float(x)))
+        y = max(0.0, min(1.0, float(y)))
+        with game.current_tokens.lock:
+            if game.current_tokens.update(token_id, x=x, y=y) is None:
                 return
+            token_broadcast.mark_changed(game, token_id)
+        logging.debug(f"Token moved: {token_id} to ({x:.3f}, {y:.3f})")
 
     @sio.on('token_remove')
     def handle_token_remove(data):
         """Remove a token from the map."""
-        if not isinstance(data, dict):
+        game = _game()
+        if game is None or not isinstance(data, dict):
             return
         token_id = data.get('token_id')
         if not token_id:
             return
-        before = len(state.current_tokens)
-        state.current_tokens = [t for t in state.current_tokens if t['id'] != token_id]
-        if len(state.current_tokens) < before:
-            logging.info(f"Token removed: {token_id}")
-            socketio_emit('tokens_update', {'tokens': state.current_tokens}, room=config.ROOM_NAME)
+        with game.current_tokens.lock:
+            if game.current_tokens.remove(token_id) is None:
+                return
+            token_broadcast.mark_changed(game, token_id)
+        logging.info(f"Token removed: {token_id}")
 
     @sio.on('token_update_color')
     def handle_token_update_color(data):
         """Update a token's color."""
-        if not isinstance(data, dict):
+        game = _game()
+        if game is None or not isinstance(data, dict):
             return
         token_id = data.get('token_id')
         color = data.get('color')
@@ -203,9 +343,15 @@ def register_socket_handlers(sio):
             return
         if not isinstance(color, str) or not re.match(r'^#[0-9a-fA-F]{6}$', color):
             return
-        for token in state.current_tokens:
-            if token['id'] == token_id:
-                token['color'] = color
-                logging.info(f"Token color updated: {token_id} to {color}")
-                socketio_emit('tokens_update', {'tokens': state.current_tokens}, room=config.ROOM_NAME)
+        with game.current_tokens.lock:
+            if game.current_tokens.update(token_id, color=color) is None:
                 return
+            token_broadcast.mark_changed(game, token_id)
+        logging.info(f"Token color updated: {token_id} to {color}")
+
+    message_bus.serve_forwarded({
+        'disconnect': handle_disconnect, 'join_game': handle_join_game,
+        'request_state_snapshot': handle_request_state_snapshot, 'request_map_image': handle_request_map_image,
+        'request_tokens': handle_request_tokens, 'token_place': handle_token_place, 'token_move': handle_token_move,
+        'token_remove': handle_token_remove, 'token_update_color': handle_token_update_color,
+    })
@@ -1,7 +1,115 @@
 # server/state.py
-# Shared mutable globals — accessed via `from server import state` then `state.X`
+# Game sessions — one GameSession per table, accessed via `from server import state`
 
-current_state = None      # dict or None
-current_tokens = []       # [token_dict, ...]
-current_save_id = None    # ID of the currently loaded save file
-gm_socket_sid = None      # SID of the active GM socket connection
+import re
+import secrets
+import threading
+
+from flask import session as flask_session
+
+from server import config
+from server.token_store import TokenStore
+
+DEFAULT_SESSION = 'default'  # the table players reach without a session code
+SESSION_CODE_RE = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+_CODE_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'  # no 0/O or 1/I, so codes survive being read aloud
+
+
+class GameSession:
+    """
+    One table: its authoritative state, tokens, GM and the sync/render bookkeeping
+    of state_sync, token_broadcast, render_worker and journal. Decoded maps, filters and
+    composites are cached process-wide and shared by every session.
+    """
+
+    def __init__(self, code):
+        self.code = code
+        self.room = config.ROOM_NAME if code == DEFAULT_SESSION else f"{config.ROOM_NAME}:{code}"
+        self.current_state = None      # dict or None — replaced, never mutated in place (subtrees are shared, see helpers.merge_dicts)
+        self.current_tokens = TokenStore()  # token id -> token_dict, in placement order
+        self.current_save_id = None    # ID of the currently loaded save file
+        self.gm_socket_sid = None      # SID of the active GM socket connection
+        self.image_clients = {}        # SID -> (transport, resolution bucket) negotiated at join_game
+        self.fog_revision = 0          # bumped on every fog change; lets renders trust fog operation hints
+        # state_sync
+        self.sync_lock = threading.Lock()
+        self.state_version = 0
+        self.last_player_view = None
+        # token_broadcast (guarded by current_tokens.lock)
+        self.tokens_dirty = {}
+        self.tokens_sent_seq = 0
+        # render_worker (guarded by its condition)
+        self.render_generation = 0
+        self.carry_patch = None
+        self.fog_frame = None          # last composited player frame (see map_gen), guarded by map_gen._frames_lock
+        # journal (owned by its writer thread)
+        self.journaled_state = None
+        self.journaled_tokens = None
+        self.journaled_tokens_seq = -1
+        self.journaled_save_id = None
+        self.persisted_state = None
+        self.persisted_tokens_seq = 0
+
+
+_sessions = {}            # code -> GameSession
+_sid_sessions = {}        # SID -> GameSession the socket joined (or, for a GM, connected to)
+_lock = threading.Lock()
+
+
+def get_session(code):
+    """The session with this code, or None."""
+    with _lock:
+        return _sessions.get(code)
+
+
+def get_or_create_session(code):
+    """The session with this code, created empty if it doesn't exist yet. Raises ValueError for a malformed code."""
+    if not isinstance(code, str) or not SESSION_CODE_RE.match(code):
+        raise ValueError(f"Invalid session code {code!r}")
+    with _lock:
+        game = _sessions.get(code)
+        if game is None:
+            game = _sessions[code] = GameSession(code)
+        return game
+
+
+def create_session():
+    """A new session with a fresh random code."""
+    while True:
+        code = ''.join(secrets.choice(_CODE_ALPHABET) for _ in range(6))
+        with _lock:
+            if code not in _sessions:
+                game = _sessions[code] = GameSession(code)
+                return game
+
+
+def default_session():
+    return get_or_create_session(DEFAULT_SESSION)
+
+
+def all_sessions():
+    with _lock:
+        return list(_sessions.values())
+
+
+def gm_session():
+    """Session the requesting GM works in (kept in the Flask session cookie; the default table if unset)."""
+    code = flask_session.get('session_code')
+    game = get_session(code) if code else None
+    return game or default_session()
+
+
+def bind_sid(sid, game):
+    with _lock:
+        _sid_sessions[sid] = game
+
+
+def unbind_sid(sid):
+    with _lock:
+        return _sid_sessions.pop(sid, None)
+
+
+def session_for_sid(sid):
+    """Session a socket belongs to, or None before it joined one."""
+    with _lock:
+        return _sid_sessions.get(sid)
@@ -0,0 +1,116 @@
+# server/state_sync.py
+# Versioned player state — broadcasts JSON-patch (RFC 6902) diffs, full snapshots on join or request
+
+import logging
+
+# Authoritative-only keys players never receive. Fog reaches players solely through the composited image.
+_PRIVATE_KEYS = ('original_map_path', 'fog_of_war')
+
+# Per session (see state.GameSession): state_version is bumped once per published change, and
+# last_player_view is the view at that version — the base every patch is computed against.
+
+
+def player_view(game_state):
+    """
+    Project the authoritative state to what players receive.
+    Shallow: nested values are shared, which is safe because state changes
+    always swap in new objects (merge_dicts copies) instead of mutating them.
+    """
+    if not game_state:
+        return {}
+    view = {k: v for k, v in game_state.items() if k not in _PRIVATE_KEYS}
+    view['map_content_path'] = 'binary://' if game_state.get('original_map_path') else None
+    return view
+
+
+def _pointer(path, key):
+    return f"{path}/{str(key).replace('~', '~0').replace('/', '~1')}"
+
+
+def make_patch(old, new, path=''):
+    """
+    Minimal JSON patch turning old into new. Dicts are diffed key by key;
+    anything else (lists included) is replaced whole when it differs.
+    """
+    if old is new:
+        return []
+    if not (isinstance(old, dict) and isinstance(new, dict)):
+        if old == new and type(old) is type(new):
+            return []
+        return [{'op': 'replace', 'path': path, 'value': new}]
+    ops = []
+    for key, value in new.items():
+        if key not in old:
+            ops.append({'op': 'add', 'path': _pointer(path, key), 'value': value})
+        else:
+            ops.extend(make_patch(old[key], value, _pointer(path, key)))
+    for key in old:
+        if key not in new:
+            ops.append({'op': 'remove', 'path': _pointer(path, key)})
+    return ops
+
+
+def apply_patch(doc, ops):
+    """
+    Apply a make_patch() result. Copy-on-write like helpers.merge_dicts: the dicts along each
+    changed path are copied, everything else is shared, and doc itself is left untouched.
+    """
+    for op in ops:
+        keys = [k.replace('~1', '/').replace('~0', '~') for k in op['path'].split('/')[1:]]
+        doc = _apply_op(doc, keys, op) if keys else op.get('value')
+    return doc
+
+
+def _apply_op(node, keys, op):
+    node = dict(node)
+    if len(keys) > 1:
+        node[keys[0]] = _apply_op(node[keys[0]], keys[1:], op)
+    elif op['op'] == 'remove':
+        node.pop(keys[0], None)
+    else:
+        node[keys[0]] = op['value']
+    return node
+
+
+def _sync(game):
+    """Bring game.last_player_view up to date with its state; returns (base_version, ops) or None if unchanged."""
+    view = player_view(game.current_state)
+    if game.last_player_view is None:
+        game.last_player_view = view
+        return None
+    ops = make_patch(game.last_player_view, view)
+    if not ops:
+        return None
+    base = game.state_version
+    game.state_version += 1
+    game.last_player_view = view
+    return base, ops
+
+
+def publish(game, emit_fn):
+    """
+    Broadcast the change since the session's last published version as a
+    'state_patch' {base, version, ops}. Nothing is sent when the player view didn't change.
+    """
+    with game.sync_lock:
+        result = _sync(game)
+        if result is None:
+            return game.state_version
+        base, ops = result
+        # Emitted under the lock so players always see versions in order
+        emit_fn('state_patch', {'base': base, 'version': game.state_version, 'ops': ops}, room=game.room)
+    logging.debug(f"state_sync: Published version {game.state_version} of session {game.code} ({len(ops)} op(s)).")
+    return game.state_version
+
+
+def send_snapshot(game, emit_fn, to):
+    """Send the session's full player view, tagged with its version, to one client as 'state_update'."""
+    with game.sync_lock:
+        result = _sync(game)
+        if result is not None:
+            # Unpublished change (e.g. a save auto-loaded at startup) — tell everyone else too
+            base, ops = result
+            emit_fn('state_patch', {'base': base, 'version': game.state_version, 'ops': ops}, room=game.room)
+        snapshot = dict(game.last_player_view)
+        snapshot['state_version'] = game.state_version
+        emit_fn('state_update', snapshot, to=to)
@@ -0,0 +1,81 @@
+# server/tiles.py
+# Tiled player map delivery — per-tile content hashes and changed-tile patches
+
+import hashlib
+import logging
+
+from server import config
+from server import render_pool
+from server import encoders
+
+
+def tile_rects(size, tile_size):
+    """All tile rectangles (left, top, right, bottom) covering an image of the given size."""
+    width, height = size
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in range(0, height, tile_size)
+            for x in range(0, width, tile_size)]
+
+
+def _intersects_any(rect, rects):
+    return any(rect[0] < r[2] and r[0] < rect[2] and rect[1] < r[3] and r[1] < rect[3] for r in rects)
+
+
+def _tile_hash(image, rect):
+    return hashlib.blake2b(image.crop(rect).tobytes(), digest_size=16).digest()
+
+
+def _encode_tile(image, rect, encoder):
+    return encoders.encode(image.crop(rect), encoder)
+
+
+def diff_tiles(frame, tile_size, encoder):
+    """
+    Rehash the tiles of a composited frame that may have changed since the last
+    diff and return a patch of the ones whose content hash differs, encoded with encoder:
+        {'base_version', 'version', 'width', 'height', 'tile_size', 'mime', 'tiles': [{'x', 'y', 'w', 'h', 'bytes'}]}
+    Returns None when there is no baseline yet or too much changed for a patch to pay off.
+    Mutates the frame's tile bookkeeping; caller must hold the frame lock.
+    """
+    image = frame['image']
+    all_rects = tile_rects(image.size, tile_size)
+    old_hashes = frame['tile_hashes']
+    base_version = frame['tile_version']
+    pending = frame['pending_dirty']
+    if old_hashes is None or pending is None:
+        candidates = all_rects
+    else:
+        candidates = [rect for rect in all_rects if _intersects_any(rect, pending)]
+
+    new_hashes = dict(old_hashes or {})
+    changed = []
+    for rect in candidates:
+        digest = _tile_hash(image, rect)
+        if new_hashes.get(rect) != digest:
+            new_hashes[rect] = digest
+            changed.append(rect)
+    frame['tile_hashes'] = new_hashes
+    frame['tile_version'] = frame['version']
+    frame['pending_dirty'] = []
+
+    if old_hashes is None or base_version is None:
+        return None
+    if len(changed) > len(all_rects) * config.MAP_TILE_MAX_PATCH_FRACTION:
+        logging.debug(f"diff_tiles: {len(changed)}/{len(all_rects)} tiles changed — sending full image instead.")
+        return None
+    encode_pool = render_pool.get_encode_pool()
+    if encode_pool is not None and len(changed) > 1:
+        encoded = list(encode_pool.map(lambda r: _encode_tile(image, r, encoder), changed))
+    else:
+        encoded = [_encode_tile(image, r, encoder) for r in changed]
+    patch_tiles = [{'x': r[0], 'y': r[1], 'w': r[2] - r[0], 'h': r[3] - r[1], 'bytes': data} for r, data in zip(changed, encoded)]
+    logging.info(f"diff_tiles: {len(changed)}/{len(all_rects)} tile(s) changed, {sum(len(t['bytes']) for t in patch_tiles)} bytes.")
+    return {
+        'base_version': base_version,
+        'version': frame['version'],
+        'width': image.width,
+        'height': image.height,
+        'tile_size': tile_size,
+        'mime': encoder.mime,
+        'tiles': patch_tiles,
+    }
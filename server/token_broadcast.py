@@ -0,0 +1,91 @@
+# server/token_broadcast.py
+# Tick-based token broadcasts — changes within a tick are coalesced per token into one 'tokens_delta'
+
+import time
+import logging
+import threading
+
+from server import config
+from server import state
+
+# Module-level socketio reference — set by init_token_broadcast()
+_socketio = None
+
+# Per session (see state.GameSession): tokens_dirty holds ids of tokens placed / moved / recoloured /
+# removed since the last broadcast (a dict keeps first-change order), tokens_sent_seq the token store
+# seq that broadcast covered. Both are guarded by the session's current_tokens.lock.
+_thread = None
+_stats = {"changes": 0, "coalesced": 0, "broadcasts": 0, "tokens_sent": 0}
+
+
+def init_token_broadcast(socketio_instance):
+    """Called from create_app() to provide the socketio reference and start the tick thread."""
+    global _socketio, _thread
+    _socketio = socketio_instance
+    if config.TOKEN_BROADCAST_HZ > 0 and _thread is None:
+        _thread = threading.Thread(target=_tick_loop, name='token-broadcast', daemon=True)
+        _thread.start()
+
+
+def mark_changed(game, token_id):
+    """
+    Record a change to token_id in a session (call right after mutating game.current_tokens).
+    With ticks disabled the delta goes out immediately.
+    """
+    with game.current_tokens.lock:
+        _stats["changes"] += 1
+        if token_id in game.tokens_dirty:
+            _stats["coalesced"] += 1
+        game.tokens_dirty[token_id] = True
+        if config.TOKEN_BROADCAST_HZ <= 0:
+            flush(game)
+
+
+def mark_synced(game):
+    """Everything up to the current seq went out as a full 'tokens_update' (save load) — drop pending changes."""
+    with game.current_tokens.lock:
+        game.tokens_dirty.clear()
+        game.tokens_sent_seq = game.current_tokens.seq
+
+
+def flush(game):
+    """
+    Broadcast a session's pending changes as 'tokens_delta' {base, seq, changed, removed}: the
+    final version of each changed token and the ids of removed ones. A client at any seq in
+    [base, seq) can apply it; one below base missed a delta and must request the full list.
+    """
+    store = game.current_tokens
+    with store.lock:
+        if not game.tokens_dirty or _socketio is None:
+            return
+        changed = []; removed = []
+        for token_id in game.tokens_dirty:
+            token = store.get(token_id)
+            if token is None:
+                removed.append(token_id)
+            else:
+                changed.append(token)
+        payload = {'base': game.tokens_sent_seq, 'seq': store.seq, 'changed': changed, 'removed': removed}
+        game.tokens_dirty.clear()
+        game.tokens_sent_seq = store.seq
+        _stats["broadcasts"] += 1
+        _stats["tokens_sent"] += len(changed) + len(removed)
+        # Emitted under the store lock so deltas leave in seq order
+        _socketio.emit('tokens_delta', payload, room=game.room)
+
+
+def get_stats():
+    return dict(_stats, pending=sum(len(game.tokens_dirty) for game in state.all_sessions()))
+
+
+def _tick_loop():
+    logging.info(f"token_broadcast: Started ({config.TOKEN_BROADCAST_HZ} Hz).")
+    interval = 1.0 / config.TOKEN_BROADCAST_HZ
+    while True:
+        started = time.monotonic()
+        for game in state.all_sessions():
+            try:
+                flush(game)
+            except Exception as e:
+                logging.error(f"token_broadcast: Broadcast for session {game.code} failed: {e}", exc_info=True)
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
@@ -0,0 +1,70 @@
+# server/token_store.py
+# Tokens indexed by ID (insertion-ordered), with a sequence number bumped on every change
+
+import copy
+import threading
+
+
+class TokenStore:
+    """
+    Tokens keyed by id in placement order. Every mutation bumps `seq`, which is
+    sent with each delta so clients can detect a missed one and ask for the full list.
+    Hold `lock` around a mutation and its broadcast to keep deltas in sequence order.
+    """
+
+    def __init__(self, tokens=None):
+        self.lock = threading.RLock()
+        self.seq = 0
+        self._tokens = {}
+        if tokens:
+            self.replace_all(tokens)
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __contains__(self, token_id):
+        return token_id in self._tokens
+
+    def get(self, token_id):
+        return self._tokens.get(token_id)
+
+    def to_list(self):
+        """Copies of all tokens in placement order — safe to persist or hand to another thread."""
+        with self.lock:
+            return copy.deepcopy(list(self._tokens.values()))
+
+    def snapshot(self):
+        """(seq, token list) for a full 'tokens_update'."""
+        with self.lock:
+            return self.seq, list(self._tokens.values())
+
+    def replace_all(self, tokens):
+        """Replace every token (save load). Entries without an id are dropped."""
+        with self.lock:
+            self._tokens = {t['id']: copy.deepcopy(t) for t in tokens if isinstance(t, dict) and t.get('id')}
+            self.seq += 1
+            return self.seq
+
+    def add(self, token):
+        with self.lock:
+            self._tokens[token['id']] = token
+            self.seq += 1
+            return self.seq
+
+    def update(self, token_id, **fields):
+        """Set fields on a token; returns the new seq, or None if the token doesn't exist or nothing changed."""
+        with self.lock:
+            token = self._tokens.get(token_id)
+            if token is None or all(token.get(k) == v for k, v in fields.items()):
+                return None
+            token.update(fields)
+            self.seq += 1
+            return self.seq
+
+    def remove(self, token_id):
+        """Remove a token; returns the new seq, or None if it didn't exist."""
+        with self.lock:
+            if self._tokens.pop(token_id, None) is None:
+                return None
+            self.seq += 1
+            return self.seq
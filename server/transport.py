@@ -0,0 +1,103 @@
+# server/transport.py
+# Player map image delivery — raw bytes as Socket.IO binary attachments, base64 for legacy clients
+
+import base64
+
+from server import config
+
+TRANSPORT_BINARY = 'binary'
+TRANSPORT_BASE64 = 'base64'
+
+
+def image_room(transport, bucket=None, room=None):
+    """Socket.IO room that receives a session's map images in the given transport and resolution bucket."""
+    return f"{room or config.ROOM_NAME}:img:{transport}:{bucket or 'full'}"
+
+
+def negotiate_transport(join_data):
+    """Pick the image transport for a joining client from its join_game payload."""
+    wants_binary = isinstance(join_data, dict) and join_data.get('binary_images') is True
+    if wants_binary and config.MAP_IMAGE_TRANSPORT == TRANSPORT_BINARY:
+        return TRANSPORT_BINARY
+    return TRANSPORT_BASE64
+
+
+def negotiate_bucket(join_data):
+    """
+    Pick a resolution bucket (max long edge in pixels) from the viewport a client reports:
+        {'viewport': {'width': css_px, 'height': css_px, 'pixel_ratio': dpr}}
+    Returns None (full resolution) when the client doesn't say or needs more than the largest bucket.
+    """
+    viewport = join_data.get('viewport') if isinstance(join_data, dict) else None
+    if not isinstance(viewport, dict) or not config.PLAYER_RESOLUTION_BUCKETS:
+        return None
+    try:
+        pixel_ratio = float(viewport.get('pixel_ratio', 1) or 1)
+        needed = max(float(viewport['width']), float(viewport['height'])) * pixel_ratio
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not needed > 0:
+        return None
+    for bucket in sorted(config.PLAYER_RESOLUTION_BUCKETS):
+        if needed <= bucket:
+            return bucket
+    return None
+
+
+def wants_http_images(join_data):
+    """True when the joining client can fetch composites by URL (and HTTP delivery is enabled)."""
+    return config.COMPOSITE_HTTP_DELIVERY and isinstance(join_data, dict) and join_data.get('http_images') is True
+
+
+def register_client(game, sid, transport, bucket=None):
+    """Remember each client's (transport, bucket) route so we only render and encode what someone needs."""
+    game.image_clients[sid] = (transport, bucket)
+
+
+def unregister_client(game, sid):
+    game.image_clients.pop(sid, None)
+
+
+def route_for(game, sid):
+    """(transport, bucket) a registered client of a session negotiated at join time."""
+    return game.image_clients.get(sid, (TRANSPORT_BASE64, None))
+
+
+def active_routes(game):
+    """Set of (transport, bucket) routes with at least one connected client in a session."""
+    return set(game.image_clients.values())
+
+
+def _payload(image_bytes, transport, mime, version=None):
+    if transport == TRANSPORT_BINARY:
+        payload = {'bytes': image_bytes, 'mime': mime}
+    else:
+        payload = {'b64': base64.b64encode(image_bytes).decode('ascii'), 'mime': mime}
+    if version is not None:
+        payload['version'] = version
+    return payload
+
+
+def emit_map_image(emit_fn, image_bytes, to=None, transport=None, bucket=None, mime='image/jpeg', version=None, room=None):
+    """
+    Send a map image via emit_fn (flask_socketio.emit or SocketIO.emit).
+    With `to`, sends to a single client; otherwise broadcasts to the image room of
+    the (transport, bucket) route in the session room `room`. transport defaults to base64.
+    """
+    if not image_bytes:
+        return
+    payload = _payload(image_bytes, transport or TRANSPORT_BASE64, mime, version)
+    if to is not None:
+        emit_fn('map_image_data', payload, to=to)
+    else:
+        emit_fn('map_image_data', payload, room=image_room(transport or TRANSPORT_BASE64, bucket, room))
+
+
+def emit_map_image_url(emit_fn, url, to, mime='image/jpeg', version=None):
+    """Point one client at a cacheable composite URL instead of pushing the bytes."""
+    emit_fn('map_image_url', {'url': url, 'mime': mime, 'version': version}, to=to)
+
+
+def emit_map_tiles(emit_fn, patch, room=None):
+    """Broadcast a changed-tile patch (see tiles.diff_tiles) to a session's full-resolution binary clients."""
+    emit_fn('map_tiles', patch, room=image_room(TRANSPORT_BINARY, room=room))
@@ -5,6 +5,7 @@
 let lanIp = null;
 let lanPort = 5000;
 let tunnelUrl = null;
+let sessionCode = null; // null = default table (plain /player link)
 let availableFilters = {};
 let mapList = [];
 let currentState = {}; // Holds the full state including filters, view, fog
@@ -74,6 +75,14 @@ const DEBOUNCE_DELAY = 1500;
 let _pendingUpdate = null;
 let _sendThrottleTimer = null;
 const SEND_THROTTLE_MS = 150;
+let _pendingFogOps = [];
+let _fogOpsTimer = null;
+let _fogResyncNeeded = false;
+let _emitChain = Promise.resolve();     // packing is async; emits still leave in call order
+// Fog vertices go out packed (see server/fog_codec.py): int32 x0, y0, dx1, dy1, ... in 1/65536ths
+// of the map, zlib-deflated, as binary attachments. Browsers without CompressionStream send plain vertices.
+const FOG_QUANT_SCALE = 65536;
+const FOG_PACKING = typeof CompressionStream !== 'undefined';
 
 // --- Token State ---
 let isTokenModeEnabled = false;
@@ -152,6 +161,7 @@ document.addEventListener('DOMContentLoaded', async () => {
         await populateMapList(); // Populates mapList and mapSelect dropdown
 
         console.log("Setting up UI, WebSocket, Listeners...");
+        fetchSessionInfo(); // Session code for the player links
         fetchLanInfo(); // Fetch and display LAN player URL
         startTunnelPolling(); // Poll for Cloudflare tunnel URL
         connectWebSocket();
@@ -258,7 +268,11 @@ function connectWebSocket() {
     socket.on('connect', () => {
         console.log(`WebSocket connected: ${socket.id}`);
         // Join the single game room
-        socket.emit('join_game');
+        socket.emit('join_game', { binary_images: true });
+        if (_fogResyncNeeded && currentState?.fog_of_war) {
+            _fogResyncNeeded = false;
+            throttledSendUpdate({ fog_of_war: currentState.fog_of_war });
+        }
     });
     socket.on('disconnect', (reason) => {
         console.warn(`WebSocket disconnected: ${reason}`);
@@ -497,7 +511,7 @@ async function loadMapDataForGM(filename) {
             scale: 1.0
         };
         currentState.current_filter = currentState.current_filter || (availableFilters['none'] ? 'none' : Object.keys(availableFilters)[0] || '');
-        currentState.filter_params = currentState.filter_params || get_default_filter_params();
+        currentState.filter_params = currentState.filter_params || {};
         currentState.fog_of_war = currentState.fog_of_war || {
             hidden_polygons: []
         };
@@ -587,10 +601,8 @@ function updateFilterControls() {
     for (const paramKey in filterDef.params) {
         if (paramKey === 'backgroundImageFilename') continue;
         const paramConfig = filterDef.params[paramKey];
+        // Only overrides are stored; anything else is the filter's default
         const currentVal = currentParams[paramKey] ?? paramConfig.value;
-        if (currentParams[paramKey] === undefined) {
-            currentParams[paramKey] = paramConfig.value;
-        }
         const div = document.createElement('div');
         const label = document.createElement('label');
         label.htmlFor = `param-${paramKey}`;
@@ -760,17 +772,6 @@ function handleFilterChange(event) {
     console.log(`Selected: ${newFilterId}`);
     currentState.current_filter = newFilterId;
     currentState.filter_params = currentState.filter_params || {};
-    if (!currentState.filter_params[newFilterId]) {
-        const filterDef = availableFilters[newFilterId];
-        currentState.filter_params[newFilterId] = {};
-        if (filterDef?.params) {
-            for (const key in filterDef.params) {
-                if (key !== 'backgroundImageFilename' && filterDef.params[key].value !== undefined) {
-                    currentState.filter_params[newFilterId][key] = filterDef.params[key].value;
-                }
-            }
-        }
-    }
     updateFilterControls();
     const payload = {
         current_filter: newFilterId,
@@ -843,7 +844,8 @@ function handleControlChange(event) {
     }
     currentState.filter_params = currentState.filter_params || {};
     currentState.filter_params[filterId] = currentState.filter_params[filterId] || {};
-    if (currentState.filter_params[filterId][paramKey] !== value) {
+    const previousValue = currentState.filter_params[filterId][paramKey] ?? availableFilters[filterId]?.params?.[paramKey]?.value;
+    if (previousValue !== value) {
         currentState.filter_params[filterId][paramKey] = value;
         const payload = {
             filter_params: {
@@ -1325,7 +1327,7 @@ function handleDocumentMouseUpDrag(event) {
 
         // Send update
         commitPendingUndo();
-        throttledSendUpdate({ fog_of_war: currentState.fog_of_war });
+        if (polygonData) sendFogPolygonChanged(polygonData);
         debouncedAutoSave();
         console.log("Polygon drag completed.");
 
@@ -1544,7 +1546,7 @@ function handleDocumentMouseUpVertex(event) {
         }
 
         commitPendingUndo();
-        throttledSendUpdate({ fog_of_war: currentState.fog_of_war });
+        if (polygonData) sendFogPolygonChanged(polygonData);
         debouncedAutoSave();
         console.log("Vertex drag completed.");
 
@@ -1671,7 +1673,7 @@ function handleDocumentMouseUpResize(event) {
         }
 
         commitPendingUndo();
-        throttledSendUpdate({ fog_of_war: currentState.fog_of_war });
+        if (polygonData) sendFogPolygonChanged(polygonData);
         debouncedAutoSave();
         console.log("Resize drag completed.");
 
@@ -1802,7 +1804,7 @@ function handleDocumentMouseUpEdge(event) {
         }
 
         commitPendingUndo();
-        throttledSendUpdate({ fog_of_war: currentState.fog_of_war });
+        if (polygonData) sendFogPolygonChanged(polygonData);
         debouncedAutoSave();
         console.log("Edge resize drag completed.");
 
@@ -1949,7 +1951,7 @@ function handleDocumentMouseUpShape(event) {
     currentState.fog_of_war.hidden_polygons.push(newPolygon);
     drawSingleCompletedPolygon(newPolygon);
 
-    throttledSendUpdate({ fog_of_war: currentState.fog_of_war });
+    sendFogPolygonAdded(newPolygon);
     debouncedAutoSave();
 
     cleanupShapePreview();
@@ -2107,9 +2109,7 @@ function completeCurrentPolygon() {
 
     // *** ADDED: Send update to backend/players ***
     console.log("Sending fog update after polygon completion.");
-    throttledSendUpdate({
-        fog_of_war: currentState.fog_of_war
-    });
+    sendFogPolygonAdded(newPolygon);
 
     // Trigger auto-save (debounced)
     debouncedAutoSave();
@@ -2176,9 +2176,7 @@ function handleDeletePolygon() {
             const elementToRemove = svgCompletedLayer.querySelector(`.fog-polygon-complete[data-polygon-id="${selectedPolygonId}"]`);
             if (elementToRemove) elementToRemove.remove();
         }
-        throttledSendUpdate({
-            fog_of_war: currentState.fog_of_war
-        });
+        sendFogPolygonDeleted(selectedPolygonId);
         debouncedAutoSave();
         console.log("Polygon deleted.");
     } else {
@@ -2212,7 +2210,7 @@ function setupFogColorPicker() {
                 const el = svgCompletedLayer.querySelector(`.fog-polygon-complete[data-polygon-id="${selectedPolygonId}"]`);
                 if (el) el.setAttribute('fill', newColor);
             }
-            throttledSendUpdate({ fog_of_war: currentState.fog_of_war });
+            sendFogPolygonChanged(polygon);
             debouncedAutoSave();
         }
     });
@@ -2435,6 +2433,10 @@ function throttledSendUpdate(partialData) {
     if (!_pendingUpdate) {
         _pendingUpdate = {};
     }
+    if (partialData.fog_of_war) {
+        // A full fog list supersedes any fog ops not yet sent
+        _pendingFogOps = [];
+    }
     _deepMerge(_pendingUpdate, partialData);
     if (!_sendThrottleTimer) {
         _sendThrottleTimer = setTimeout(flushUpdate, SEND_THROTTLE_MS);
@@ -2449,18 +2451,112 @@ function flushUpdate() {
     }
 }
 
+// --- Fog Operations ---
+// Single-polygon edits go out as ops keyed by polygon id instead of the whole fog list
+function queueFogOps(ops) {
+    // Ops build on the server's current list, so a queued full list must go first
+    if (_pendingUpdate && _pendingUpdate.fog_of_war) {
+        clearTimeout(_sendThrottleTimer);
+        flushUpdate();
+    }
+    for (const op of ops) {
+        if (op.op === 'update') {
+            // Only the latest version of a polygon matters; fold into a queued add/update for the same id
+            const queued = _pendingFogOps.find(o => (o.op === 'add' || o.op === 'update') && o.polygon.id === op.polygon.id);
+            if (queued) {
+                queued.polygon = op.polygon;
+                continue;
+            }
+        }
+        _pendingFogOps.push(op);
+    }
+    if (!_fogOpsTimer) {
+        _fogOpsTimer = setTimeout(flushFogOps, SEND_THROTTLE_MS);
+    }
+}
+
+function flushFogOps() {
+    _fogOpsTimer = null;
+    if (_pendingFogOps.length === 0) return;
+    const ops = _pendingFogOps;
+    _pendingFogOps = [];
+    if (!socket || !socket.connected) {
+        // Ops can't be replayed safely later — resend the whole list once reconnected
+        console.warn("WS disconnected, fog will be resent in full.");
+        _fogResyncNeeded = true;
+        return;
+    }
+    try {
+        emitOrdered('fog_ops', Promise.all(ops.map(async op => op.polygon ? { ...op, polygon: await packFogPolygon(op.polygon) } : op))
+            .then(packedOps => ({ ops: packedOps })));
+    } catch (e) {
+        console.error("Error emitting fog ops:", e);
+    }
+}
+
+function emitOrdered(event, payloadPromise) {
+    _emitChain = _emitChain
+        .then(() => payloadPromise)
+        .then(payload => {
+            if (socket && socket.connected) socket.emit(event, payload);
+            else console.warn(`WS disconnected, '${event}' dropped.`);
+        })
+        .catch(e => console.error(`Error emitting '${event}':`, e));
+}
+
+// Vertices are read synchronously here, so later edits to the polygon can't leak into this send
+async function packFogVertices(vertices) {
+    const values = new Int32Array(vertices.length * 2);
+    let previousX = 0, previousY = 0;
+    for (let i = 0; i < vertices.length; i++) {
+        const x = Math.round(vertices[i].x * FOG_QUANT_SCALE), y = Math.round(vertices[i].y * FOG_QUANT_SCALE);
+        values[2 * i] = x - previousX;
+        values[2 * i + 1] = y - previousY;
+        previousX = x;
+        previousY = y;
+    }
+    const stream = new Blob([values]).stream().pipeThrough(new CompressionStream('deflate'));
+    return new Response(stream).arrayBuffer();
+}
+
+function packFogPolygon(polygon) {
+    const vertices = polygon?.vertices;
+    if (!FOG_PACKING || !Array.isArray(vertices) || !vertices.every(v => Number.isFinite(v?.x) && Number.isFinite(v?.y))) {
+        return Promise.resolve(polygon);
+    }
+    const { vertices: _plain, ...rest } = polygon;
+    return packFogVertices(vertices).then(packed => ({ ...rest, packed_vertices: packed }));
+}
+
+async function packFogOfWar(fog) {
+    if (!Array.isArray(fog?.hidden_polygons)) return fog;
+    return { ...fog, hidden_polygons: await Promise.all(fog.hidden_polygons.map(packFogPolygon)) };
+}
+
+function sendFogPolygonAdded(polygon) {
+    queueFogOps([{ op: 'add', polygon: polygon }]);
+}
+
+function sendFogPolygonChanged(polygon) {
+    queueFogOps([{ op: 'update', polygon: polygon }]);
+}
+
+function sendFogPolygonDeleted(polygonId) {
+    queueFogOps([{ op: 'delete', id: polygonId }]);
+}
+
 function sendUpdate(updateData) {
     console.log("Sending update:", JSON.stringify(updateData));
     if (!socket || !socket.connected) {
         console.warn("WS disconnected.");
         return;
     }
-    const payload = {
-        update_data: updateData
-    };
+    const payload = updateData.fog_of_war
+        ? packFogOfWar(updateData.fog_of_war).then(fog => ({ update_data: { ...updateData, fog_of_war: fog } }))
+        : Promise.resolve({ update_data: updateData });
     try {
-        socket.emit('gm_update', payload);
-        console.log(" -> 'gm_update' emitted.");
+        emitOrdered('gm_update', payload);
+        console.log(" -> 'gm_update' queued.");
     } catch (e) {
         console.error("Error emitting:", e);
     }
@@ -2556,15 +2652,30 @@ function handleBeforeUnload() {
 }
 
 // --- Session/Player URL Display ---
+function playerPath() {
+    return sessionCode ? `/player?session=${encodeURIComponent(sessionCode)}` : '/player';
+}
+
 function updatePlayerUrl() {
     if (lanPlayerUrlDisplay && lanIp) {
-        lanPlayerUrlDisplay.value = `http://${lanIp}:${lanPort}/player`;
+        lanPlayerUrlDisplay.value = `http://${lanIp}:${lanPort}${playerPath()}`;
     }
     if (tunnelPlayerUrlDisplay && tunnelUrl) {
-        tunnelPlayerUrlDisplay.value = `${tunnelUrl}/player`;
+        tunnelPlayerUrlDisplay.value = `${tunnelUrl}${playerPath()}`;
     }
 }
 
+// The table this GM runs; the default table keeps the plain /player link
+function fetchSessionInfo() {
+    fetch('/api/sessions/current')
+        .then(r => r.json())
+        .then(data => {
+            sessionCode = data.default ? null : data.code;
+            updatePlayerUrl();
+        })
+        .catch(err => console.warn("Could not fetch session info:", err));
+}
+
 function fetchLanInfo() {
     fetch('/api/lan-info')
         .then(r => r.json())
@@ -2947,20 +3058,6 @@ function updateSaveDisplay() {
 }
 
 // --- Helpers (Unchanged) ---
-function get_default_filter_params() {
-    const fp = {};
-    for (const f_id in availableFilters) {
-        const fc = availableFilters[f_id];
-        fp[f_id] = {};
-        if (fc?.params) {
-            for (const key in fc.params) {
-                if (fc.params[key].value !== undefined && key !== 'backgroundImageFilename') fp[f_id][key] = fc.params[key].value;
-            }
-        }
-    }
-    return fp;
-}
-
 function generateUniqueId() {
     return `poly_${Date.now()}_${Math.random().toString(36).substring(2, 7)}`;
 }
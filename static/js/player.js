@@ -18,6 +18,13 @@ let currentViewState = {};
 let currentFilterParams = {};
 let currentMapContentPath = null;
 let currentObjectUrl = null; // Keep track of the blob URL
+let currentFrameVersion = null; // Server frame version of the displayed map image (tile patches apply on top of it)
+let mapCanvas = null;           // Canvas backing the texture once tile patches start arriving
+let tilePatchChain = Promise.resolve();
+let fullImageRequested = false; // A request_map_image resync is in flight
+let playerState = null;          // Last state received (snapshot + applied patches)
+let stateVersion = null;         // Server version of playerState; state_patch events apply on top of it
+let stateSnapshotRequested = false; // A request_state_snapshot resync is in flight
 
 // --- Player Local Pan/Zoom State ---
 let playerZoom = 1.0;       // multiplier on top of GM scale
@@ -48,6 +55,7 @@ let targetViewState = null;       // target camera state for lerping
 
 // --- Preview Mode ---
 const isPreviewMode = window.parent !== window;
+const sessionCode = new URLSearchParams(window.location.search).get('session'); // table to join (/player?session=CODE); none = default
 
 // --- DOM Elements ---
 const canvas = document.getElementById('player-canvas');
@@ -157,11 +165,14 @@ function connectWebSocket() {
     if (window.parent !== window) ioOpts.query = { preview: '1' };
     try { socket = io(ioOpts); console.log("Socket.IO object created:", socket); }
     catch (error) { console.error("Error initializing Socket.IO connection:", error); return; }
-    socket.on('connect', () => { console.log(`WebSocket connected: ${socket.id}`); displayStatus(`Connected.`); socket.emit('join_game'); });
+    socket.on('connect', () => { console.log(`WebSocket connected: ${socket.id}`); displayStatus(`Connected.`); socket.emit('join_game', { session: sessionCode, binary_images: true, http_images: true, viewport: { width: window.screen.width, height: window.screen.height, pixel_ratio: window.devicePixelRatio || 1 } }); });
     socket.on('disconnect', (reason) => { console.warn(`WebSocket disconnected: ${reason}`); displayStatus(`Disconnected.`); });
     socket.on('connect_error', (error) => { console.error('WebSocket connection error:', error); displayStatus(`Connection Error.`); });
-    socket.on('state_update', handleStateUpdate);
+    socket.on('state_update', handleStateSnapshot);
+    socket.on('state_patch', handleStatePatch);
     socket.on('map_image_data', handleMapImageData);
+    socket.on('map_image_url', handleMapImageUrl);
+    socket.on('map_tiles', handleMapTiles);
     socket.on('error', (data) => { console.error('Server WS Error:', data.message || data); displayStatus(`SERVER ERROR.`); });
     if (!isPreviewMode) {
         TokenShared.onTokensUpdate(socket, (newTokens) => {
@@ -174,6 +185,63 @@ function connectWebSocket() {
 }
 
 
+// --- Versioned State ---
+// Full snapshot (join / resync), tagged with the server state version.
+function handleStateSnapshot(snapshot) {
+    if (!snapshot || typeof snapshot !== 'object') { console.error("Invalid state snapshot received."); return; }
+    stateVersion = typeof snapshot.state_version === 'number' ? snapshot.state_version : null;
+    delete snapshot.state_version;
+    stateSnapshotRequested = false;
+    playerState = snapshot;
+    handleStateUpdate(playerState);
+}
+
+function requestStateSnapshot() {
+    if (stateSnapshotRequested || !socket || !socket.connected) return;
+    stateSnapshotRequested = true;
+    console.warn(`[state_patch] Version gap at ${stateVersion}, requesting snapshot.`);
+    socket.emit('request_state_snapshot');
+}
+
+// RFC 6902 subset used by the server: add / replace / remove on JSON pointer paths.
+function applyJsonPatch(doc, ops) {
+    for (const op of ops) {
+        if (op.path === '') {
+            if (op.op === 'remove') throw new Error('Cannot remove document root');
+            doc = op.value;
+            continue;
+        }
+        const keys = op.path.split('/').slice(1).map(k => k.replace(/~1/g, '/').replace(/~0/g, '~'));
+        const last = keys.pop();
+        let parent = doc;
+        for (const key of keys) {
+            parent = parent?.[key];
+            if (!parent || typeof parent !== 'object') throw new Error(`Bad patch path ${op.path}`);
+        }
+        if (op.op === 'remove') delete parent[last];
+        else if (op.op === 'add' || op.op === 'replace') parent[last] = op.value;
+        else throw new Error(`Unsupported patch op ${op.op}`);
+    }
+    return doc;
+}
+
+function handleStatePatch(patch) {
+    if (!patch || !Array.isArray(patch.ops)) return;
+    if (stateVersion === null || playerState === null) { requestStateSnapshot(); return; }
+    if (patch.version <= stateVersion) return; // Already included in a snapshot
+    if (patch.base !== stateVersion) { requestStateSnapshot(); return; }
+    try {
+        // Patch a copy — filter params in use may still reference the current object
+        playerState = applyJsonPatch(JSON.parse(JSON.stringify(playerState)), patch.ops);
+    } catch (e) {
+        console.error('[state_patch] Failed to apply patch:', e);
+        requestStateSnapshot();
+        return;
+    }
+    stateVersion = patch.version;
+    handleStateUpdate(playerState);
+}
+
 // --- State Update Handler ---
 async function handleStateUpdate(state) {
     console.log('[handleStateUpdate] Received state:', JSON.stringify(state));
@@ -184,7 +252,8 @@ async function handleStateUpdate(state) {
     const newContentPath = state.map_content_path || null; // Relative URL from backend
     console.log(`[handleStateUpdate] Processing: Path='${newContentPath}', Filter='${newFilterId}'`);
     // Update filter params... (condensed)
-    if (state.filter_params && state.filter_params[newFilterId]) { currentFilterParams = state.filter_params[newFilterId]; } else { const filterConfig = filterDefinitions[newFilterId]; currentFilterParams = {}; if (filterConfig?.params) { for (const key in filterConfig.params) { if (filterConfig.params[key].value !== undefined) { currentFilterParams[key] = filterConfig.params[key].value; } } } } currentFilterParams = currentFilterParams || {};
+    // filter_params holds only overrides of the filter's defaults
+    const filterConfig = filterDefinitions[newFilterId]; currentFilterParams = {}; if (filterConfig?.params) { for (const key in filterConfig.params) { if (filterConfig.params[key].value !== undefined) { currentFilterParams[key] = filterConfig.params[key].value; } } } Object.assign(currentFilterParams, state.filter_params?.[newFilterId] || {});
 
     try {
         let shaderChanged = false; let shadersOk = true;
@@ -278,22 +347,54 @@ async function handleStateUpdate(state) {
 }
 
 // --- Binary Image Data Handler ---
+// Builds a Blob from either a raw binary attachment ({bytes, mime}) or the legacy base64 payload ({b64}).
+function mapImageBlobFromData(data) {
+    if (!data) return null;
+    const mime = data.mime || 'image/jpeg';
+    if (data.blob) return data.blob;
+    if (data.bytes) {
+        console.log(`[map_image_data] Received binary image: ${data.bytes.byteLength} bytes`);
+        return new Blob([data.bytes], { type: mime });
+    }
+    if (data.b64) {
+        console.log(`[map_image_data] Received base64 image: ${data.b64.length} chars`);
+        const binaryStr = atob(data.b64);
+        const bytes = new Uint8Array(binaryStr.length);
+        for (let i = 0; i < binaryStr.length; i++) { bytes[i] = binaryStr.charCodeAt(i); }
+        return new Blob([bytes], { type: mime });
+    }
+    return null;
+}
+
+// Content-addressed composite URL (immutable) — the browser cache makes reconnects free.
+async function handleMapImageUrl(data) {
+    if (!data || !data.url) return;
+    try {
+        let response = await fetch(data.url);
+        if (response.status === 503) {
+            // The composite isn't on this server worker's disk yet — retry once before asking for the bytes
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            response = await fetch(data.url);
+        }
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        handleMapImageData({ blob: await response.blob(), version: data.version });
+    } catch (e) {
+        console.error(`[map_image_url] Failed to fetch ${data.url}:`, e);
+        requestFullMapImage();
+    }
+}
+
 function handleMapImageData(data) {
-    const b64 = data && data.b64;
-    if (!b64) { console.warn("[map_image_data] No b64 field in data."); return; }
-    console.log(`[map_image_data] Received base64 image: ${b64.length} chars`);
     if (!material || !planeMesh) { console.warn("[map_image_data] Material/mesh not ready."); return; }
 
     // Keep old texture visible until the new one is ready (prevents flash)
     const oldTexture = material.uniforms.mapTexture?.value;
     const oldObjectUrl = currentObjectUrl;
+    const incomingVersion = data && data.version !== undefined ? data.version : null;
 
     try {
-        // Decode base64 to binary
-        const binaryStr = atob(b64);
-        const bytes = new Uint8Array(binaryStr.length);
-        for (let i = 0; i < binaryStr.length; i++) { bytes[i] = binaryStr.charCodeAt(i); }
-        const blob = new Blob([bytes], { type: 'image/jpeg' });
+        const blob = mapImageBlobFromData(data);
+        if (!blob) { console.warn("[map_image_data] No image payload in data."); return; }
         currentObjectUrl = URL.createObjectURL(blob);
 
         imageLoader.load(currentObjectUrl,
@@ -305,6 +406,9 @@ function handleMapImageData(data) {
                     material.uniforms.mapTexture.value = texture;
                     if (oldTexture) oldTexture.dispose();
                     if (oldObjectUrl) URL.revokeObjectURL(oldObjectUrl);
+                    currentFrameVersion = incomingVersion;
+                    mapCanvas = null;
+                    fullImageRequested = false;
                     if (imageElement.naturalWidth > 0 && imageElement.naturalHeight > 0) {
                         const textureAspect = imageElement.naturalWidth / imageElement.naturalHeight;
                         planeMesh.scale.set(textureAspect, 1.0, 1.0);
@@ -312,13 +416,14 @@ function handleMapImageData(data) {
                     }
                     updateCameraView(currentViewState);
                     displayStatus("");
-                    console.log("[map_image_data] Texture loaded from base64 stream.");
+                    console.log("[map_image_data] Texture loaded from image blob.");
                 } catch (e) { console.error("[map_image_data] Error creating texture:", e); }
             },
             undefined,
             (err) => {
                 // Load failed — restore old object URL so it can be cleaned up next time
                 currentObjectUrl = oldObjectUrl;
+                fullImageRequested = false;
                 console.error("[map_image_data] ImageLoader failed:", err); displayStatus("ERROR loading map image.");
             }
         );
@@ -327,6 +432,55 @@ function handleMapImageData(data) {
     }
 }
 
+// --- Tile Patch Handler ---
+// Patches changed tiles into the current texture. The texture is moved onto a canvas on the
+// first patch; a full map_image_data later replaces it again. Patches apply strictly in order,
+// and a patch whose base_version doesn't match what we display triggers a full resync.
+function requestFullMapImage() {
+    currentFrameVersion = null;
+    if (fullImageRequested || !socket) return;
+    fullImageRequested = true;
+    socket.emit('request_map_image');
+}
+
+function handleMapTiles(patch) {
+    tilePatchChain = tilePatchChain.then(() => applyMapTiles(patch)).catch((e) => {
+        console.error("[map_tiles] Error applying tile patch:", e);
+        requestFullMapImage();
+    });
+}
+
+async function applyMapTiles(patch) {
+    if (!patch || !Array.isArray(patch.tiles)) return;
+    const texture = material?.uniforms?.mapTexture?.value;
+    if (!texture || currentFrameVersion === null || patch.base_version !== currentFrameVersion) {
+        console.warn(`[map_tiles] Version gap (have ${currentFrameVersion}, patch base ${patch.base_version}) — requesting full image.`);
+        requestFullMapImage();
+        return;
+    }
+    if (!mapCanvas) {
+        const source = texture.image;
+        if (!source || source.width !== patch.width || source.height !== patch.height) {
+            console.warn("[map_tiles] Texture size mismatch — requesting full image.");
+            requestFullMapImage();
+            return;
+        }
+        mapCanvas = document.createElement('canvas');
+        mapCanvas.width = patch.width; mapCanvas.height = patch.height;
+        mapCanvas.getContext('2d').drawImage(source, 0, 0);
+        const canvasTexture = new THREE.CanvasTexture(mapCanvas);
+        material.uniforms.mapTexture.value = canvasTexture;
+        texture.dispose();
+        if (currentObjectUrl) { URL.revokeObjectURL(currentObjectUrl); currentObjectUrl = null; }
+    }
+    const bitmaps = await Promise.all(patch.tiles.map(tile => createImageBitmap(mapImageBlobFromData({ bytes: tile.bytes, mime: patch.mime }))));
+    const ctx = mapCanvas.getContext('2d');
+    patch.tiles.forEach((tile, i) => { ctx.drawImage(bitmaps[i], tile.x, tile.y); bitmaps[i].close(); });
+    material.uniforms.mapTexture.value.needsUpdate = true;
+    currentFrameVersion = patch.version;
+    console.log(`[map_tiles] Applied ${patch.tiles.length} tile(s), now at version ${currentFrameVersion}.`);
+}
+
 // --- Uniform Handling (Unchanged, condensed) ---
 function updateUniformsForMaterial(targetMaterial, filterConfig, paramsForFilter) {
     const expectedUniforms = new Set(['mapTexture', 'resolution', 'time']); const currentUniforms = targetMaterial.uniforms; let uniformsChanged = false;
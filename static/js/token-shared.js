@@ -61,12 +61,48 @@
 
     // --- Socket Listener ---
 
+    /**
+     * onTokensUpdate(socket, callback)
+     *
+     * Keeps a local id-indexed copy of the tokens from the full 'tokens_update'
+     * list plus batched 'tokens_delta' updates, and calls callback(tokensArray)
+     * after each change. A delta carries the latest version of each changed token,
+     * so it applies on top of any seq in [base, seq); a client below base missed
+     * one and requests the full list again.
+     */
     function onTokensUpdate(socket, callback) {
         if (!socket) return;
+        let tokenMap = new Map();
+        let seq = null;
+        let resyncRequested = false;
+
+        function requestResync() {
+            if (resyncRequested || !socket.connected) return;
+            resyncRequested = true;
+            console.warn(`Token seq gap at ${seq}, requesting full list.`);
+            socket.emit('request_tokens');
+        }
+
         socket.on('tokens_update', (data) => {
             if (data && Array.isArray(data.tokens)) {
-                callback(data.tokens);
+                tokenMap = new Map(data.tokens.map(t => [t.id, t]));
+                seq = typeof data.seq === 'number' ? data.seq : null;
+                resyncRequested = false;
+                callback(Array.from(tokenMap.values()));
+            }
+        });
+        socket.on('tokens_delta', (data) => {
+            if (!data || typeof data.seq !== 'number' || seq === null) return;
+            if (data.seq <= seq) return; // Already covered by a full list
+            if (data.base > seq) {
+                requestResync();
+                return;
             }
+            // Map.set keeps an existing token's position, so placement order is preserved
+            (data.changed || []).forEach(t => tokenMap.set(t.id, t));
+            (data.removed || []).forEach(id => tokenMap.delete(id));
+            seq = data.seq;
+            callback(Array.from(tokenMap.values()));
         });
     }
 
@@ -0,0 +1,104 @@
+# worker.py
+# Headless production entry point — serves the app under gunicorn, no GM window (and no pywebview import)
+#
+#   python worker.py --port 5000
+#   python worker.py --role authoritative --port 5000 --bus sqlite:///bus.db
+#   python worker.py --role fanout --port 5001 --bus sqlite:///bus.db
+#
+# Players can connect to any worker (e.g. behind a load balancer with sticky sessions); the GM uses the authoritative one.
+# Stop with SIGTERM/SIGINT: open connections are drained and the authoritative worker saves like the GM window does on close.
+
+import argparse
+import logging
+
+from gunicorn.app.base import BaseApplication
+
+from server import config
+from server import message_bus
+
+
+class HeadlessServer(BaseApplication):
+    """
+    Gunicorn serving the app from one process with a pool of threads. Sessions, sockets and
+    rendering live in that process's memory, so scale out with fan-out workers, not gunicorn workers.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        super().__init__()
+
+    def load_config(self):
+        settings = {
+            'bind': f"{self.args.host}:{self.args.port}",
+            'workers': 1,
+            'worker_class': 'gthread',
+            'threads': config.SERVER_THREADS,              # each open WebSocket holds a thread
+            'worker_connections': config.SERVER_MAX_CONNECTIONS,
+            'graceful_timeout': config.SERVER_GRACEFUL_TIMEOUT,
+            'worker_exit': _on_worker_exit,
+            'accesslog': '-' if self.args.access_log else None,
+        }
+        for key, value in settings.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Imported here, after main() applied the command line to config: create_app() reads it
+        from server import create_app
+        app = create_app()
+        if not message_bus.is_fanout():
+            from server.composite_cache import trim_disk as trim_composite_cache
+            from server.routes_saves import _auto_load_latest_save
+            from server.journal import init_journal
+            config.cleanup_generated_maps()
+            trim_composite_cache()
+            _auto_load_latest_save()
+            init_journal()
+        return app
+
+
+def _on_worker_exit(server, worker):
+    """Gunicorn hook, run in the serving process once it stopped accepting requests."""
+    if message_bus.is_fanout():
+        return
+    from server.routes_saves import _save_on_shutdown
+    logging.info("worker: Shutting down — saving state...")
+    _save_on_shutdown()
+    logging.info("worker: Shutdown complete.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dynamic Map Renderer headless server")
+    parser.add_argument('--role', choices=('authoritative', 'fanout'), default=config.WORKER_ROLE)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--bus', default=config.MESSAGE_QUEUE, help="shared message bus, e.g. sqlite:///bus.db")
+    parser.add_argument('--threads', type=int, default=config.SERVER_THREADS, help="request threads (caps concurrent WebSockets)")
+    parser.add_argument('--max-connections', type=int, default=config.SERVER_MAX_CONNECTIONS)
+    parser.add_argument('--ping-interval', type=float, default=config.SOCKETIO_PING_INTERVAL, help="seconds between Socket.IO pings")
+    parser.add_argument('--ping-timeout', type=float, default=config.SOCKETIO_PING_TIMEOUT, help="seconds without a pong before a client is dropped")
+    parser.add_argument('--max-message-size', type=int, default=config.SOCKETIO_MAX_MESSAGE_BYTES, help="largest Socket.IO message accepted from a client, in bytes")
+    parser.add_argument('--graceful-timeout', type=int, default=config.SERVER_GRACEFUL_TIMEOUT, help="seconds open requests get to finish on shutdown")
+    parser.add_argument('--access-log', action='store_true')
+    args = parser.parse_args()
+
+    config.WORKER_ROLE = args.role
+    config.MESSAGE_QUEUE = args.bus
+    config.SERVER_THREADS = args.threads
+    config.SERVER_MAX_CONNECTIONS = args.max_connections
+    config.SOCKETIO_PING_INTERVAL = args.ping_interval
+    config.SOCKETIO_PING_TIMEOUT = args.ping_timeout
+    config.SOCKETIO_MAX_MESSAGE_BYTES = args.max_message_size
+    config.SERVER_GRACEFUL_TIMEOUT = args.graceful_timeout
+
+    print("------------------------------------------")
+    print(f" Dynamic Map Renderer — headless {args.role} worker")
+    print(f" Threads: {args.threads}, max connections: {args.max_connections}, bus: {args.bus or 'none'}")
+    if not message_bus.is_fanout():
+        print(f" GM View: http://127.0.0.1:{args.port}/?token={config.GM_SECRET}")
+    print(f" Player View (LAN): http://{config.LAN_IP}:{args.port}/player")
+    print("------------------------------------------")
+    HeadlessServer(args).run()
+
+
+if __name__ == '__main__':
+    main()